@@ -0,0 +1,317 @@
+import argparse
+import collections
+import logging
+import threading
+import time
+from typing import Iterator, Optional
+
+import can
+
+from socketcan import SocketCAN
+
+'''
+CAN总线抓包和回放, 用于离线复现现场问题和不接硬件的性能测试
+
+抓包: SocketCAN.start_capture(path) 之后每一帧收发都写一行, 时间戳为time.monotonic()
+    candump日志(默认, can-utils的canplayer/log2asc和python-can都能读):
+        (12345.678901) can0 581#4B41600000000000 R
+        行尾R为收到的帧, T为本机发出的帧
+    Vector ASC(扩展名.asc, 只写经典CAN帧):
+        12345.678901 1  581             Rx   d 8 4B 41 60 00 00 00 00 00
+    写文件走大缓冲区, 接收线程里每帧只做一次格式化
+
+回放: ReplayCAN是SocketCAN的子类, 总线换成逐行读取录制文件的ReplayBus,
+      可以直接作为KincoCanController/NmxLiftCanDevice的can_bus
+    realtime=True:   按录制时的时间间隔送出接收帧(speed倍速)
+    realtime=False:  尽快送出
+    follow_tx=True:  录制里的发送帧要等驱动真的发出一帧才越过, 应答不会比请求先到;
+                     用同样的调用序列重放一遍即可复现现场
+    follow_tx=False: 跳过发送帧, 只把接收帧灌进去, 测TPDO/EMCY/心跳解码和状态跟踪的吞吐
+    文件逐行流式读取, 不整个读进内存, GB级日志也可以回放
+
+    python3 can_capture.py bench session.log --node 1     # 尽快回放, 输出帧/秒
+'''
+
+FORMATS = ("candump", "asc")
+BUFFER_SIZE = 1 << 20
+
+
+def _format_of(path: str, fmt: Optional[str]) -> str:
+    if fmt is None:
+        fmt = "asc" if path.lower().endswith(".asc") else "candump"
+    if fmt not in FORMATS:
+        raise ValueError(f"不支持的抓包格式: {fmt}, 可选{FORMATS}")
+    return fmt
+
+
+class CaptureWriter:
+    def __init__(self, path: str, fmt: Optional[str] = None, channel: str = "can0",
+                 buffer_size: int = BUFFER_SIZE):
+        '''fmt: "candump" / "asc", None时按扩展名'''
+        self.path = path
+        self.fmt = _format_of(path, fmt)
+        self.channel = channel
+        self.frames = 0
+        # 发送线程和接收线程都会写
+        self._lock = threading.Lock()
+        self._file = open(path, "w", buffering=buffer_size, encoding="ascii")
+        self._format = self._format_candump if self.fmt == "candump" else self._format_asc
+        if self.fmt == "asc":
+            self._file.write(f"date {time.strftime('%a %b %d %I:%M:%S %p %Y')}\n"
+                             "base hex  timestamps absolute\n"
+                             "internal events logged\n"
+                             "Begin Triggerblock\n")
+
+    def write(self, msg: can.Message, is_rx: bool, stamp: Optional[float] = None):
+        line = self._format(msg, is_rx, time.monotonic() if stamp is None else stamp)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self.frames += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            if self.fmt == "asc":
+                self._file.write("End TriggerBlock\n")
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _format_candump(self, msg: can.Message, is_rx: bool, stamp: float) -> str:
+        can_id = f"{msg.arbitration_id:08X}" if msg.is_extended_id else f"{msg.arbitration_id:03X}"
+        if msg.is_remote_frame:
+            body = f"R{msg.dlc}" if msg.dlc else "R"
+        elif msg.is_fd:
+            flags = (1 if msg.bitrate_switch else 0) | (2 if msg.error_state_indicator else 0)
+            body = f"#{flags:X}{bytes(msg.data).hex().upper()}"
+        else:
+            body = bytes(msg.data).hex().upper()
+        return f"({stamp:.6f}) {self.channel} {can_id}#{body} {'R' if is_rx else 'T'}\n"
+
+    def _format_asc(self, msg: can.Message, is_rx: bool, stamp: float) -> str:
+        can_id = f"{msg.arbitration_id:X}x" if msg.is_extended_id else f"{msg.arbitration_id:X}"
+        direction = "Rx" if is_rx else "Tx"
+        if msg.is_remote_frame:
+            return f"{stamp:.6f} 1  {can_id:<15} {direction}   r {msg.dlc:X}\n"
+        data = bytes(msg.data)
+        return f"{stamp:.6f} 1  {can_id:<15} {direction}   d {len(data):X} {data.hex(' ').upper()}\n"
+
+
+# ------------------------- 读取 ------------------------
+def _parse_candump(line: str) -> Optional[can.Message]:
+    parts = line.split()
+    if len(parts) < 3 or not parts[0].startswith("("):
+        return None
+    can_id, _, body = parts[2].partition("#")
+    fd = remote = brs = esi = False
+    dlc = None
+    if body.startswith("#"):
+        fd = True
+        flags = int(body[1], 16)
+        brs, esi = bool(flags & 1), bool(flags & 2)
+        data = bytes.fromhex(body[2:])
+    elif body.startswith("R"):
+        remote = True
+        data = b""
+        dlc = int(body[1:] or "0", 16)
+    else:
+        data = bytes.fromhex(body)
+    return can.Message(timestamp=float(parts[0][1:-1]), arbitration_id=int(can_id, 16),
+                       is_extended_id=len(can_id) > 3, is_remote_frame=remote, is_fd=fd,
+                       bitrate_switch=brs, error_state_indicator=esi, data=data, dlc=dlc,
+                       channel=parts[1], is_rx=len(parts) < 4 or parts[3] != "T")
+
+
+def _parse_asc(line: str) -> Optional[can.Message]:
+    # 只认经典CAN数据/远程帧行, 头部/CANFD/错误帧/统计等行跳过
+    parts = line.split()
+    if len(parts) < 5 or not parts[1].isdigit() or parts[3] not in ("Rx", "Tx"):
+        return None
+    can_id = parts[2]
+    extended = can_id.endswith("x")
+    remote = parts[4] == "r"
+    if remote:
+        data = b""
+        dlc = int(parts[5], 16) if len(parts) > 5 else 0
+    elif parts[4] == "d":
+        dlc = int(parts[5], 16)
+        data = bytes(int(b, 16) for b in parts[6:6 + dlc])
+    else:
+        return None
+    return can.Message(timestamp=float(parts[0]), arbitration_id=int(can_id.rstrip("x"), 16),
+                       is_extended_id=extended, is_remote_frame=remote, data=data, dlc=dlc,
+                       channel=parts[1], is_rx=parts[3] == "Rx")
+
+
+def read_capture(path: str, fmt: Optional[str] = None) -> Iterator[can.Message]:
+    '''
+    逐行读取录制文件, 每帧一个can.Message(timestamp为录制时间, is_rx为方向)
+    认不出或坏掉的行跳过, 截断的文件也能读到最后一个完整行
+    '''
+    parse = _parse_candump if _format_of(path, fmt) == "candump" else _parse_asc
+    with open(path, "r", buffering=BUFFER_SIZE, encoding="ascii", errors="replace") as f:
+        for line in f:
+            try:
+                msg = parse(line)
+            except (ValueError, IndexError):
+                continue
+            if msg is not None:
+                yield msg
+
+
+# ------------------------- 回放 ------------------------
+class ReplayBus(can.BusABC):
+    '''python-can总线接口, 接收帧来自录制文件, 发送的帧只用来推进follow_tx'''
+
+    def __init__(self, channel: str, realtime: bool = True, speed: float = 1.0, follow_tx: bool = True,
+                 fmt: Optional[str] = None, **kwargs):
+        '''channel: 录制文件路径'''
+        self.path = channel
+        self.realtime = realtime
+        self.speed = speed
+        self.follow_tx = follow_tx
+        self._frames = read_capture(channel, fmt)
+        self._next: Optional[can.Message] = None
+        # 录制时间 <-> 回放时间 的对应点
+        self._record_base: Optional[float] = None
+        self._wall_base = 0.0
+        # 驱动已发出但还没和录制里的发送帧对上的帧
+        self._sent = collections.deque(maxlen=4096)
+        self._sent_cond = threading.Condition()
+        self.finished = threading.Event()
+        self.rx_replayed = 0
+        self.tx_matched = 0
+        self.tx_mismatched = 0
+        self.channel_info = f"replay {channel}"
+        super().__init__(channel=channel, **kwargs)
+
+    def send(self, msg: can.Message, timeout: Optional[float] = None):
+        with self._sent_cond:
+            self._sent.append(msg)
+            self._sent_cond.notify()
+
+    def _rebase(self, record_time: float):
+        self._record_base = record_time
+        self._wall_base = time.monotonic()
+
+    def _recv_internal(self, timeout: Optional[float]):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._next is None:
+                self._next = next(self._frames, None)
+                if self._next is None:
+                    self.finished.set()
+                    if deadline is not None:
+                        time.sleep(max(deadline - time.monotonic(), 0))
+                    return None, False
+            msg = self._next
+            if self._record_base is None:
+                self._rebase(msg.timestamp)
+
+            if not msg.is_rx:
+                if self.follow_tx:
+                    sent = self._wait_sent(deadline)
+                    if sent is None:
+                        return None, False
+                    if sent.arbitration_id == msg.arbitration_id and bytes(sent.data) == bytes(msg.data):
+                        self.tx_matched += 1
+                    else:
+                        self.tx_mismatched += 1
+                        logging.debug(f"回放发送帧不一致: 录制{msg} 实际{sent}")
+                    # 之后的接收帧相对于实际发送时刻保持录制时的间隔
+                    self._rebase(msg.timestamp)
+                self._next = None
+                continue
+
+            if self.realtime:
+                due = self._wall_base + (msg.timestamp - self._record_base) / self.speed
+                wait = due - time.monotonic()
+                if wait > 0:
+                    if deadline is not None and due > deadline:
+                        time.sleep(max(deadline - time.monotonic(), 0))
+                        return None, False
+                    time.sleep(wait)
+            self._next = None
+            self.rx_replayed += 1
+            return msg, False
+
+    def _wait_sent(self, deadline: Optional[float]) -> Optional[can.Message]:
+        with self._sent_cond:
+            while not self._sent:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._sent_cond.wait(remaining)
+            return self._sent.popleft()
+
+    def shutdown(self):
+        self._frames.close()
+        super().shutdown()
+
+
+class ReplayCAN(SocketCAN):
+    def __init__(self, path: str, realtime: bool = True, speed: float = 1.0, follow_tx: bool = True,
+                 fmt: Optional[str] = None):
+        '''path: 录制文件, 其余参数见ReplayBus'''
+        super().__init__(channel=path, bitrate=0, is_fd=False, interface="replay")
+        self._replay_options = {"realtime": realtime, "speed": speed, "follow_tx": follow_tx, "fmt": fmt}
+
+    def _open_bus(self, bus_config: dict) -> can.BusABC:
+        return ReplayBus(self.channel, can_filters=bus_config.get("can_filters"), **self._replay_options)
+
+    def wait_finished(self, timeout: Optional[float] = None) -> bool:
+        '''阻塞到录制文件回放完(最后一帧已经分发)'''
+        return self.bus is not None and self.bus.finished.wait(timeout)
+
+    def replay_stats(self) -> dict:
+        bus = self.bus
+        return {"rx_replayed": bus.rx_replayed, "tx_matched": bus.tx_matched,
+                "tx_mismatched": bus.tx_mismatched, "finished": bus.finished.is_set()}
+
+
+def bench(path: str, node_id: int) -> dict:
+    '''尽快回放, 只做TPDO/EMCY/心跳的解码和状态跟踪, return: 帧数和帧/秒'''
+    from nmx_lift_can_device import KincoCanController
+
+    replay = ReplayCAN(path, realtime=False, follow_tx=False)
+    controller = KincoCanController(path, node_id, 0, can_bus=replay)
+    controller.enable_pdo_telemetry(configure=False)
+    controller.enable_node_monitor(configure=False)
+    start = time.perf_counter()
+    if not replay.connect():
+        raise RuntimeError(f"打开录制文件失败: {path}")
+    try:
+        replay.wait_finished()
+        elapsed = time.perf_counter() - start
+        # Close会清掉telemetry/monitor, 先取状态
+        telemetry, monitor = controller.telemetry.snapshot(), controller.monitor.state()
+    finally:
+        controller.Close()
+        replay.disconnect()
+    frames = replay.rx_delivered
+    return {"frames": frames, "seconds": elapsed, "frames_per_s": frames / elapsed if elapsed else 0.0,
+            "telemetry": telemetry, "monitor": monitor}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CAN录制文件工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench_parser = sub.add_parser("bench", help="尽快回放, 测解码和状态跟踪吞吐")
+    bench_parser.add_argument("path")
+    bench_parser.add_argument("--node", type=lambda s: int(s, 0), default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == "bench":
+        print(bench(args.path, args.node))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+import heapq
+import logging
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import can
+
+import sdo_codec
+from nmx_lift_can_device import KincoObject, SYNC_COB_ID, INC_PER_M, RPM_PER_MPS, RPM_PER_DEC
+
+'''
+Kinco CANopen 伺服仿真器, 不需要实物就能跑 nmx_lift_can_device.py
+
+    虚拟总线(同一进程):
+        sim = KincoSimulator(channel="sim", interface="virtual", node_ids=[1])
+        config.interface = "virtual"; config.channel = "sim"
+    vcan(可以和驱动分进程):
+        sudo modprobe vcan
+        sudo ip link add dev vcan0 type vcan
+        sudo ip link set vcan0 up
+        python3 kinco_sim.py vcan0 1 2 3
+
+支持: KincoObject里的对象读写, 梯形速度规划的位置模式运动, 周期同步位置模式(线性插补),
+      TPDO/RPDO映射/NMT/SYNC,
+      应答延时/丢帧/SDO中止注入, 故障注入(EMCY)
+      每个节点记录最近一次开始运动的时刻(move_started), 用来核对同步启动的实际偏差
+      心跳/NMT复位后的boot-up, 故障复位时发错误码0的EMCY, silence()模拟节点掉线
+'''
+
+ABORT_NO_OBJECT = 0x06020000
+ABORT_READ_ONLY = 0x06010002
+ABORT_GENERAL = 0x08000000
+
+SW_OPERATION_ENABLED = 0x0237       # ready/switched on/operation enabled/quick stop/remote
+NMT_PRE_OPERATIONAL = 0x7F
+NMT_OPERATIONAL = 0x05
+
+# 对象 -> 数据长度
+OBJECT_SIZES = {
+    KincoObject.CONTROL_WORD: 2, KincoObject.STATUS_WORD: 2, KincoObject.WORK_MODE: 1,
+    KincoObject.POS_ACTUAL: 4, KincoObject.POS_TARGET: 4, KincoObject.TRAPEZOID_SPEED: 4,
+    KincoObject.SPEED_ACTUAL: 4, KincoObject.SPEED_TARGET: 4,
+    KincoObject.CURRENT_ACTUAL: 2, KincoObject.CURRENT_TARGET: 2,
+    KincoObject.CURRENT_LIMIT: 2, KincoObject.POS_SOFT_LIMIT: 4, KincoObject.NEG_SOFT_LIMIT: 4,
+    KincoObject.SPEED_LIMIT: 4, KincoObject.ERROR_CODE1: 2, KincoObject.ERROR_CODE2: 2,
+    KincoObject.INTERP_PERIOD: 1, KincoObject.INTERP_PERIOD_INDEX: 1,
+}
+READ_ONLY = {KincoObject.STATUS_WORD, KincoObject.POS_ACTUAL, KincoObject.SPEED_ACTUAL,
+             KincoObject.CURRENT_ACTUAL, KincoObject.ERROR_CODE1, KincoObject.ERROR_CODE2}
+HEARTBEAT_TIME = KincoObject.HEARTBEAT_TIME
+
+
+def to_signed(value: int, bits: int) -> int:
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+
+def dec_to_inc_per_s(dec: int) -> float:
+    '''速度DEC单位 -> inc/s'''
+    return dec * RPM_PER_DEC / RPM_PER_MPS * INC_PER_M
+
+
+class KincoSimNode:
+    '''一个仿真伺服节点, 由KincoSimulator驱动, 方法都在持有lock时调用'''
+
+    def __init__(self, node_id: int, accel: float = 0.5, position: float = 0.0):
+        '''accel: 加减速度, 单位m/s^2'''
+        self.node_id = node_id
+        self.accel = accel * INC_PER_M
+        self.position = position * INC_PER_M
+        self.velocity = 0.0
+        self.moving = False
+        self.fault = 0
+        self.nmt_state = NMT_PRE_OPERATIONAL
+        self.od: Dict[Tuple[int, int], int] = {obj: 0 for obj in OBJECT_SIZES}
+        self.od[KincoObject.TRAPEZOID_SPEED] = round(0.05 * RPM_PER_MPS / RPM_PER_DEC)
+        self.pdo_due: Dict[int, float] = {}
+        self.pdo_last: Dict[int, Tuple[bytes, float]] = {}
+        self.heartbeat_due = 0.0
+        # 掉线: 不应答也不发任何帧
+        self.silent = False
+        self.move_started: Optional[float] = None
+        # CSP: 当前插补段的起点和已走时间
+        self.csp_from = self.position
+        self.csp_elapsed = 0.0
+        # RPDO: COB-ID -> [编号], 同步传输的RPDO收到后先放在rpdo_pending, SYNC时生效
+        self.rpdo_ids: Dict[int, List[int]] = {}
+        self.rpdo_pending: Dict[int, bytes] = {}
+
+    # ------------------------- 对象字典 ------------------------
+    def status_word(self) -> int:
+        word = SW_OPERATION_ENABLED
+        if self.fault:
+            word |= KincoObject.SW_FAULT
+        if not self.moving:
+            word |= KincoObject.SW_TARGET_REACHED
+        return word
+
+    def read(self, key) -> Optional[Tuple[int, int]]:
+        '''return: (值, 长度), 对象不存在返回None'''
+        if key == KincoObject.STATUS_WORD:
+            return self.status_word(), 2
+        if key == KincoObject.POS_ACTUAL:
+            return round(self.position), 4
+        if key == KincoObject.SPEED_ACTUAL:
+            return round(self.velocity / dec_to_inc_per_s(1)), 4
+        if key == KincoObject.CURRENT_ACTUAL:
+            return (300 if self.moving else 20), 2
+        if key == KincoObject.ERROR_CODE1:
+            return self.fault & 0xFFFF, 2
+        if key == KincoObject.ERROR_CODE2:
+            return self.fault >> 16, 2
+        if key in OBJECT_SIZES:
+            return self.od[key], OBJECT_SIZES[key]
+        if key in self.od:
+            return self.od[key], 4
+        return None
+
+    def write(self, key, value: int, size: int) -> Optional[int]:
+        '''return: 中止码, 成功返回None'''
+        if key in READ_ONLY:
+            return ABORT_READ_ONLY
+        if key not in OBJECT_SIZES and not (0x1000 <= key[0] < 0x2000):
+            return ABORT_NO_OBJECT
+        previous = self.od.get(key, 0)
+        self.od[key] = value
+        if key == KincoObject.CONTROL_WORD:
+            self.control_word(previous, value)
+        elif (key == KincoObject.POS_TARGET and self.od[KincoObject.WORK_MODE] == 8
+              or key == KincoObject.WORK_MODE and value == 8 and previous != 8):
+            # 设定点从当前位置开始插补
+            self.csp_from = self.position
+            self.csp_elapsed = 0.0
+        elif key[1] == 1 and KincoObject.RPDO_COMM <= key[0] < KincoObject.RPDO_COMM + 4:
+            self.update_rpdo_ids()
+        return None
+
+    def control_word(self, previous: int, value: int):
+        if value == 0x86:
+            self.fault = 0
+        elif value == 0x0B:
+            self.moving = False
+            self.velocity = 0.0
+        elif value & 0x10 and not previous & 0x10 and not self.fault:
+            # bit4上升沿: 接受新的目标位置
+            if self.od[KincoObject.WORK_MODE] == 1:
+                self.moving = True
+                self.move_started = time.monotonic()
+
+    def inject_fault(self, code: int):
+        self.fault = code
+        self.moving = False
+        self.velocity = 0.0
+
+    # ------------------------- 运动 ------------------------
+    def step(self, dt: float):
+        if self.od[KincoObject.WORK_MODE] == 8:
+            self.step_csp(dt)
+            return
+        if not self.moving:
+            return
+        target = to_signed(self.od[KincoObject.POS_TARGET], 32)
+        v_max = abs(dec_to_inc_per_s(to_signed(self.od[KincoObject.TRAPEZOID_SPEED], 32)))
+        distance = target - self.position
+        direction = 1.0 if distance > 0 else -1.0
+        speed = abs(self.velocity)
+        stop_distance = speed * speed / (2 * self.accel)
+        if abs(distance) <= stop_distance:
+            speed = max(speed - self.accel * dt, 0.0)
+        else:
+            speed = min(speed + self.accel * dt, v_max)
+        self.velocity = direction * speed
+        moved = self.velocity * dt
+        if abs(moved) >= abs(distance) or (speed == 0.0 and abs(distance) < 1.0):
+            self.position = float(target)
+            self.velocity = 0.0
+            self.moving = False
+        else:
+            self.position += moved
+
+    def step_csp(self, dt: float):
+        '''周期同步位置模式: 在一个插补周期内从上一个位置线性走到新设定点'''
+        if self.fault or not self.od[KincoObject.CONTROL_WORD] & 0x0F == 0x0F:
+            return
+        period = (self.od[KincoObject.INTERP_PERIOD] or 1) / 1000
+        target = to_signed(self.od[KincoObject.POS_TARGET], 32)
+        self.csp_elapsed = min(self.csp_elapsed + dt, period)
+        position = self.csp_from + (target - self.csp_from) * (self.csp_elapsed / period)
+        self.velocity = (position - self.position) / dt
+        self.moving = position != target
+        self.position = position
+
+    # ------------------------- PDO ------------------------
+    def tpdos(self) -> List[Tuple[int, int, bytes]]:
+        '''return: 已使能的TPDO [(编号, cob_id, 数据)]'''
+        frames = []
+        for num in range(4):
+            cob_id = self.od.get((KincoObject.TPDO_COMM + num, 1))
+            count = self.od.get((KincoObject.TPDO_MAP + num, 0), 0)
+            if cob_id is None or cob_id & 0x80000000 or not count:
+                continue
+            data = b""
+            for i in range(1, count + 1):
+                entry = self.od[(KincoObject.TPDO_MAP + num, i)]
+                bits = entry & 0xFF
+                obj = (entry >> 16, (entry >> 8) & 0xFF)
+                value = (self.read(obj) or (0, 4))[0]
+                data += (value & ((1 << bits) - 1)).to_bytes(bits // 8, "little")
+            frames.append((num, cob_id & 0x7FF, data))
+        return frames
+
+    def update_rpdo_ids(self):
+        self.rpdo_ids = {}
+        for num in range(4):
+            cob_id = self.od.get((KincoObject.RPDO_COMM + num, 1))
+            if cob_id is not None and not cob_id & 0x80000000:
+                self.rpdo_ids.setdefault(cob_id & 0x7FF, []).append(num)
+
+    def receive_rpdo(self, num: int, data: bytes):
+        if self.nmt_state != NMT_OPERATIONAL:
+            return
+        # 传输类型0~0xF0为同步: 等SYNC再生效
+        if self.od.get((KincoObject.RPDO_COMM + num, 2), 0xFF) <= 0xF0:
+            self.rpdo_pending[num] = data
+        else:
+            self.apply_rpdo(num, data)
+
+    def apply_rpdo(self, num: int, data: bytes):
+        offset = 0
+        for i in range(1, self.od.get((KincoObject.RPDO_MAP + num, 0), 0) + 1):
+            entry = self.od[(KincoObject.RPDO_MAP + num, i)]
+            size = (entry & 0xFF) // 8
+            obj = (entry >> 16, (entry >> 8) & 0xFF)
+            self.write(obj, int.from_bytes(data[offset:offset + size], "little"), size)
+            offset += size
+
+    def sync(self):
+        if self.nmt_state != NMT_OPERATIONAL:
+            return
+        # 按RPDO编号顺序生效: RPDO1的目标先写, RPDO2的控制字后写
+        pending, self.rpdo_pending = self.rpdo_pending, {}
+        for num in sorted(pending):
+            self.apply_rpdo(num, pending[num])
+
+
+class KincoSimulator:
+    def __init__(self, channel: str = "vcan0", interface: str = "socketcan",
+                 node_ids: Iterable[int] = (1,), latency: float = 0.0, jitter: float = 0.0,
+                 drop_rate: float = 0.0, abort_rate: float = 0.0, tick: float = 0.001):
+        '''
+        latency/jitter: SDO应答延时和随机抖动, 单位秒
+        drop_rate:      SDO请求不应答的概率
+        abort_rate:     SDO请求回0x80中止的概率
+        tick:           运动仿真步长, 单位秒
+        '''
+        self.channel = channel
+        self.interface = interface
+        self.nodes = {node_id: KincoSimNode(node_id) for node_id in node_ids}
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.abort_rate = abort_rate
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.bus: Optional[can.Bus] = None
+        self._notifier: Optional[can.Notifier] = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._delayed: List[Tuple[float, int, int, bytes]] = []
+        self._seq = 0
+
+    def start(self):
+        self.bus = can.Bus(interface=self.interface, channel=self.channel, receive_own_messages=False)
+        self._notifier = can.Notifier(self.bus, [self._on_message], timeout=0.05)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="kinco-sim", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        if self._notifier is not None:
+            self._notifier.stop()
+        if self.bus is not None:
+            self.bus.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def inject_fault(self, node_id: int, code: int = 0x0001):
+        '''让节点进入故障并发EMCY(0x80+id)'''
+        with self.lock:
+            self.nodes[node_id].inject_fault(code)
+        self._send(0x80 + node_id, bytes([code & 0xFF, (code >> 8) & 0xFF, 0x01, 0, 0, 0, 0, 0]))
+
+    def silence(self, node_id: int, silent: bool = True):
+        '''模拟节点掉线(断线/掉电), silent=False恢复'''
+        with self.lock:
+            self.nodes[node_id].silent = silent
+
+    # ------------------------- 收发 ------------------------
+    def _send(self, can_id: int, data: bytes):
+        try:
+            self.bus.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=False))
+        except can.CanError as e:
+            logging.error(f"仿真器发送失败: {e}")
+
+    def _reply(self, can_id: int, data: bytes):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay <= 0:
+            self._send(can_id, data)
+            return
+        with self.lock:
+            self._seq += 1
+            heapq.heappush(self._delayed, (time.monotonic() + delay, self._seq, can_id, data))
+
+    def _on_message(self, msg: can.Message):
+        can_id = msg.arbitration_id
+        if can_id == 0x000 and len(msg.data) >= 2:
+            self._on_nmt(msg.data[0], msg.data[1])
+            return
+        if can_id == SYNC_COB_ID:
+            with self.lock:
+                for node in self.nodes.values():
+                    node.sync()
+            return
+        if self._on_rpdo(can_id, bytes(msg.data)):
+            return
+        node = self.nodes.get(can_id - 0x600)
+        if node is None or node.silent or len(msg.data) < 8:
+            return
+        if self.drop_rate and random.random() < self.drop_rate:
+            return
+
+        cmd, index, sub, value, size = sdo_codec.decode_request(msg.data)
+        key = (index, sub)
+        if self.abort_rate and random.random() < self.abort_rate:
+            self._reply(0x580 + node.node_id, sdo_codec.encode_abort(index, sub, ABORT_GENERAL))
+            return
+        # 锁里只生成帧, 出锁后再发: _reply有延时时也要拿self.lock
+        emcy = None
+        with self.lock:
+            if cmd == sdo_codec.UPLOAD_REQUEST:
+                result = node.read(key)
+                response = (sdo_codec.encode_abort(index, sub, ABORT_NO_OBJECT) if result is None
+                            else sdo_codec.encode_upload_response(index, sub, *result))
+            elif size is not None:
+                had_fault = node.fault
+                abort = node.write(key, value, size)
+                if key == HEARTBEAT_TIME:
+                    node.heartbeat_due = time.monotonic()
+                if had_fault and not node.fault:
+                    # 故障清除: 错误码0的EMCY
+                    emcy = bytes(8)
+                response = (sdo_codec.encode_download_ack(index, sub) if abort is None
+                            else sdo_codec.encode_abort(index, sub, abort))
+            else:
+                response = sdo_codec.encode_abort(index, sub, ABORT_GENERAL)
+        if emcy is not None:
+            self._reply(0x80 + node.node_id, emcy)
+        self._reply(0x580 + node.node_id, response)
+
+    def _on_rpdo(self, can_id: int, data: bytes) -> bool:
+        '''return: 是否有节点把这一帧当作RPDO处理(组播COB-ID可能对应多个节点)'''
+        handled = False
+        with self.lock:
+            for node in self.nodes.values():
+                for num in node.rpdo_ids.get(can_id, ()):
+                    node.receive_rpdo(num, data)
+                    handled = True
+        return handled
+
+    def _on_nmt(self, command: int, node_id: int):
+        bootups = []
+        with self.lock:
+            for node in self.nodes.values():
+                if node_id in (0, node.node_id) and not node.silent:
+                    node.nmt_state = NMT_OPERATIONAL if command == 0x01 else NMT_PRE_OPERATIONAL
+                    if command in (0x81, 0x82):
+                        # 复位节点/复位通讯: 发boot-up
+                        bootups.append(0x700 + node.node_id)
+        for can_id in bootups:
+            self._send(can_id, bytes([0x00]))
+
+    # ------------------------- 仿真线程 ------------------------
+    def _run(self):
+        next_tick = time.monotonic()
+        while self._running:
+            now = time.monotonic()
+            frames = []
+            with self.lock:
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, can_id, data = heapq.heappop(self._delayed)
+                    frames.append((can_id, data))
+                if now >= next_tick:
+                    next_tick += self.tick
+                    for node in self.nodes.values():
+                        node.step(self.tick)
+                        frames.extend(self._periodic(node, now))
+                wake = next_tick if not self._delayed else min(next_tick, self._delayed[0][0])
+            for can_id, data in frames:
+                self._send(can_id, data)
+            time.sleep(max(wake - time.monotonic(), 0))
+
+    def _periodic(self, node: KincoSimNode, now: float):
+        frames = []
+        if node.silent:
+            return frames
+        heartbeat_ms = node.od.get(HEARTBEAT_TIME, 0)
+        if heartbeat_ms and now >= node.heartbeat_due:
+            node.heartbeat_due = now + heartbeat_ms / 1000
+            frames.append((0x700 + node.node_id, bytes([node.nmt_state])))
+        if node.nmt_state != NMT_OPERATIONAL:
+            return frames
+        for num, cob_id, data in node.tpdos():
+            # 传输类型0xFF: 事件定时器到了, 或者数据变化且过了禁止时间(单位100us)就发
+            timer_ms = node.od.get((KincoObject.TPDO_COMM + num, 5), 0) or 10
+            inhibit = node.od.get((KincoObject.TPDO_COMM + num, 3), 0) / 10000
+            last_data, last_sent = node.pdo_last.get(num, (None, 0.0))
+            if now >= node.pdo_due.get(num, 0.0) or (data != last_data and now >= last_sent + inhibit):
+                node.pdo_due[num] = now + timer_ms / 1000
+                node.pdo_last[num] = (data, now)
+                frames.append((cob_id, data))
+        return frames
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2:
+        print("使用方法: python3 kinco_sim.py vcan0 [节点ID ...]")
+        sys.exit(1)
+    ids = [int(arg, 0) for arg in sys.argv[2:]] or [1]
+    with KincoSimulator(channel=sys.argv[1], node_ids=ids):
+        logging.info(f"Kinco仿真器运行中: {sys.argv[1]} 节点{ids}, Ctrl+C退出")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
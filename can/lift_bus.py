@@ -0,0 +1,137 @@
+import copy
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+from socketcan import SocketCAN
+from nmx_lift_can_device import NmxLiftCanDevice, CanConfig
+
+'''
+一条CAN总线上挂多台升降电机时使用:
+    所有节点共用一个SocketCAN(一个socket, 一个接收线程)
+    每个节点同时最多一个SDO在途, 不同节点的SDO并行, 操作8台电机约等于1次往返
+'''
+
+
+class LiftBusManager:
+    def __init__(self, config, node_ids: Iterable[int] = ()):
+        '''
+        config:   CanConfig, 使用其中的channel/bitrate, id字段被node_ids替代
+        node_ids: 总线上的节点ID
+        '''
+        self.config = config
+        self.can_bus = SocketCAN(channel=config.channel, bitrate=config.bitrate, is_fd=False,
+                                 interface=getattr(config, "interface", "socketcan"))
+        self.devices: Dict[int, NmxLiftCanDevice] = {}
+        self._node_ids = list(node_ids)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._workers = 0
+
+    def Open(self) -> bool:
+        if not self.can_bus.connect():
+            logging.error(f"打开CAN总线失败: {self.config.channel}")
+            return False
+        for node_id in self._node_ids:
+            self.add_node(node_id)
+        return True
+
+    def Close(self):
+        for device in self.devices.values():
+            device.Close()
+        self.devices.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._workers = 0
+        self.can_bus.disconnect()
+
+    def add_node(self, node_id: int) -> NmxLiftCanDevice:
+        node_config = copy.copy(self.config)
+        node_config.id = node_id
+        device = NmxLiftCanDevice(node_config, can_bus=self.can_bus)
+        self.devices[node_id] = device
+        if node_id not in self._node_ids:
+            self._node_ids.append(node_id)
+        self._ensure_workers()
+        return device
+
+    def _ensure_workers(self):
+        # 线程数跟着节点数走, 保证每个节点都能同时有一个SDO在途
+        if self._workers >= len(self.devices):
+            return
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._workers = len(self.devices)
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="lift-sdo")
+
+    def remove_node(self, node_id: int):
+        device = self.devices.pop(node_id, None)
+        if node_id in self._node_ids:
+            self._node_ids.remove(node_id)
+        if device is not None:
+            device.Close()
+
+    def run(self, fn: Callable[..., object], *args) -> Future:
+        '''在总线的工作线程里执行fn(*args), 不等结果'''
+        if self._executor is None:
+            raise RuntimeError("LiftBusManager没有节点或已关闭")
+        return self._executor.submit(fn, *args)
+
+    def run_on_nodes(self, fn: Callable[[NmxLiftCanDevice], object], node_ids: Optional[Iterable[int]] = None) -> dict:
+        '''对每个节点并行执行fn, 所有节点返回后再返回 {node_id: 结果}, 失败的节点为None'''
+        ids = list(self.devices) if node_ids is None else list(node_ids)
+        futures = {node_id: self.run(fn, self.devices[node_id]) for node_id in ids}
+        results = {}
+        for node_id, future in futures.items():
+            try:
+                results[node_id] = future.result()
+            except Exception as e:
+                logging.error(f"节点{node_id}操作失败: {e}")
+                results[node_id] = None
+        return results
+
+    # ------------------------- 批量接口 ------------------------
+    def read_positions(self, node_ids=None) -> Dict[int, int]:
+        '''return: {node_id: 实际位置(inc)}'''
+        return self.run_on_nodes(lambda device: device.motor.get_now_position(), node_ids)
+
+    def read_heights(self, node_ids=None) -> Dict[int, float]:
+        '''return: {node_id: 高度(m)}'''
+        return self.run_on_nodes(lambda device: device.get_height(), node_ids)
+
+    def read_status(self, node_ids=None) -> Dict[int, dict]:
+        return self.run_on_nodes(lambda device: device.get_status(), node_ids)
+
+    def set_heights(self, heights: Dict[int, float], speed: Optional[float] = None, start: bool = True):
+        '''
+        heights: {node_id: 目标高度(m)}
+        speed:   速度(m/s), None时不修改
+        start:   写完目标后是否立即开始运动
+        '''
+        def move(device):
+            if speed is not None:
+                device.set_speed(speed)
+            device.set_height(heights[device.node_id])
+            if start:
+                device.go()
+        self.run_on_nodes(move, heights.keys())
+
+    def go(self, node_ids=None):
+        self.run_on_nodes(lambda device: device.go(), node_ids)
+
+    def stop(self, node_ids=None):
+        self.run_on_nodes(lambda device: device.stop(), node_ids)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    manager = LiftBusManager(CanConfig(), node_ids=[0x01, 0x02])
+    if not manager.Open():
+        exit(1)
+
+    try:
+        manager.set_heights({0x01: 0.2, 0x02: 0.2}, speed=0.0465)
+        logging.info(f"heights={manager.read_heights()}")
+    finally:
+        manager.Close()
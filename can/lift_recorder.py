@@ -0,0 +1,149 @@
+import mmap
+import struct
+import threading
+from typing import Optional
+
+from nmx_lift_can_device import KincoCanController, INC_PER_M, RPM_PER_MPS, RPM_PER_DEC
+
+'''
+升降电机高频遥测记录(调运动曲线用)
+
+    挂在TPDO遥测上(KincoCanController.enable_pdo_telemetry), 每收到一帧TPDO1记一条:
+        t(monotonic秒) position(inc) speed(DEC) current(原始值) status_word
+    记录写进预分配的环形缓冲区, 每条记录只做一次struct.pack_into, 不新建列表/字典,
+    也不产生额外的总线通讯
+    指定path时缓冲区是内存映射文件, 进程退出后用 load_recording(path) 直接读成NumPy数组
+
+文件格式(小端):
+    头 24字节: magic(8s) capacity(Q) count(Q)   count为累计写入条数, 超过capacity后循环覆盖
+    记录 20字节 * capacity
+'''
+
+MAGIC = b"KINCOREC"
+HEADER = struct.Struct("<8sQQ")
+COUNT = struct.Struct("<Q")
+COUNT_OFFSET = 16
+RECORD = struct.Struct("<diihH")
+RECORD_FIELDS = [("t", "<f8"), ("position", "<i4"), ("speed", "<i4"), ("current", "<i2"), ("status_word", "<u2")]
+
+
+class LiftRecorder:
+    def __init__(self, controller: KincoCanController, capacity: int = 200000, path: Optional[str] = None):
+        '''
+        capacity: 环形缓冲区条数, 默认200000条(500Hz约6分半)
+        path:     内存映射文件路径, None时只在内存里
+        '''
+        if controller.telemetry is None:
+            raise RuntimeError("LiftRecorder需要先开启PDO遥测(enable_pdo_telemetry)")
+        self.controller = controller
+        # 控制器Close后telemetry会被清掉, 这里留一份引用, stop/close仍能退订
+        self.telemetry = controller.telemetry
+        self.capacity = capacity
+        self.path = path
+        self.count = 0
+        # 只和close互斥, 防止接收线程写到已经关闭的mmap
+        self._lock = threading.Lock()
+        size = HEADER.size + RECORD.size * capacity
+        if path is None:
+            self._file = None
+            self._buf = bytearray(size)
+        else:
+            self._file = open(path, "w+b")
+            self._file.truncate(size)
+            self._buf = mmap.mmap(self._file.fileno(), size)
+        HEADER.pack_into(self._buf, 0, MAGIC, capacity, 0)
+        self._values = self.telemetry.raw_values()
+
+    def start(self):
+        self.telemetry.add_listener(self._on_pdo)
+
+    def stop(self):
+        self.telemetry.remove_listener(self._on_pdo)
+        if self._file is not None:
+            self._buf.flush()
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            if self._file is not None:
+                self._buf.close()
+                self._file.close()
+                self._file = None
+                self._buf = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _on_pdo(self, source):
+        # 接收线程里调用, 热路径: 不分配容器, 时间戳直接用TPDO1的接收时刻
+        if source != "tpdo1":
+            return
+        values = self._values
+        position, stamp = values["position"]
+        speed = values["speed"][0]
+        current = values["current"][0] or 0
+        status_word = values["status_word"][0] or 0
+        with self._lock:
+            buf = self._buf
+            if buf is None:
+                return
+            count = self.count
+            RECORD.pack_into(buf, HEADER.size + RECORD.size * (count % self.capacity),
+                             stamp, position, speed, current, status_word)
+            self.count = count + 1
+            COUNT.pack_into(buf, COUNT_OFFSET, count + 1)
+
+    # ------------------------- 读出 ------------------------
+    def samples(self):
+        '''return: 按时间顺序的NumPy结构化数组(拷贝); 记录文件close后从文件读'''
+        import numpy as np
+        if self._buf is None:
+            return load_recording(self.path)
+        records = np.frombuffer(self._buf, dtype=record_dtype(), count=self.capacity, offset=HEADER.size)
+        return _ordered(records, self.capacity, self.count).copy()
+
+    def to_si(self):
+        return to_si(self.samples())
+
+
+def record_dtype():
+    import numpy as np
+    return np.dtype(RECORD_FIELDS)
+
+
+def _ordered(records, capacity: int, count: int):
+    import numpy as np
+    if count <= capacity:
+        return records[:count]
+    head = count % capacity
+    return np.concatenate((records[head:], records[:head]))
+
+
+def load_recording(path: str):
+    '''读记录文件, return: 按时间顺序的NumPy结构化数组'''
+    import numpy as np
+    with open(path, "rb") as f:
+        magic, capacity, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"不是LiftRecorder文件: {path}")
+    records = np.memmap(path, dtype=record_dtype(), mode="r", offset=HEADER.size, shape=(capacity,))
+    return _ordered(records, capacity, count)
+
+
+def to_si(records) -> dict:
+    '''原始单位 -> t(s, 从第一条开始), height(m), speed(m/s), 向量化计算'''
+    t = records["t"]
+    return {
+        "t": t - t[0] if len(t) else t,
+        "height": records["position"] / INC_PER_M,
+        "speed": records["speed"] * (RPM_PER_DEC / RPM_PER_MPS),
+        "current": records["current"],
+        "status_word": records["status_word"],
+    }
@@ -0,0 +1,198 @@
+import logging
+import queue
+import threading
+import time
+from typing import Iterable, Optional
+
+from nmx_lift_can_device import KincoCanController, CanConfig, NmxLiftCanDevice, SYNC_COB_ID, INC_PER_M
+from txn_stats import LatencyHistogram, OK
+
+'''
+周期同步位置模式(CSP)的设定点流, 用于平滑的连续轨迹
+
+    位置模式(0x6060=1)每次运动是一段点到点的梯形; 这里按固定周期(1~10ms)发送设定点,
+    每个周期: RPDO3(目标位置) + SYNC, 驱动器在SYNC时取新设定点并在周期内插补
+
+    streamer = PositionStreamer(device.motor, period=0.004)
+    streamer.start(heights)                  # heights: 可迭代对象/生成器/NumPy数组, 单位m
+    streamer.wait()
+    streamer.stats()
+
+    或者由调用方逐个推:
+        streamer.start()
+        streamer.push(height)                # 队列满时阻塞(背压), 生产者自然按周期节奏走
+        streamer.finish()
+
+调度用time.monotonic()的绝对截止时刻(第k个周期 = 起点 + k*周期), 不累积误差:
+    先sleep到截止前spin秒, 再忙等到截止时刻
+    晚到超过一个周期的周期直接跳过(计入missed), 不补发, 避免一串设定点挤在一起
+    到截止时刻队列为空(生产者跟不上)时重发上一个设定点, 电机保持不动, 计入underruns
+总线上其他节点配置的同步RPDO也会在这里的SYNC上生效
+'''
+
+
+class PositionStreamer:
+    def __init__(self, controller: KincoCanController, period: float = 0.004,
+                 queue_size: int = 32, spin: float = 0.0005):
+        '''
+        period:     设定点周期, 单位秒, 1~10ms, 按整ms写入驱动器插补周期
+        queue_size: 设定点队列长度, 也就是生产者最多能领先多少个周期
+        spin:       截止前改为忙等的时间, 单位秒, 0时只用sleep
+        '''
+        period_ms = round(period * 1000)
+        if not 1 <= period_ms <= 10:
+            raise ValueError(f"周期必须在1~10ms之间: {period}")
+        self.controller = controller
+        self.period = period_ms / 1000
+        self.spin = spin
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._ended = threading.Event()
+        self._done = threading.Event()
+        self._running = False
+        self._sender: Optional[threading.Thread] = None
+        self._feeder: Optional[threading.Thread] = None
+        self._last: Optional[int] = None
+        # 统计
+        self.jitter = LatencyHistogram()
+        self.jitter_max = 0.0
+        self.cycles = 0
+        self.missed = 0
+        self.underruns = 0
+        self.send_errors = 0
+
+    def start(self, setpoints: Optional[Iterable[float]] = None):
+        '''
+        切到CSP模式并开始按周期发送
+        setpoints: 高度序列(m), None时由调用方push/finish
+        '''
+        if not self.controller.enable_cyclic_position(round(self.period * 1000)):
+            raise RuntimeError("切换周期同步位置模式失败")
+        # 队列空时保持当前位置, 不会跳
+        self._last = self.controller.get_now_position()
+        self._running = True
+        self._sender = threading.Thread(target=self._run, name=f"lift{self.controller.node_id}-stream",
+                                        daemon=True)
+        self._sender.start()
+        if setpoints is not None:
+            self._feeder = threading.Thread(target=self._feed, args=(setpoints,),
+                                            name=f"lift{self.controller.node_id}-feed", daemon=True)
+            self._feeder.start()
+
+    def push(self, height: float, timeout: Optional[float] = None) -> bool:
+        '''
+        追加一个设定点(m), 队列满时阻塞到有空位(背压)
+        return: timeout内没有空位或已停止时False
+        '''
+        pos = round(height * INC_PER_M)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._running:
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+            if wait <= 0:
+                return False
+            try:
+                self._queue.put(pos, timeout=wait)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def finish(self):
+        '''不再有新设定点, 队列发完后结束'''
+        self._ended.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        '''阻塞到所有设定点发完, return: 超时False'''
+        return self._done.wait(timeout)
+
+    def stop(self):
+        '''立即停止发送, 驱动器保持最后一个设定点'''
+        self._running = False
+        for thread in (self._feeder, self._sender):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        self._feeder = self._sender = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self) -> dict:
+        '''抖动分位数按直方图桶上界估计, 不超过实测最大值'''
+        return {"cycles": self.cycles, "missed": self.missed, "underruns": self.underruns,
+                "send_errors": self.send_errors, "queue_depth": self._queue.qsize(),
+                "jitter_p50_ms": min(self.jitter.quantile(0.5), self.jitter_max) * 1000,
+                "jitter_p99_ms": min(self.jitter.quantile(0.99), self.jitter_max) * 1000,
+                "jitter_max_ms": self.jitter_max * 1000}
+
+    # ------------------------- 线程 ------------------------
+    def _feed(self, setpoints: Iterable[float]):
+        try:
+            for height in setpoints:
+                if not self.push(height):
+                    return
+        except Exception as e:
+            logging.error(f"节点{self.controller.node_id}设定点生成失败: {e}")
+        finally:
+            self.finish()
+
+    def _sleep_until(self, deadline: float):
+        remaining = deadline - time.monotonic() - self.spin
+        if remaining > 0:
+            time.sleep(remaining)
+        while time.monotonic() < deadline:
+            pass
+
+    def _run(self):
+        period = self.period
+        can_bus = self.controller.kinco_motor
+        deadline = time.monotonic() + period
+        try:
+            while self._running:
+                self._sleep_until(deadline)
+                late = time.monotonic() - deadline
+                if late >= period:
+                    # 错过的周期直接跳过, 从当前所在的周期继续
+                    skipped = int(late // period)
+                    self.missed += skipped
+                    deadline += skipped * period
+                    late -= skipped * period
+                try:
+                    self._last = self._queue.get_nowait()
+                except queue.Empty:
+                    if self._ended.is_set():
+                        break
+                    self.underruns += 1
+                if not (self.controller.send_setpoint(self._last) and can_bus.send_msg(SYNC_COB_ID, b"")):
+                    self.send_errors += 1
+                self.jitter.record(late, OK)
+                if late > self.jitter_max:
+                    self.jitter_max = late
+                self.cycles += 1
+                deadline += period
+        finally:
+            self._running = False
+            self._done.set()
+            stats = self.stats()
+            if stats["missed"] or stats["underruns"]:
+                logging.warning(f"节点{self.controller.node_id}设定点流: {stats}")
+
+
+if __name__ == "__main__":
+    import math
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    config = CanConfig()
+    device = NmxLiftCanDevice(config)
+    try:
+        start = device.get_height()
+        # 4ms周期, 10秒一个周期的正弦, 振幅2cm
+        trajectory = (start + 0.02 * math.sin(2 * math.pi * k * 0.004 / 10) for k in range(2500))
+        streamer = PositionStreamer(device.motor, period=0.004)
+        streamer.start(trajectory)
+        streamer.wait()
+        streamer.stop()
+        logging.info(f"stats={streamer.stats()}")
+    finally:
+        device.Close()
@@ -0,0 +1,193 @@
+import logging
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from lift_bus import LiftBusManager
+from nmx_lift_can_device import (KincoObject, CanConfig, SYNC_COB_ID, RPDO2_LAYOUT,
+                                 INC_PER_M, RPM_PER_MPS)
+
+'''
+多台升降电机同步启动(共用平台等场合)
+
+    set_heights/set_pos_speed逐个节点用SDO写控制字, 各节点的启动时刻差好几个往返
+    这里先用SDO+RPDO把目标/速度/控制字0x2F预先下发, 再用一帧触发整组:
+        trigger="sync":      RPDO为同步传输, 节点收到后先缓存, 一帧SYNC(0x080)让所有节点同时生效
+        trigger="broadcast": RPDO立即生效, 所有节点的RPDO2配同一个COB-ID, 一帧控制字0x3F启动整组
+    启动偏差在一帧的时间以内, 和节点数无关
+
+    group = SyncMoveGroup(manager)           # manager: 已Open的LiftBusManager
+    group.setup()
+    result = group.move({1: 0.2, 2: 0.2}, speed=0.05, wait=True)
+    result["start_skew"]                     # 实测启动偏差(秒), 需要PDO遥测
+
+实测偏差取各节点第一帧显示开始运动(速度非0或到位位清零)的TPDO的接收时刻,
+精度受TPDO禁止时间/事件定时器限制
+'''
+
+# RPDO2组播COB-ID: 节点0的RPDO2, 没有节点用0号, 不会和预定义连接冲突
+GROUP_COB_ID = 0x300
+TRIGGERS = ("sync", "broadcast")
+
+
+def frame_time(dlc: int, bitrate: int) -> float:
+    '''标准帧在总线上的时间(不算位填充), 单位秒'''
+    return (47 + 8 * dlc) / bitrate
+
+
+class SyncMoveGroup:
+    def __init__(self, manager: LiftBusManager, node_ids: Optional[Iterable[int]] = None,
+                 trigger: str = "sync", group_cob_id: Optional[int] = GROUP_COB_ID):
+        '''
+        node_ids:     参与同步运动的节点, None时为manager上的全部节点
+        trigger:      "sync" / "broadcast"
+        group_cob_id: 控制字组播COB-ID, sync模式可以为None(每个节点单独发一帧, 都要等SYNC才生效)
+        '''
+        if trigger not in TRIGGERS:
+            raise ValueError(f"trigger必须是{TRIGGERS}之一: {trigger}")
+        if trigger == "broadcast" and group_cob_id is None:
+            raise ValueError("broadcast模式需要group_cob_id")
+        self.manager = manager
+        self.can_bus = manager.can_bus
+        self.node_ids = list(manager.devices) if node_ids is None else list(node_ids)
+        self.trigger = trigger
+        self.group_cob_id = group_cob_id
+        self.ready = False
+
+    def setup(self):
+        '''给每个节点映射RPDO(并行SDO), 只需要做一次'''
+        sync = self.trigger == "sync"
+        results = self.manager.run_on_nodes(
+            lambda device: device.motor.enable_rpdo_setpoints(sync, self.group_cob_id), self.node_ids)
+        failed = [node_id for node_id, ok in results.items() if not ok]
+        if failed:
+            raise RuntimeError(f"节点{failed}映射RPDO失败")
+        self.ready = True
+
+    def move(self, heights: Dict[int, float], speed: float, wait: bool = False,
+             timeout: float = 30.0, start_timeout: float = 0.5) -> dict:
+        '''
+        heights:       {node_id: 目标高度(m)}, 节点必须在node_ids里
+        speed:         速度(m/s)
+        wait:          True时等所有节点到位
+        start_timeout: 等各节点开始运动(用于测启动偏差)的最长时间, 单位秒
+        Returns:
+            dict: prepare       预下发耗时(s)
+                  trigger_frames 触发用的帧数
+                  frame_time    一帧触发帧的总线时间(s), 即理论启动偏差
+                  start_times   {node_id: 相对触发帧发出时刻的启动时间(s)}, 没有PDO遥测时为空
+                  start_skew    实测启动偏差(s), 有节点没测到时为None
+                  reached       {node_id: 是否到位}, wait=False时为None
+        '''
+        if not self.ready:
+            raise RuntimeError("SyncMoveGroup需要先setup")
+        unknown = set(heights) - set(self.node_ids)
+        if unknown:
+            raise ValueError(f"节点{sorted(unknown)}不在同步组里")
+        devices = {node_id: self.manager.devices[node_id] for node_id in heights}
+
+        start = time.perf_counter()
+        preloaded = self.manager.run_on_nodes(
+            lambda device: device.motor.preload_move(heights[device.node_id] * INC_PER_M, speed * RPM_PER_MPS),
+            heights.keys())
+        prepare = time.perf_counter() - start
+        failed = [node_id for node_id, ok in preloaded.items() if not ok]
+        if failed:
+            # 控制字0x3F还没发, 不会有节点动; 同步模式下缓存的目标等下次move覆盖
+            raise RuntimeError(f"节点{failed}预下发失败, 整组不启动")
+
+        watcher = _StartWatcher(devices)
+        try:
+            frames, triggered = self._send_trigger(heights.keys())
+            start_times = watcher.wait(triggered, start_timeout)
+        finally:
+            watcher.close()
+
+        reached = None
+        if wait:
+            targets = {node_id: round(height * INC_PER_M) for node_id, height in heights.items()}
+            reached = self.manager.run_on_nodes(
+                lambda device: device.wait_target_reached(targets[device.node_id], timeout), heights.keys())
+
+        skew = (max(start_times.values()) - min(start_times.values())
+                if start_times and len(start_times) == len(devices) else None)
+        trigger_dlc = 0 if self.trigger == "sync" else RPDO2_LAYOUT.size
+        result = {"prepare": prepare, "trigger_frames": frames,
+                  "frame_time": frame_time(trigger_dlc, self.manager.config.bitrate),
+                  "start_times": start_times, "start_skew": skew, "reached": reached}
+        logging.info(f"同步运动{self.trigger}: 预下发{prepare * 1000:.1f}ms, 启动偏差{skew}")
+        return result
+
+    def _send_trigger(self, node_ids):
+        '''return: (帧数, 触发帧发出时刻monotonic)'''
+        control = RPDO2_LAYOUT.pack(0x3F)
+        if self.group_cob_id is not None:
+            control_ids = [self.group_cob_id]
+        else:
+            control_ids = [self.manager.devices[node_id].motor.rpdo_control_id for node_id in node_ids]
+        for can_id in control_ids:
+            if not self.can_bus.send_msg(can_id, control):
+                raise RuntimeError(f"发送控制字RPDO失败: {can_id:#x}")
+        if self.trigger == "broadcast":
+            return len(control_ids), time.monotonic()
+        if not self.can_bus.send_msg(SYNC_COB_ID, b""):
+            raise RuntimeError("发送SYNC失败")
+        return len(control_ids) + 1, time.monotonic()
+
+
+class _StartWatcher:
+    '''挂在各节点的TPDO遥测上, 记录每个节点第一次显示开始运动的接收时刻'''
+
+    def __init__(self, devices):
+        self.starts: Dict[int, float] = {}
+        self._done = threading.Event()
+        self._listeners = {node_id: (device.motor.telemetry, self._make_listener(node_id, device.motor.telemetry))
+                           for node_id, device in devices.items() if device.motor.telemetry is not None}
+        # 先定好要等几个节点再挂监听, 接收线程可能马上回调
+        self._expected = len(self._listeners)
+        for telemetry, listener in self._listeners.values():
+            telemetry.add_listener(listener)
+
+    def _make_listener(self, node_id, telemetry):
+        def on_pdo(source):
+            if node_id in self.starts:
+                return
+            if source == "tpdo1":
+                speed, stamp = telemetry.raw("speed")
+                started = bool(speed)
+            else:
+                status_word, stamp = telemetry.raw("status_word")
+                started = status_word is not None and not status_word & KincoObject.SW_TARGET_REACHED
+            if started:
+                self.starts[node_id] = stamp
+                if len(self.starts) >= self._expected:
+                    self._done.set()
+        return on_pdo
+
+    def wait(self, triggered: float, timeout: float) -> Dict[int, float]:
+        '''return: {node_id: 启动时刻 - triggered}'''
+        if self._expected:
+            self._done.wait(timeout)
+        return {node_id: stamp - triggered for node_id, stamp in dict(self.starts).items()}
+
+    def close(self):
+        for telemetry, listener in self._listeners.values():
+            telemetry.remove_listener(listener)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    config = CanConfig()
+    config.pdo_telemetry = True
+    manager = LiftBusManager(config, node_ids=[0x01, 0x02])
+    if not manager.Open():
+        exit(1)
+
+    try:
+        group = SyncMoveGroup(manager)
+        group.setup()
+        result = group.move({0x01: 0.2, 0x02: 0.2}, speed=0.0465, wait=True, timeout=15)
+        logging.info(f"result={result}")
+    finally:
+        manager.Close()
@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import can
+
+import sdo_codec
+from sdo_codec import SdoError
+from sdo_timing import RetryPolicy, RttEstimator
+from nmx_lift_can_device import (KincoObject, CanConfig, TargetWatch, canopen_rx_ids, combine_err_code,
+                                 dec_to_rpm, poll_intervals, INC_PER_M, RPM_PER_MPS, DEC_PER_RPM,
+                                 TARGET_WINDOW_INC, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX)
+
+'''
+NmxLiftCanDevice 的 asyncio 版本
+    总线由python-can的Notifier挂到事件循环上(socketcan走loop.add_reader), 不占线程池
+    多台电机/多个协程可以共用一个AsyncCanBus, 每个节点同时最多一个SDO在途
+    常量/单位换算/SDO编解码/到位判断都取自同步版, 这里只有I/O是异步的
+'''
+
+
+class AsyncCanBus:
+    SEND_RETRY_INTERVAL = 0.001     # 发送队列满时的重试间隔, 单位秒
+
+    def __init__(self, channel: str = "can0", bitrate: int = 1000000, interface: str = "socketcan"):
+        self.interface = interface
+        self.channel = channel
+        self.bitrate = bitrate
+        self.bus: Optional[can.Bus] = None
+        self._notifier: Optional[can.Notifier] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = None
+        self._pending: Dict[int, List[Tuple[Callable[[can.Message], bool], asyncio.Future]]] = {}
+        self._rx_ids: Counter = Counter()
+
+    async def connect(self) -> bool:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        try:
+            self.bus = can.Bus(interface=self.interface, channel=self.channel, bitrate=self.bitrate,
+                               can_filters=self._build_filters() or None)
+        except Exception as e:
+            logging.error(f"打开CAN总线失败: {self.channel} {e}")
+            return False
+        self._notifier = can.Notifier(self.bus, [self._on_message], loop=self._loop)
+        return True
+
+    async def disconnect(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+        if self.bus:
+            self.bus.shutdown()
+            self.bus = None
+
+    def _build_filters(self) -> List[dict]:
+        return [{"can_id": can_id, "can_mask": 0x7FF, "extended": False} for can_id in sorted(self._rx_ids)]
+
+    def add_rx_ids(self, can_ids: List[int]):
+        self._rx_ids.update(can_ids)
+        if self.bus:
+            self.bus.set_filters(self._build_filters() or None)
+
+    def remove_rx_ids(self, can_ids: List[int]):
+        self._rx_ids.subtract(can_ids)
+        self._rx_ids = +self._rx_ids
+        if self.bus:
+            self.bus.set_filters(self._build_filters() or None)
+
+    def _on_message(self, msg: can.Message):
+        # 有fileno的总线在事件循环里回调, 否则Notifier会用自己的线程
+        if threading.get_ident() == self._loop_thread:
+            self._dispatch(msg)
+        else:
+            self._loop.call_soon_threadsafe(self._dispatch, msg)
+
+    def _dispatch(self, msg: can.Message):
+        waiters = self._pending.get(msg.arbitration_id)
+        if not waiters:
+            return
+        for i, (match, future) in enumerate(waiters):
+            if match(msg):
+                del waiters[i]
+                if not waiters:
+                    del self._pending[msg.arbitration_id]
+                if not future.done():
+                    future.set_result(msg)
+                return
+
+    def _remove_waiter(self, resp_id: int, waiter):
+        waiters = self._pending.get(resp_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._pending[resp_id]
+
+    async def _send(self, msg: can.Message, timeout: float):
+        '''
+        不阻塞事件循环的发送: bus.send(timeout=0)只检查一次发送队列,
+        队列满(CanOperationError)时让出事件循环稍后重试, 超过timeout仍发不出去则抛出
+        '''
+        deadline = self._loop.time() + timeout
+        while True:
+            try:
+                self.bus.send(msg, timeout=0)
+                return
+            except can.CanError:
+                if self._loop.time() >= deadline:
+                    raise
+                await asyncio.sleep(self.SEND_RETRY_INTERVAL)
+
+    async def transact(self, can_id: int, data: bytes, resp_id: int,
+                       match: Optional[Callable[[can.Message], bool]] = None,
+                       timeout: float = 0.1) -> Optional[bytearray]:
+        '''和SocketCAN.transact一致: 只等待resp_id上满足match的应答, 超时返回None'''
+        if not self.bus:
+            return None
+        future = self._loop.create_future()
+        waiter = (match or (lambda msg: True), future)
+        self._pending.setdefault(resp_id, []).append(waiter)
+        try:
+            await self._send(can.Message(arbitration_id=can_id, data=data, is_extended_id=False), timeout)
+            msg = await asyncio.wait_for(future, timeout)
+        except can.CanError as e:
+            logging.error(f"CAN发送失败: {e}")
+            return None
+        except asyncio.TimeoutError:
+            logging.warning(f"等待CAN应答超时(can_id:{hex(resp_id)},超时时间:{timeout}s)")
+            return None
+        finally:
+            self._remove_waiter(resp_id, waiter)
+        return msg.data
+
+    def send_msg(self, can_id: int, data: bytes) -> bool:
+        '''发一帧不等应答, 发送队列满时直接返回False, 不阻塞事件循环'''
+        if not self.bus:
+            return False
+        try:
+            self.bus.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=False), timeout=0)
+            return True
+        except can.CanError:
+            return False
+
+
+class AsyncKincoCanController:
+    def __init__(self, id, can_bus: AsyncCanBus):
+        self.node_id = id
+        self.can_bus = can_bus
+        self.master_cob_id = 0x600 + self.node_id
+        self.slave_cob_id = 0x580 + self.node_id
+        # 每个节点同时最多一个SDO在途, 不同节点互不等待
+        self.sdo_lock = asyncio.Lock()
+        self.rtt = RttEstimator()
+        self.retry = RetryPolicy(retries=2, no_retry=KincoObject.COMMANDS)
+        self.can_bus.add_rx_ids(canopen_rx_ids(self.node_id))
+
+    async def _send_receive(self, send_data: bytes, timeout):
+        async with self.sdo_lock:
+            return await self.can_bus.transact(self.master_cob_id, send_data, self.slave_cob_id,
+                                               match=lambda msg: sdo_codec.is_reply_to(send_data, msg.data),
+                                               timeout=timeout)
+
+    # ------------------------- Service Data Object ------------------------
+    async def _transact(self, obj, request, is_write):
+        '''和同步版一样: 超时取自RttEstimator, 按RetryPolicy重发, 全部超时抛SdoTimeoutError'''
+        tries = self.retry.begin(obj, is_write, self.rtt)
+        for timeout in tries:
+            recv_data = await self._send_receive(request, timeout)
+            if recv_data:
+                return tries.succeeded(recv_data)
+        raise tries.failed()
+
+    async def sdo_read(self, obj, signed=False):
+        '''失败抛SdoTimeoutError/SdoAbortError(都是SdoError)'''
+        try:
+            rev_data = await self._transact(obj, sdo_codec.encode_upload(*obj), is_write=False)
+            return sdo_codec.decode_upload(rev_data, signed)
+        except SdoError as e:
+            logging.error(f"获取伺服数据失败: {e}")
+            raise
+
+    async def sdo_write(self, obj, value, size) -> bool:
+        '''失败抛SdoTimeoutError/SdoAbortError(都是SdoError)'''
+        try:
+            recv_data = await self._transact(obj, sdo_codec.encode_download(*obj, value, size), is_write=True)
+            sdo_codec.check_download(recv_data)
+        except SdoError as e:
+            logging.error(f"写伺服数据失败: {e}")
+            raise
+        return True
+
+    # ------------------------- 暴露 ------------------------
+    async def reset_error(self):
+        '''复位错误'''
+        await self.sdo_write(KincoObject.CONTROL_WORD, 0x86, 2)
+
+    async def quick_stop(self):
+        '''快速停止'''
+        await self.sdo_write(KincoObject.CONTROL_WORD, 0x0B, 2)
+
+    async def start_move(self):
+        '''开始以绝对位置模式运动'''
+        await self.sdo_write(KincoObject.CONTROL_WORD, 0x2F, 2)
+        await self.sdo_write(KincoObject.WORK_MODE, 0x01, 1)
+        await self.sdo_write(KincoObject.CONTROL_WORD, 0x3F, 2)
+
+    async def set_target_position(self, pos):
+        '''pos: 单位inc'''
+        return await self.sdo_write(KincoObject.POS_TARGET, round(pos), 4)
+
+    async def set_trapezoid_speed(self, speed):
+        '''speed: 单位rpm'''
+        return await self.sdo_write(KincoObject.TRAPEZOID_SPEED, round(speed * DEC_PER_RPM), 4)
+
+    async def get_now_position(self):
+        '''return: 单位:inc'''
+        return await self.sdo_read(KincoObject.POS_ACTUAL, signed=True)
+
+    async def get_now_speed(self):
+        '''return: 单位:rpm'''
+        return dec_to_rpm(await self.sdo_read(KincoObject.SPEED_ACTUAL, signed=True))
+
+    async def get_status_word(self):
+        return await self.sdo_read(KincoObject.STATUS_WORD)
+
+    async def get_err_code(self):
+        err_code1 = await self.sdo_read(KincoObject.ERROR_CODE1)
+        err_code2 = await self.sdo_read(KincoObject.ERROR_CODE2)
+        return combine_err_code(err_code1, err_code2)
+
+    def close(self):
+        self.can_bus.remove_rx_ids(canopen_rx_ids(self.node_id))
+
+
+class AsyncNmxLiftCanDevice:
+    TARGET_WINDOW_INC = TARGET_WINDOW_INC
+    POLL_INTERVAL_MIN = POLL_INTERVAL_MIN
+    POLL_INTERVAL_MAX = POLL_INTERVAL_MAX
+
+    def __init__(self, config, can_bus: Optional[AsyncCanBus] = None):
+        '''can_bus: 多台电机共用的AsyncCanBus, 为None时自己建'''
+        self.node_id = config.id
+        self.owns_bus = can_bus is None
+        self.can_bus = can_bus or AsyncCanBus(channel=config.channel, bitrate=config.bitrate,
+                                              interface=getattr(config, "interface", "socketcan"))
+        self.motor = AsyncKincoCanController(config.id, self.can_bus)
+
+    async def open(self) -> bool:
+        if self.owns_bus and not await self.can_bus.connect():
+            return False
+        # TODO 86 清除错误 (清除错误后,必须执行这个函数)
+        await self.motor.reset_error()
+        return True
+
+    async def close(self):
+        self.motor.close()
+        if self.owns_bus:
+            await self.can_bus.disconnect()
+
+    async def go(self):
+        """开始升降机构运动"""
+        await self.motor.start_move()
+
+    async def stop(self):
+        """停止升降机构运动"""
+        await self.motor.quick_stop()
+
+    async def get_status(self) -> dict:
+        # 同一节点的SDO仍然排队, gather让调用方不必关心顺序
+        speed, height, err = await asyncio.gather(self.get_speed(), self.get_height(), self.motor.get_err_code())
+        logging.info(f"speed={speed}m/s,height={height}m,err={err}")
+        return {"speed": speed, "height": height, "err": err}
+
+    async def get_speed(self) -> float:
+        """单位m/s"""
+        rpm = await self.motor.get_now_speed()
+        return rpm / RPM_PER_MPS
+
+    async def set_speed(self, speed: float):
+        """speed: 单位m/s"""
+        await self.motor.set_trapezoid_speed(speed*RPM_PER_MPS)
+
+    async def get_height(self) -> float:
+        """单位m"""
+        pos = await self.motor.get_now_position()
+        return pos / INC_PER_M
+
+    async def set_height(self, height: float, wait: bool = False, timeout: float = 30.0) -> bool:
+        """
+        height: 目标高度，单位m
+        wait: True时开始运动并等到位, 等待期间不阻塞事件循环
+        """
+        target = round(height*INC_PER_M)
+        await self.motor.set_target_position(target)
+        if not wait:
+            return True
+        await self.go()
+        return await self.wait_target_reached(target, timeout)
+
+    async def wait_target_reached(self, target: Optional[int] = None, timeout: float = 30.0) -> bool:
+        """等待状态字位置到达(bit10)
+        判断规则见TargetWatch, 和同步版共用
+        """
+        watch = TargetWatch(target, self.TARGET_WINDOW_INC)
+        intervals = poll_intervals(self.POLL_INTERVAL_MIN, self.POLL_INTERVAL_MAX)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                hit = watch.check(await self.motor.get_status_word())
+                if hit is None:
+                    hit = watch.check_position(await self.motor.get_now_position())
+                if watch.fault:
+                    logging.error(f"节点{self.node_id}运动中故障")
+                    return False
+                if hit:
+                    return True
+            except SdoError as e:
+                # 偶尔一次读失败不影响等待, 下一轮再查
+                logging.warning(f"节点{self.node_id}查询到位状态失败: {e}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"节点{self.node_id}等待到位超时({timeout}s)")
+                return False
+            await asyncio.sleep(min(next(intervals), remaining))
+
+
+async def _main():
+    config = CanConfig()
+    can_bus = AsyncCanBus(channel=config.channel, bitrate=config.bitrate)
+    lifts = []
+    for node_id in (0x01, 0x02):
+        node_config = CanConfig()
+        node_config.id = node_id
+        lifts.append(AsyncNmxLiftCanDevice(node_config, can_bus))
+    if not await can_bus.connect():
+        return
+    try:
+        await asyncio.gather(*(lift.open() for lift in lifts))
+        await asyncio.gather(*(lift.set_speed(0.0465) for lift in lifts))
+        await asyncio.gather(*(lift.set_height(0.2, wait=True, timeout=15) for lift in lifts))
+        await asyncio.gather(*(lift.get_status() for lift in lifts))
+    finally:
+        for lift in lifts:
+            await lift.close()
+        await can_bus.disconnect()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(_main())
@@ -1,105 +1,465 @@
 import logging
+import struct
+import threading
 import time
-import ctypes
 
-from typing import List
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Tuple
 
+import sdo_codec
+import txn_stats
+from sdo_codec import SdoAbortError, SdoError, SdoTimeoutError
+from sdo_timing import RetryPolicy, RttEstimator
 from socketcan import SocketCAN
 
 #第三代升降电机
 #位置  inc(0 -> 4571136) == mm(0 -> 465) --->  (1mm == 9830.4inc)
 #速度  1mm/s = 9.0009rpm  -> (1m/s = 1000mm/s = 9000.9rpm)
+INC_PER_M = 9830400
+RPM_PER_MPS = 9000.9
+DEC_PER_RPM = 512 * 65536 / 1875    # DEC=[(RPM*512*编码器分辨率)/1875]
+RPM_PER_DEC = 0.00005588
 
 class KincoObject:
+    '''对象字典条目: (index, subindex)'''
     ''' ---------------------- ControlWord --------------------- '''
-    CONTROL_WORD = [0x40, 0x60, 0x00]
+    CONTROL_WORD = (0x6040, 0x00)
     ''' ---------------------- Status Word --------------------- '''
-    STATUS_WORD = [0x41, 0x60, 0x00]
+    STATUS_WORD = (0x6041, 0x00)
     ''' ----------------------- Work Mode ---------------------- '''
-    WORK_MODE = [0x60, 0x60, 0x00]
+    WORK_MODE = (0x6060, 0x00)
     ''' ------------------------- Basic ------------------------ '''
-    POS_ACTUAL = [0x63, 0x60, 0x00]         # 实际位置
-    POS_TARGET = [0x7A, 0x60, 0x00]         # 目标位置
-    SPEED_ACTUAL = [0x6C, 0x60, 0x00]       # 实际速度
-    SPEED_TARGET = [0xFF, 0x60, 0x00]       # 目标速度
-    CURRENT_ACTUAL = [0x78, 0x60, 0x00]     # 实际电流
-    CURRENT_TARGET = [0xF6, 0x60, 0x08]     # 目标电流
+    POS_ACTUAL = (0x6063, 0x00)             # 实际位置
+    POS_TARGET = (0x607A, 0x00)             # 目标位置
+    TRAPEZOID_SPEED = (0x6081, 0x00)        # 梯形速度
+    SPEED_ACTUAL = (0x606C, 0x00)           # 实际速度
+    SPEED_TARGET = (0x60FF, 0x00)           # 目标速度
+    CURRENT_ACTUAL = (0x6078, 0x00)         # 实际电流
+    CURRENT_TARGET = (0x60F6, 0x08)         # 目标电流
     ''' ------------------------- Limit ------------------------ '''
-    CURRENT_LIMIT = [0x60, 0x73, 0x00]      # 目标电流限制
-    POS_SOFT_LIMIT = [0x60, 0x7D, 0x01]     # 软限位正设置
-    NEG_SOFT_LIMIT = [0x60, 0x7D, 0x02]     # 软限位负设置
-    SPEED_LIMIT = [0x60, 0x80, 0x00]        # 最大速度限制
+    CURRENT_LIMIT = (0x6073, 0x00)          # 目标电流限制
+    POS_SOFT_LIMIT = (0x607D, 0x01)         # 软限位正设置
+    NEG_SOFT_LIMIT = (0x607D, 0x02)         # 软限位负设置
+    SPEED_LIMIT = (0x6080, 0x00)            # 最大速度限制
+    ''' ------------------------ 插补/周期 ----------------------- '''
+    INTERP_PERIOD = (0x60C2, 0x01)          # 插补周期数值
+    INTERP_PERIOD_INDEX = (0x60C2, 0x02)    # 插补周期单位 10^index 秒
     ''' ------------------------- Error ------------------------ '''
-    ERROR_CODE1 = [0x01, 0x26, 0x00]
-    ERROR_CODE2 = [0x02, 0x26, 0x00]
+    ERROR_CODE1 = (0x2601, 0x00)
+    ERROR_CODE2 = (0x2602, 0x00)
+    ''' --------------------- Status Word位 -------------------- '''
+    SW_FAULT = 0x0008                       # bit3 故障
+    SW_TARGET_REACHED = 0x0400              # bit10 位置到达
+    ''' ----------------------- 命令类对象 ---------------------- '''
+    # 写入即是动作(上升沿/复位), 不能因为值相同跳过
+    COMMANDS = frozenset([CONTROL_WORD])
+    ''' -------------------------- PDO ------------------------- '''
+    TPDO_COMM = 0x1800                      # TPDO通讯参数(0x1800+n)
+    TPDO_MAP = 0x1A00                       # TPDO映射参数(0x1A00+n)
+    RPDO_COMM = 0x1400                      # RPDO通讯参数(0x1400+n)
+    RPDO_MAP = 0x1600                       # RPDO映射参数(0x1600+n)
+    ''' ------------------------- 监视 ------------------------- '''
+    HEARTBEAT_TIME = (0x1017, 0x00)         # 心跳生产者周期, 单位ms
+
+
+SYNC_COB_ID = 0x080
+
+
+# TPDO1: 实际位置 + 实际速度,  TPDO2: 状态字 + 错误码1 + 错误码2 + 实际电流
+TPDO1_LAYOUT = struct.Struct("<ii")
+TPDO2_LAYOUT = struct.Struct("<HHHh")
+# RPDO1: 目标位置 + 梯形速度,  RPDO2: 控制字
+RPDO1_LAYOUT = struct.Struct("<iI")
+RPDO2_LAYOUT = struct.Struct("<H")
+# RPDO3: 周期同步位置模式的目标位置
+RPDO3_LAYOUT = struct.Struct("<i")
+# EMCY: 紧急错误码 + 错误寄存器 + 厂家数据
+EMCY_LAYOUT = struct.Struct("<HB5s")
+NMT_BOOTUP = 0x00
+
+
+def canopen_rx_ids(node_id: int) -> List[int]:
+    '''主站需要接收的该节点COB-ID: EMCY, TPDO1~4, SDO应答, 心跳'''
+    return [0x80 + node_id, 0x180 + node_id, 0x280 + node_id, 0x380 + node_id,
+            0x480 + node_id, 0x580 + node_id, 0x700 + node_id]
+
+
+def pdo_map_entry(obj: Tuple[int, int], bits: int) -> int:
+    '''KincoObject -> PDO映射值(index<<16 | sub<<8 | bits)'''
+    return (obj[0] << 16) | (obj[1] << 8) | bits
+
+
+# ------------------- 同步版/asyncio版共用, 不做I/O -------------------
+TARGET_WINDOW_INC = 4915        # 到位判断允许的位置误差 0.5mm
+POLL_INTERVAL_MIN = 0.002       # 非PDO模式等待到位时的轮询间隔, 从小到大自适应
+POLL_INTERVAL_MAX = 0.05
+
+
+def combine_err_code(err_code1: int, err_code2: int) -> int:
+    '''错误码1/2合成一个值, 0就是没有错误'''
+    return (err_code2 << 16) | err_code1
+
+
+def dec_to_rpm(dec: int) -> float:
+    '''实际速度(DEC) -> rpm'''
+    return dec * RPM_PER_DEC
+
+
+def poll_intervals(first: float = POLL_INTERVAL_MIN, last: float = POLL_INTERVAL_MAX):
+    '''轮询间隔: 从first开始每次×1.5, 最大last'''
+    interval = first
+    while True:
+        yield interval
+        interval = min(interval * 1.5, last)
+
+
+class TargetWatch:
+    '''
+    到位判断的状态机, 只看传进来的状态字/位置
+    刚开始运动时状态字里可能还留着上一次的到位标志, 所以要么先看到过该位清零,
+    要么实际位置已经在目标附近, 才算到位
+    '''
+    def __init__(self, target: Optional[int] = None, window: int = TARGET_WINDOW_INC):
+        self.target = target
+        self.window = window
+        self.moving = False
+        self.fault = False
+
+    def set_fault(self) -> bool:
+        self.fault = True
+        return True
+
+    def check(self, status_word: Optional[int]) -> Optional[bool]:
+        '''True: 结束(到位或故障, 看fault), False: 还没到, None: 需要再用check_position确认'''
+        if status_word is None:
+            return False
+        if status_word & KincoObject.SW_FAULT:
+            return self.set_fault()
+        if not status_word & KincoObject.SW_TARGET_REACHED:
+            self.moving = True
+            return False
+        if self.moving or self.target is None:
+            return True
+        return None
+
+    def check_position(self, position: Optional[int]) -> bool:
+        return position is not None and abs(position - self.target) <= self.window
+
+
+class KincoTelemetry:
+    '''
+    TPDO推送的状态快照,值为原始单位,每个值记录接收时刻(time.monotonic)
+    由SocketCAN的后台线程更新,读取时不产生总线通讯
+    '''
+    FIELDS = ("position", "speed", "status_word", "err_code1", "err_code2", "current")
+
+    def __init__(self):
+        self._values = {name: (None, None) for name in self.FIELDS}
+        self._changed = threading.Condition()
+        self._listeners = ()
+
+    def update(self, name, value):
+        # 整个元组一次替换,读取方不会看到值和时间戳不一致
+        self._values[name] = (value, time.monotonic())
+
+    def notify(self, source=None):
+        '''一帧PDO的值都更新完后调用, 唤醒wait_for并回调监听者, source: "tpdo1"/"tpdo2"'''
+        with self._changed:
+            self._changed.notify_all()
+        for listener in self._listeners:
+            listener(source)
+
+    def add_listener(self, listener):
+        '''listener(source)在接收线程里调用, 不能阻塞'''
+        # 元组整体替换, 接收线程遍历时不需要加锁
+        self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        self._listeners = tuple(l for l in self._listeners if l is not listener)
+
+    def raw(self, name):
+        '''return: (值, 接收时刻), 不计算age, 给高频记录用'''
+        return self._values[name]
+
+    def raw_values(self) -> Mapping[str, tuple]:
+        '''return: 只读的实时视图 {名称: (值, 接收时刻)}, 随PDO更新, 给每帧都要读多个值的记录器用'''
+        return MappingProxyType(self._values)
+
+    def wait_for(self, predicate, timeout) -> bool:
+        '''阻塞到predicate()为真(每收到一帧PDO检查一次)或超时'''
+        with self._changed:
+            return bool(self._changed.wait_for(predicate, timeout))
+
+    def get(self, name):
+        '''return: (值, 距上次更新的秒数),还没收到过PDO时为(None, None)'''
+        value, stamp = self._values[name]
+        if stamp is None:
+            return None, None
+        return value, time.monotonic() - stamp
+
+    def snapshot(self) -> dict:
+        return {name: self.get(name) for name in self.FIELDS}
+
+class KincoNodeMonitor:
+    '''
+    EMCY(0x80+id)和心跳(0x700+id)监视, 由SocketCAN的接收线程更新, 不产生SDO
+    心跳超时由一个看门狗线程判断, 超过 心跳周期*tolerance 没收到心跳即认为掉线
+    listener(event, monitor) 在接收线程或看门狗线程里调用, 不能阻塞, 事件:
+        "emcy"               收到故障EMCY(fault变为True)
+        "emcy_reset"         收到错误码0的EMCY(故障已清除)
+        "bootup"             节点重启(心跳帧状态0), 之前写的参数/PDO映射都不在了
+        "nmt"                NMT状态变化
+        "heartbeat_lost"     心跳超时
+        "heartbeat_restored" 掉线后重新收到心跳
+    '''
+    NMT_STATES = {0x00: "boot-up", 0x04: "stopped", 0x05: "operational", 0x7F: "pre-operational"}
+
+    def __init__(self, node_id, heartbeat_ms, tolerance=1.5):
+        self.node_id = node_id
+        self.timeout = heartbeat_ms * tolerance / 1000
+        self.fault = False
+        self.emcy_code = 0
+        self.error_register = 0
+        self.emcy_data = b""
+        self.emcy_stamp = None
+        self.emcy_count = 0
+        self.nmt_state = None
+        self.last_heartbeat = None
+        self.alive = False
+        self._listeners = ()
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name=f"kinco{self.node_id}-heartbeat", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def add_listener(self, listener):
+        # 元组整体替换, 接收线程遍历时不需要加锁
+        self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        self._listeners = tuple(l for l in self._listeners if l is not listener)
+
+    def _fire(self, event):
+        for listener in self._listeners:
+            try:
+                listener(event, self)
+            except Exception:
+                logging.exception(f"节点{self.node_id}监视回调异常: {event}")
+
+    def on_emcy(self, msg):
+        code, register, data = EMCY_LAYOUT.unpack_from(bytes(msg.data).ljust(EMCY_LAYOUT.size, b"\0"))
+        self.emcy_code = code
+        self.error_register = register
+        self.emcy_data = data
+        self.emcy_stamp = time.monotonic()
+        if code == 0:
+            self.fault = False
+            self._fire("emcy_reset")
+        else:
+            self.fault = True
+            self.emcy_count += 1
+            logging.error(f"节点{self.node_id} EMCY: code={code:#06x} reg={register:#04x} data={data.hex()}")
+            self._fire("emcy")
+
+    def on_heartbeat(self, msg):
+        state = msg.data[0] & 0x7F if msg.data else None
+        self.last_heartbeat = time.monotonic()
+        if not self.alive:
+            self.alive = True
+            self._fire("heartbeat_restored")
+        if state == self.nmt_state:
+            return
+        self.nmt_state = state
+        if state == NMT_BOOTUP:
+            self.fault = False
+            self._fire("bootup")
+        else:
+            self._fire("nmt")
+
+    def _watch(self):
+        while not self._stop.is_set():
+            last = self.last_heartbeat
+            if last is None:
+                self._stop.wait(self.timeout)
+                continue
+            remaining = last + self.timeout - time.monotonic()
+            if remaining > 0:
+                self._stop.wait(remaining)
+                continue
+            if self.alive:
+                self.alive = False
+                logging.error(f"节点{self.node_id}心跳超时({self.timeout}s)")
+                self._fire("heartbeat_lost")
+            self._stop.wait(self.timeout)
+
+    def state(self) -> dict:
+        age = None if self.last_heartbeat is None else time.monotonic() - self.last_heartbeat
+        return {"alive": self.alive, "heartbeat_age": age,
+                "nmt_state": self.NMT_STATES.get(self.nmt_state, self.nmt_state),
+                "fault": self.fault, "emcy_code": self.emcy_code, "error_register": self.error_register,
+                "emcy_count": self.emcy_count}
+
 
 class KincoCanController:
-    def __init__(self, channel, id, bitrate):
-        self.kinco_motor = SocketCAN(channel=channel, bitrate=bitrate, is_fd=False)
+    def __init__(self, channel, id, bitrate, can_bus=None, interface="socketcan"):
+        '''can_bus: 多个节点共用的SocketCAN(见lift_bus.LiftBusManager),为None时自己建'''
+        self.owns_bus = can_bus is None
+        self.kinco_motor = can_bus or SocketCAN(channel=channel, bitrate=bitrate, is_fd=False, interface=interface)
+        # SDO服务端同一时刻只处理一个请求, 每个节点最多一个SDO在途
+        self.sdo_lock = threading.Lock()
 
         self.node_id = id
         self.master_cob_id = 0x600 + self.node_id 
         self.slave_cob_id = 0x580 + self.node_id
+        self.telemetry = None
+        # enable_node_monitor之后才有
+        self.monitor: Optional[KincoNodeMonitor] = None
+        # enable_rpdo_setpoints之后才有
+        self.rpdo_setpoint_id = None
+        self.rpdo_control_id = None
+        # enable_cyclic_position之后才有
+        self.rpdo_stream_id = None
+        # 每个对象最后一次写成功的值, 值相同的写直接跳过
+        self.od_shadow = {}
+        self.sdo_writes_saved = 0
+        # 事务统计插件(txn_stats.TxnStats或任何带on_transaction的对象), 为空时不计时
+        self.instruments = ()
+        # 超时按该节点实测往返时间自适应; 读和幂等写超时重试, 控制字不重试
+        self.rtt = RttEstimator()
+        self.retry = RetryPolicy(retries=2, no_retry=KincoObject.COMMANDS)
+        # enable_pdo_telemetry/enable_node_monitor订阅的COB-ID, Close时退订
+        self.subscriptions = []
+        # 共用总线时在connect前登记, 独占总线时connect会带上过滤; Close时撤销, Open时重新登记
+        self.rx_registered = False
+        self.__register_rx()
+
+    def __register_rx(self):
+        if not self.rx_registered:
+            self.kinco_motor.add_rx_ids(canopen_rx_ids(self.node_id))
+            self.rx_registered = True
+
+    def __subscribe(self, can_id, callback):
+        self.kinco_motor.subscribe(can_id, callback)
+        self.subscriptions.append(can_id)
         
-    def __kinco_send_receive(self, send_data, timeout=0.1):
-
-        self.kinco_motor.send_msg(can_id = self.master_cob_id, 
-                                  data = send_data,
-                                  is_extended_id=False
-                                )
-        return_data = self.kinco_motor.recv_msg(timeout)
+    def __kinco_send_receive(self, send_data: bytes, timeout):
+        # SDO应答回显index/subindex, 只接受0x580+id上同一对象的应答
+        with self.sdo_lock:
+            return_data = self.kinco_motor.transact(can_id = self.master_cob_id,
+                                                    data = send_data,
+                                                    resp_id = self.slave_cob_id,
+                                                    match = lambda msg: sdo_codec.is_reply_to(send_data, msg.data),
+                                                    timeout = timeout
+                                                )
         return return_data
     
+    def add_instrument(self, instrument):
+        self.instruments = self.instruments + (instrument,)
+
+    def remove_instrument(self, instrument):
+        self.instruments = tuple(i for i in self.instruments if i is not instrument)
+
+    def __record(self, obj, start, outcome):
+        seconds = time.perf_counter() - start
+        for instrument in self.instruments:
+            instrument.on_transaction(self.node_id, obj[0], seconds, outcome)
+
+    @staticmethod
+    def __error_outcome(e):
+        if isinstance(e, SdoTimeoutError):
+            return txn_stats.TIMEOUT
+        return txn_stats.ABORT if isinstance(e, SdoAbortError) else txn_stats.ERROR
+
     # ------------------------- Service Data Object ------------------------
-    def __sdo_read(self, Data1_3: list[int]) -> list:
-        Data0 = [0x40]
-        Data4_7 = [0x00, 0x00, 0x00, 0x00]
-        rev_data = self.__kinco_send_receive(send_data = Data0 + Data1_3 + Data4_7)
-        logging.debug(f"__sdo_read rev_data:{rev_data}")
-        
-        dec_list = [int(b, 16) for b in rev_data]
-        if not dec_list:
-            logging.error("获取伺服数据失败:__sdo_read返回空")
-            return None
-        logging.debug(f"__sdo_read dec_data:{dec_list}")
-
-        if   dec_list[0] == 0x4F: 
-            Data = dec_list[4]
-        elif dec_list[0] == 0x4B: 
-            Data = dec_list[4] + dec_list[5]*256
-        elif dec_list[0] == 0x43: 
-            Data = dec_list[4] + dec_list[5]*256 + dec_list[6]*65536 + dec_list[7]*16777216
-        elif dec_list[0] == 0x80:
-            err_code = dec_list[4] + dec_list[5]*256 + dec_list[6]*65536 + dec_list[7]*16777216
-            logging.error(f"communication err = {err_code}")
-        else:
-            logging.error("Accept errors")
-            return -1
-        return Data
-
-    def __sdo_write(self, write_len, Data1_3, Data4_7):
-        if   write_len == 1: Data0 = [0x2F]
-        elif write_len == 2: Data0 = [0x2B]
-        elif write_len == 4: Data0 = [0x23]
-        else:
-            logging.error(f"Write_len err={write_len}")
-            return -1
-        
-        recv_data = self.__kinco_send_receive(send_data = Data0 + Data1_3 + Data4_7)
-        # 这里要判断发送是否成功
-        logging.debug(f"recv_data:{recv_data}")
+    def __transact(self, obj, request, is_write):
+        '''按RetryPolicy重发, 超时取自RttEstimator, 全部超时抛SdoTimeoutError'''
+        tries = self.retry.begin(obj, is_write, self.rtt)
+        for timeout in tries:
+            recv_data = self.__kinco_send_receive(request, timeout)
+            if recv_data:
+                return tries.succeeded(recv_data)
+        raise tries.failed()
+
+    def __sdo_read(self, obj, signed=False):
+        '''
+        obj: KincoObject条目, signed: 按有符号数解析
+        失败抛SdoTimeoutError/SdoAbortError(都是SdoError)
+        '''
+        start = time.perf_counter() if self.instruments else 0.0
+        try:
+            rev_data = self.__transact(obj, sdo_codec.encode_upload(*obj), is_write=False)
+            logging.debug(f"__sdo_read rev_data:{rev_data}")
+            value = sdo_codec.decode_upload(rev_data, signed)
+        except SdoError as e:
+            logging.error(f"获取伺服数据失败: {e}")
+            if not isinstance(e, SdoTimeoutError):
+                self.invalidate_shadow()
+            if self.instruments:
+                self.__record(obj, start, self.__error_outcome(e))
+            raise
+        if self.instruments:
+            self.__record(obj, start, txn_stats.OK)
+        return value
+
+    def __sdo_write(self, obj, value, size):
+        '''
+        obj: KincoObject条目, size: 1/2/4字节
+        失败抛SdoTimeoutError/SdoAbortError(都是SdoError)
+        '''
+        shadowed = obj not in KincoObject.COMMANDS
+        if shadowed and self.od_shadow.get(obj) == value:
+            self.sdo_writes_saved += 1
+            return True
+
+        start = time.perf_counter() if self.instruments else 0.0
+        try:
+            recv_data = self.__transact(obj, sdo_codec.encode_download(*obj, value, size), is_write=True)
+            logging.debug(f"recv_data:{recv_data}")
+            sdo_codec.check_download(recv_data)
+        except SdoError as e:
+            logging.error(f"写伺服数据失败: {e}")
+            if isinstance(e, SdoTimeoutError):
+                # 不知道从站有没有收到, 下次必须重写
+                self.od_shadow.pop(obj, None)
+            else:
+                self.invalidate_shadow()
+            if self.instruments:
+                self.__record(obj, start, self.__error_outcome(e))
+            raise
+        if self.instruments:
+            self.__record(obj, start, txn_stats.OK)
+        if shadowed:
+            self.od_shadow[obj] = value
+        return True
+
+    def invalidate_shadow(self):
+        '''清空写缓存, 之后的写都会真正发到总线上'''
+        self.od_shadow.clear()
 
     def __set_position_mode(self):
-        sdo_data = [0x01, 0x00, 0x00, 0x00]
-        return self.__sdo_write(write_len=1, Data1_3=KincoObject.WORK_MODE, Data4_7=sdo_data)
+        return self.__sdo_write(KincoObject.WORK_MODE, 0x01, 1)
     
     def __set_control_word(self, Num):
-        sdo_data = [Num, 0x00, 0x00, 0x00]
-        return self.__sdo_write(write_len=2, Data1_3=KincoObject.CONTROL_WORD, Data4_7=sdo_data)
+        return self.__sdo_write(KincoObject.CONTROL_WORD, Num, 2)
     # ------------------------- 暴露 ------------------------
     def reset_error(self):
         '''复位错误'''
+        # 故障复位后驱动器内部状态可能变化, 不再信任缓存
+        self.invalidate_shadow()
         self.__set_control_word(0x86)
+        if self.monitor is not None:
+            # 复位后驱动器会发错误码0的EMCY; 故障还在的话会再报
+            self.monitor.fault = False
 
     def quick_stop(self):
         '''快速停止'''
@@ -113,35 +473,24 @@ class KincoCanController:
     
     def set_target_position(self, pos):
         '''pos: 单位inc'''
-        pos_int = round(pos)
-        pos_bytes = pos_int.to_bytes(4, byteorder="little", signed=True)
-        sdo_data = list(pos_bytes)
-        Data1 = [0x7A, 0x60, 0x00]
-        return self.__sdo_write(write_len=4, Data1_3=Data1, Data4_7=sdo_data)
+        return self.__sdo_write(KincoObject.POS_TARGET, round(pos), 4)
     
     def set_trapezoid_speed(self, speed):
         '''speed: 单位rpm'''
-        pos_speed = (speed * 512 * 65536) / 1875
-        speed_int = round(pos_speed)
-        speed_bytes = speed_int.to_bytes(4, byteorder="little", signed=True)
-        sdo_data = list(speed_bytes)
-        Data1 = [0x81, 0x60, 0x00]
-        return self.__sdo_write(write_len=4, Data1_3=Data1, Data4_7=sdo_data)
+        pos_speed = speed * DEC_PER_RPM
+        return self.__sdo_write(KincoObject.TRAPEZOID_SPEED, round(pos_speed), 4)
 
     def get_now_position(self):
         '''return: 单位:inc'''
-        INC_uint32 = self.__sdo_read(KincoObject.POS_ACTUAL)
-        INC_int32 = ctypes.c_int32(INC_uint32).value
+        INC_int32 = self.__sdo_read(KincoObject.POS_ACTUAL, signed=True)
         logging.debug(f"DEC_int32={INC_int32}")
         return INC_int32
     
     def get_now_speed(self):
         '''return: 单位:rpm''' 
-        DEC_uint32 = self.__sdo_read(KincoObject.SPEED_ACTUAL)
-        DEC_int32 = ctypes.c_int32(DEC_uint32).value
+        DEC_int32 = self.__sdo_read(KincoObject.SPEED_ACTUAL, signed=True)
         logging.debug(f"DEC_int32={DEC_int32}")
-        RPM = DEC_int32 * 0.00005588  # DEC=[(RPM*512*编码器分辨率)/1875]
-        return RPM
+        return dec_to_rpm(DEC_int32)
 
     def get_err_code(self):
         '''参考手册编写错误一一对应提醒,如果是0x00 ,0x00就是没有错误'''
@@ -149,13 +498,184 @@ class KincoCanController:
         err_code2 = self.__sdo_read(KincoObject.ERROR_CODE2)
         logging.debug(f"Err_Code1={err_code1}")
         logging.debug(f"Err_Code1={err_code2}")
-        return ((err_code2 << 16) | err_code1)
+        return combine_err_code(err_code1, err_code2)
+
+    def get_status_word(self):
+        return self.__sdo_read(KincoObject.STATUS_WORD)
     
+    # ------------------------- Process Data Object ------------------------
+    def __map_tpdo(self, num, entries, event_timer_ms, inhibit_ms):
+        '''
+        按CiA301流程映射TPDO: 关闭PDO -> 写传输参数 -> 清空映射 -> 写映射 -> 重新使能
+        entries: [(KincoObject, bits), ...]
+        '''
+        comm = KincoObject.TPDO_COMM + num
+        mapping = KincoObject.TPDO_MAP + num
+        cob_id = 0x180 + 0x100 * num + self.node_id
+
+        self.__sdo_write((comm, 1), cob_id | 0x80000000, 4)
+        self.__sdo_write((comm, 2), 0xFF, 1)                # 异步,事件/定时器触发
+        self.__sdo_write((comm, 3), inhibit_ms * 10, 2)     # 单位100us
+        self.__sdo_write((comm, 5), event_timer_ms, 2)
+        self.__sdo_write((mapping, 0), 0, 1)
+        for i, (obj, bits) in enumerate(entries, start=1):
+            self.__sdo_write((mapping, i), pdo_map_entry(obj, bits), 4)
+        self.__sdo_write((mapping, 0), len(entries), 1)
+        self.__sdo_write((comm, 1), cob_id, 4)
+        return cob_id
+
+    def __map_rpdo(self, num, entries, cob_id, trans_type):
+        '''和__map_tpdo同样的流程, RPDO只需要COB-ID和传输类型'''
+        comm = KincoObject.RPDO_COMM + num
+        mapping = KincoObject.RPDO_MAP + num
+
+        self.__sdo_write((comm, 1), cob_id | 0x80000000, 4)
+        self.__sdo_write((comm, 2), trans_type, 1)
+        self.__sdo_write((mapping, 0), 0, 1)
+        for i, (obj, bits) in enumerate(entries, start=1):
+            self.__sdo_write((mapping, i), pdo_map_entry(obj, bits), 4)
+        self.__sdo_write((mapping, 0), len(entries), 1)
+        self.__sdo_write((comm, 1), cob_id, 4)
+
+    def __on_tpdo1(self, msg):
+        position, speed = TPDO1_LAYOUT.unpack_from(msg.data)
+        self.telemetry.update("position", position)
+        self.telemetry.update("speed", speed)
+        self.telemetry.notify("tpdo1")
+
+    def __on_tpdo2(self, msg):
+        status_word, err_code1, err_code2, current = TPDO2_LAYOUT.unpack_from(msg.data)
+        self.telemetry.update("status_word", status_word)
+        self.telemetry.update("err_code1", err_code1)
+        self.telemetry.update("err_code2", err_code2)
+        self.telemetry.update("current", current)
+        self.telemetry.notify("tpdo2")
+
+    def enable_pdo_telemetry(self, event_timer_ms=10, inhibit_ms=1, configure=True):
+        '''
+        把实际位置/实际速度映射到TPDO1, 状态字/错误码/实际电流映射到TPDO2, 然后NMT启动节点
+        之后telemetry由后台线程更新,读状态不再走SDO
+        event_timer_ms: 值不变时的周期上报间隔, inhibit_ms: 两帧之间的最小间隔
+        configure:      False时不改驱动器配置, 只按默认COB-ID订阅(回放录制文件时用)
+        '''
+        tpdo1, tpdo2 = 0x180 + self.node_id, 0x280 + self.node_id
+        if configure:
+            tpdo1 = self.__map_tpdo(0, [(KincoObject.POS_ACTUAL, 32), (KincoObject.SPEED_ACTUAL, 32)],
+                                    event_timer_ms, inhibit_ms)
+            tpdo2 = self.__map_tpdo(1, [(KincoObject.STATUS_WORD, 16), (KincoObject.ERROR_CODE1, 16),
+                                        (KincoObject.ERROR_CODE2, 16), (KincoObject.CURRENT_ACTUAL, 16)],
+                                    event_timer_ms, inhibit_ms)
+        self.telemetry = KincoTelemetry()
+        self.__subscribe(tpdo1, self.__on_tpdo1)
+        self.__subscribe(tpdo2, self.__on_tpdo2)
+        if configure:
+            # NMT Start Remote Node, 只有operational状态才发PDO
+            self.kinco_motor.send_msg(can_id=0x000, data=[0x01, self.node_id])
+
+    def enable_rpdo_setpoints(self, sync=True, group_cob_id=None) -> bool:
+        '''
+        RPDO1映射目标位置+梯形速度, RPDO2映射控制字, 给多台电机同步启动用(见lift_sync.py)
+        sync=True:    传输类型1, 收到的RPDO先缓存, 下一帧SYNC时才生效, 所有节点同一时刻动作
+        sync=False:   传输类型0xFF, 收到立即生效
+        group_cob_id: RPDO2的COB-ID, 多个节点配成同一个时一帧控制字就能发给整组, None时用0x300+id
+        '''
+        self.rpdo_setpoint_id = 0x200 + self.node_id
+        self.rpdo_control_id = group_cob_id or (0x300 + self.node_id)
+        trans_type = 0x01 if sync else 0xFF
+        self.__map_rpdo(0, [(KincoObject.POS_TARGET, 32), (KincoObject.TRAPEZOID_SPEED, 32)],
+                        self.rpdo_setpoint_id, trans_type)
+        self.__map_rpdo(1, [(KincoObject.CONTROL_WORD, 16)], self.rpdo_control_id, trans_type)
+        # NMT Start Remote Node, 只有operational状态才处理PDO
+        return self.kinco_motor.send_msg(can_id=0x000, data=[0x01, self.node_id])
+
+    def preload_move(self, pos, speed) -> bool:
+        '''
+        同步运动的准备: 控制字0x2F(给之后的0x3F准备上升沿), 切位置模式, 目标和速度经RPDO1发出
+        需要先enable_rpdo_setpoints; 启动由调用方发控制字0x3F(RPDO2)和SYNC
+        pos: 单位inc, speed: 单位rpm
+        '''
+        if self.rpdo_setpoint_id is None:
+            raise RuntimeError("preload_move需要先enable_rpdo_setpoints")
+        self.__set_control_word(0x2F)
+        self.__set_position_mode()
+        # RPDO直接改对象字典, 写缓存里的旧值不再可信
+        self.od_shadow.pop(KincoObject.POS_TARGET, None)
+        self.od_shadow.pop(KincoObject.TRAPEZOID_SPEED, None)
+        return self.kinco_motor.send_msg(self.rpdo_setpoint_id,
+                                         RPDO1_LAYOUT.pack(round(pos), round(speed * DEC_PER_RPM)))
+
+    def enable_cyclic_position(self, period_ms: int) -> bool:
+        '''
+        周期同步位置模式(CSP, 0x6060=8): 目标位置经RPDO3(同步传输)每周期下发, 每帧SYNC生效一次
+        驱动器按插补周期在相邻两个设定点之间插补, 设定点由lift_stream.PositionStreamer按固定周期发送
+        切换前0x607A和RPDO3里的设定点都先设成当前位置, 否则驱动器一进CSP就会在一个周期内跳过去
+        period_ms: 插补周期, 单位ms
+        '''
+        self.rpdo_stream_id = 0x400 + self.node_id
+        self.__map_rpdo(2, [(KincoObject.POS_TARGET, 32)], self.rpdo_stream_id, 0x01)
+        self.__sdo_write(KincoObject.INTERP_PERIOD, period_ms, 1)
+        self.__sdo_write(KincoObject.INTERP_PERIOD_INDEX, 0xFD, 1)     # -3: 单位ms
+        position = self.__sdo_read(KincoObject.POS_ACTUAL, signed=True)
+        self.__sdo_write(KincoObject.POS_TARGET, position, 4)
+        # NMT Start Remote Node, 只有operational状态才处理PDO; 先进operational再预置RPDO3
+        if not self.kinco_motor.send_msg(can_id=0x000, data=[0x01, self.node_id]):
+            return False
+        if not self.send_setpoint(position):
+            return False
+        self.__sdo_write(KincoObject.WORK_MODE, 0x08, 1)
+        self.__set_control_word(0x0F)
+        # 之后目标位置由RPDO改写
+        self.od_shadow.pop(KincoObject.POS_TARGET, None)
+        return True
+
+    def send_setpoint(self, pos) -> bool:
+        '''CSP模式下发一个设定点(不等应答, 下一帧SYNC生效), pos: 单位inc'''
+        return self.kinco_motor.send_msg(self.rpdo_stream_id, RPDO3_LAYOUT.pack(round(pos)))
+
+    # ------------------------- EMCY/心跳 ------------------------
+    def enable_node_monitor(self, heartbeat_ms=100, tolerance=1.5, configure=True) -> KincoNodeMonitor:
+        '''
+        订阅EMCY和心跳, 并把驱动器的心跳周期(0x1017)设为heartbeat_ms
+        之后故障和掉线由monitor推送(monitor.add_listener), 不用再轮询get_err_code
+        tolerance: 超过 heartbeat_ms*tolerance 没收到心跳算掉线
+        configure: False时不写0x1017, 只订阅(回放录制文件时用)
+        '''
+        monitor = KincoNodeMonitor(self.node_id, heartbeat_ms, tolerance)
+        monitor.add_listener(self.__on_monitor_event)
+        self.__subscribe(0x80 + self.node_id, monitor.on_emcy)
+        self.__subscribe(0x700 + self.node_id, monitor.on_heartbeat)
+        if configure:
+            self.__sdo_write(KincoObject.HEARTBEAT_TIME, heartbeat_ms, 2)
+        monitor.start()
+        self.monitor = monitor
+        return monitor
+
+    def __on_monitor_event(self, event, monitor):
+        if event == "bootup":
+            # 驱动器重启过, 对象字典回到了默认值
+            logging.warning(f"节点{self.node_id}重启")
+            self.invalidate_shadow()
+
     def Open(self):
-        self.kinco_motor.connect()
+        self.invalidate_shadow()
+        self.__register_rx()
+        if self.owns_bus:
+            self.kinco_motor.connect()
 
     def Close(self):
-        self.kinco_motor.disconnect()
+        '''撤销过滤登记并退订TPDO/EMCY/心跳; 重新Open后需要再enable_pdo_telemetry/enable_node_monitor'''
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+        for can_id in self.subscriptions:
+            self.kinco_motor.unsubscribe(can_id)
+        self.subscriptions.clear()
+        self.telemetry = None
+        if self.rx_registered:
+            self.kinco_motor.remove_rx_ids(canopen_rx_ids(self.node_id))
+            self.rx_registered = False
+        if self.owns_bus:
+            self.kinco_motor.disconnect()
     
     def set_pos_speed(self, pos, speed):
         '''
@@ -171,14 +691,31 @@ class KincoCanController:
 
 
 class NmxLiftCanDevice:#(nmxrdk.LiftDevice)
-    def __init__(self, config):
-        self.motor = KincoCanController(config.channel, config.id, config.bitrate)
+    TARGET_WINDOW_INC = TARGET_WINDOW_INC
+    POLL_INTERVAL_MIN = POLL_INTERVAL_MIN
+    POLL_INTERVAL_MAX = POLL_INTERVAL_MAX
+
+    def __init__(self, config, can_bus=None):
+        self.node_id = config.id
+        self._move_executor: Optional[ThreadPoolExecutor] = None
+        self.motor = KincoCanController(config.channel, config.id, config.bitrate, can_bus,
+                                        getattr(config, "interface", "socketcan"))
         self.motor.Open()
         self.init(config)
 
     def init(self, config):
         # TODO 86 清除错误 (清除错误后,必须执行这个函数)
         self.motor.reset_error()
+        if getattr(config, "pdo_telemetry", False):
+            self.motor.enable_pdo_telemetry()
+        if getattr(config, "heartbeat_ms", 0):
+            self.motor.enable_node_monitor(config.heartbeat_ms)
+
+    def _cached(self, name):
+        '''PDO模式下从快照取值,未开启或还没收到PDO时返回None'''
+        if self.motor.telemetry is None:
+            return None
+        return self.motor.telemetry.get(name)[0]
 
     # def up(self, speed: float = 30, duration: float = 0.5):
     #     pass
@@ -195,40 +732,145 @@ class NmxLiftCanDevice:#(nmxrdk.LiftDevice)
         self.motor.quick_stop()
 
     def get_status(self):
-        speed = self.get_speed()
-        height = self.get_height()
-        code = self.motor.get_err_code()
-        logging.info(f"speed={speed}m/s,height={height}m,err={code}")
+        """获取速度/高度/错误码
+        Returns:
+            dict: PDO模式下额外带各值的age(距上次更新的秒数)
+        """
+        if self.motor.telemetry is not None:
+            snap = self.motor.telemetry.snapshot()
+            err1, err_age = snap["err_code1"]
+            err2, _ = snap["err_code2"]
+            status = {
+                "speed": self.get_speed(), "speed_age": snap["speed"][1],
+                "height": self.get_height(), "height_age": snap["position"][1],
+                "status_word": snap["status_word"][0], "status_word_age": snap["status_word"][1],
+                "err": None if err1 is None else combine_err_code(err1, err2), "err_age": err_age,
+            }
+        else:
+            status = {"speed": self.get_speed(), "height": self.get_height(), "err": self._err_code()}
+        monitor = self.motor.monitor
+        if monitor is not None:
+            status.update(alive=monitor.alive, nmt_state=monitor.NMT_STATES.get(monitor.nmt_state, monitor.nmt_state),
+                          emcy_code=monitor.emcy_code)
+        logging.info(f"speed={status['speed']}m/s,height={status['height']}m,err={status['err']}")
+        return status
+
+    def _err_code(self):
+        '''有EMCY监视时只在报过故障后才读错误码, 平时不占总线'''
+        monitor = self.motor.monitor
+        if monitor is not None and not monitor.fault:
+            return 0
+        return self.motor.get_err_code()
 
     def get_speed(self) -> float:
         """获取升降机构当前速度
         Returns:
             float: 当前速度，单位m/s
         """
-        return (self.motor.get_now_speed() / 9000.9)
+        raw = self._cached("speed")
+        if raw is not None:
+            return (dec_to_rpm(raw) / RPM_PER_MPS)
+        return (self.motor.get_now_speed() / RPM_PER_MPS)
 
     def set_speed(self, speed: float):
         """设置升降机构速度
         Args:
             speed: 速度，单位m/s
         """
-        self.motor.set_trapezoid_speed(speed*9000.9)
+        self.motor.set_trapezoid_speed(speed*RPM_PER_MPS)
 
     def get_height(self) -> List[float]:
         """获取升降机构当前高度
         Returns:
             float: 当前高度，单位m
         """
-        return (self.motor.get_now_position() / 9830400)
+        raw = self._cached("position")
+        if raw is not None:
+            return (raw / INC_PER_M)
+        return (self.motor.get_now_position() / INC_PER_M)
 
-    def set_height(self, height: float):
+    def set_height(self, height: float, wait: bool = False, timeout: float = 30.0) -> bool:
         """设置升降机构高度
         Args:
             height: 目标高度，单位m
+            wait: True时写完目标立即开始运动(相当于再调go), 并阻塞到到位
+            timeout: wait=True时最长等待时间，单位秒
+        Returns:
+            bool: wait=True时是否在超时前到位
+        """
+        target = round(height*INC_PER_M)
+        self.motor.set_target_position(target)
+        if not wait:
+            return True
+        self.go()
+        return self.wait_target_reached(target, timeout)
+
+    def set_height_future(self, height: float, timeout: float = 30.0) -> Future:
+        """set_height(wait=True)的非阻塞版本, 返回Future[bool]
+        asyncio中可以用 await asyncio.wrap_future(...)
         """
-        self.motor.set_target_position(height*9830400)
+        if self._move_executor is None:
+            self._move_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"lift{self.node_id}-move")
+        return self._move_executor.submit(self.set_height, height, True, timeout)
+
+    def wait_target_reached(self, target: Optional[int] = None, timeout: float = 30.0) -> bool:
+        """等待状态字位置到达(bit10)
+        刚开始运动时状态字里可能还留着上一次的到位标志, 所以要么先看到过该位清零,
+        要么实际位置已经在目标附近, 才算到位
+        Args:
+            target: 目标位置，单位inc, None时只看状态字
+            timeout: 最长等待时间，单位秒
+        Returns:
+            bool: 到位True, 超时或驱动器故障False
+        """
+        watch = TargetWatch(target, self.TARGET_WINDOW_INC)
+
+        monitor = self.motor.monitor
+
+        def reached(status_word, read_position):
+            if monitor is not None and monitor.fault:
+                return watch.set_fault()
+            hit = watch.check(status_word)
+            if hit is None:
+                hit = watch.check_position(read_position())
+            return hit
+
+        telemetry = self.motor.telemetry
+        if telemetry is not None:
+            # PDO模式: 每收到一帧TPDO检查一次, 不额外占用总线
+            done = telemetry.wait_for(lambda: reached(telemetry.get("status_word")[0],
+                                                      lambda: telemetry.get("position")[0]),
+                                      timeout)
+        else:
+            done = False
+            intervals = poll_intervals(self.POLL_INTERVAL_MIN, self.POLL_INTERVAL_MAX)
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    hit = reached(self.motor.get_status_word(), self.motor.get_now_position)
+                except SdoError as e:
+                    # 偶尔一次读失败不影响等待, 下一轮再查
+                    logging.warning(f"节点{self.node_id}查询到位状态失败: {e}")
+                    hit = False
+                if hit:
+                    done = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(next(intervals), remaining))
+
+        if watch.fault:
+            logging.error(f"节点{self.node_id}运动中故障")
+            return False
+        if not done:
+            logging.warning(f"节点{self.node_id}等待到位超时({timeout}s)")
+        return done
 
     def Close(self):
+        if self._move_executor is not None:
+            self._move_executor.shutdown(wait=False)
+            self._move_executor = None
         self.motor.Close()
 
 
@@ -238,6 +880,9 @@ class CanConfig:
         self.channel = "can1"   # CAN 通道名
         self.id = 0x01          # CAN 帧 ID
         self.bitrate = 500000   # 波特率
+        self.interface = "socketcan"  # python-can接口, 仿真时用"virtual"
+        self.pdo_telemetry = False  # True: 状态由TPDO推送,不再SDO轮询
+        self.heartbeat_ms = 0       # >0: 订阅EMCY/心跳, 故障和掉线由推送得到,不再轮询错误码
 
 
 if __name__ == "__main__":
@@ -247,12 +892,8 @@ if __name__ == "__main__":
 
     test = NmxLiftCanDevice(config)
 
-    test.set_height(0.465)  #465mm
     test.set_speed(0.0465)  #46.5mm/s
-    test.go()
-
-    test.get_status()
-    time.sleep(10)
+    test.set_height(0.465, wait=True, timeout=15)  #465mm, 到位后返回
 
     test.get_status()
 
@@ -0,0 +1,187 @@
+import argparse
+import copy
+import logging
+import statistics
+import threading
+import time
+from typing import List
+
+from kinco_sim import KincoSimulator
+from lift_bus import LiftBusManager
+from lift_sync import SyncMoveGroup
+from nmx_lift_can_device import NmxLiftCanDevice, CanConfig
+
+'''
+CAN驱动性能基准, 跑在kinco_sim仿真器上, 不需要实物
+
+    python3 sdo_bench.py                          # python-can虚拟总线
+    python3 sdo_bench.py --interface socketcan --channel vcan0
+    python3 sdo_bench.py --latency 0.0005 --jitter 0.0002 --nodes 1,2,4,8
+
+输出:
+    SDO往返时间 p50/p99/max
+    get_status() 轮询频率 (SDO模式 / PDO模式)
+    多节点批量读位置耗时 (LiftBusManager)
+    多节点启动偏差: 并行SDO写控制字 vs SYNC/组播RPDO (SyncMoveGroup), 取仿真器记录的实际启动时刻
+    故障复位: 仿真器注入故障 -> reset_error -> 收到错误码0的EMCY的耗时
+'''
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    k = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[k]
+
+
+def summarize(samples: List[float]) -> dict:
+    return {"count": len(samples),
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "max_ms": max(samples) * 1000,
+            "mean_ms": statistics.fmean(samples) * 1000}
+
+
+def bench_sdo_rtt(device: NmxLiftCanDevice, count: int) -> dict:
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        device.motor.get_now_position()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def bench_status_rate(device: NmxLiftCanDevice, duration: float) -> float:
+    '''return: get_status()每秒次数'''
+    calls = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        device.get_status()
+        calls += 1
+    return calls / duration
+
+
+def bench_fault_reset(device: NmxLiftCanDevice, sim: KincoSimulator, rounds: int, timeout: float = 1.0) -> dict:
+    '''device需要已enable_node_monitor'''
+    cleared = threading.Event()
+
+    def on_event(event, monitor):
+        if event == "emcy_reset":
+            cleared.set()
+
+    monitor = device.motor.monitor
+    monitor.add_listener(on_event)
+    try:
+        samples = []
+        for _ in range(rounds):
+            sim.inject_fault(device.node_id)
+            cleared.clear()
+            start = time.perf_counter()
+            device.motor.reset_error()
+            if not cleared.wait(timeout):
+                raise RuntimeError(f"复位后{timeout}s内没有收到故障清除EMCY")
+            samples.append(time.perf_counter() - start)
+        return summarize(samples)
+    finally:
+        monitor.remove_listener(on_event)
+
+
+def bench_multi_node(config, node_ids: List[int], rounds: int) -> dict:
+    manager = LiftBusManager(config, node_ids=node_ids)
+    if not manager.Open():
+        raise RuntimeError("打开总线失败")
+    try:
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            manager.read_positions()
+            samples.append(time.perf_counter() - start)
+        return summarize(samples)
+    finally:
+        manager.Close()
+
+
+def _sim_skew(sim: KincoSimulator, node_ids: List[int]) -> float:
+    started = [sim.nodes[node_id].move_started for node_id in node_ids]
+    return max(started) - min(started)
+
+
+def bench_start_skew(config, sim: KincoSimulator, node_ids: List[int], rounds: int) -> dict:
+    '''return: {方式: 启动偏差统计}, 每轮在0和1cm之间来回走'''
+    manager = LiftBusManager(config, node_ids=node_ids)
+    if not manager.Open():
+        raise RuntimeError("打开总线失败")
+    try:
+        result = {"sdo": []}
+        for i in range(rounds):
+            heights = {node_id: 0.01 * (i % 2 == 0) for node_id in node_ids}
+            manager.set_heights(heights, speed=0.5)
+            result["sdo"].append(_sim_skew(sim, node_ids))
+            manager.stop()
+        for trigger in ("sync", "broadcast"):
+            group = SyncMoveGroup(manager, trigger=trigger)
+            group.setup()
+            result[trigger] = []
+            for i in range(rounds):
+                group.move({node_id: 0.01 * (i % 2 == 0) for node_id in node_ids}, speed=0.5, start_timeout=0)
+                result[trigger].append(_sim_skew(sim, node_ids))
+                manager.stop()
+        return {name: summarize(samples) for name, samples in result.items()}
+    finally:
+        manager.Close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kinco CAN驱动基准(仿真器)")
+    parser.add_argument("--interface", default="virtual")
+    parser.add_argument("--channel", default="kinco-bench")
+    parser.add_argument("--count", type=int, default=2000, help="SDO往返测试次数")
+    parser.add_argument("--duration", type=float, default=2.0, help="状态轮询测试时长(秒)")
+    parser.add_argument("--nodes", default="1,2,4,8", help="多节点测试的节点数")
+    parser.add_argument("--rounds", type=int, default=200, help="多节点批量读次数")
+    parser.add_argument("--latency", type=float, default=0.0, help="仿真器应答延时(秒)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="仿真器应答抖动(秒)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    node_counts = [int(n) for n in args.nodes.split(",")]
+    node_ids = list(range(1, max(node_counts + [1]) + 1))
+
+    config = CanConfig()
+    config.interface = args.interface
+    config.channel = args.channel
+
+    with KincoSimulator(channel=args.channel, interface=args.interface, node_ids=node_ids,
+                        latency=args.latency, jitter=args.jitter) as sim:
+        device = NmxLiftCanDevice(config)
+        try:
+            print(f"SDO往返:            {bench_sdo_rtt(device, args.count)}")
+            print(f"get_status(SDO):    {bench_status_rate(device, args.duration):.0f} 次/秒")
+        finally:
+            device.Close()
+
+        pdo_config = copy.copy(config)
+        pdo_config.pdo_telemetry = True
+        device = NmxLiftCanDevice(pdo_config)
+        try:
+            time.sleep(0.05)    # 等第一帧TPDO
+            print(f"get_status(PDO):    {bench_status_rate(device, args.duration):.0f} 次/秒")
+        finally:
+            device.Close()
+
+        monitor_config = copy.copy(config)
+        monitor_config.heartbeat_ms = 100
+        device = NmxLiftCanDevice(monitor_config)
+        try:
+            print(f"故障复位:           {bench_fault_reset(device, sim, min(args.rounds, 50))}")
+        finally:
+            device.Close()
+
+        for n in node_counts:
+            print(f"{n}节点批量读位置:  {bench_multi_node(config, node_ids[:n], args.rounds)}")
+
+        for name, stats in bench_start_skew(config, sim, node_ids, min(args.rounds, 50)).items():
+            print(f"{len(node_ids)}节点启动偏差({name}): {stats}")
+
+
+if __name__ == "__main__":
+    main()
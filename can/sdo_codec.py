@@ -0,0 +1,132 @@
+import struct
+from typing import Union
+
+'''
+CANopen SDO 快速传输(expedited)编解码, 直接操作 bytes/bytearray/memoryview
+
+    上传(读) 请求: 40 idx_l idx_h sub 00 00 00 00
+             应答: 4F/4B/43 idx_l idx_h sub data(1/2/4字节, 小端)
+    下载(写) 请求: 2F/2B/23 idx_l idx_h sub data(1/2/4字节, 小端)
+             应答: 60 idx_l idx_h sub 00 00 00 00
+    中止:          80 idx_l idx_h sub abort_code(4字节)
+'''
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+UPLOAD_REQUEST = 0x40
+DOWNLOAD_ACK = 0x60
+ABORT = 0x80
+
+# 上传应答命令字 -> 数据长度
+UPLOAD_SIZES = {0x4F: 1, 0x4B: 2, 0x47: 3, 0x43: 4}
+# 数据长度 -> 下载请求命令字
+DOWNLOAD_COMMANDS = {1: 0x2F, 2: 0x2B, 4: 0x23}
+
+_HEADER = struct.Struct("<BHB")
+_UPLOAD_REQUEST = struct.Struct("<BHB4x")
+_ABORT_CODE = struct.Struct("<4xI")
+# 下载统一用无符号格式, 负数先按位宽取补码
+_DOWNLOAD = {size: struct.Struct(fmt) for size, fmt in ((1, "<BHBB3x"), (2, "<BHBH2x"), (4, "<BHBI"))}
+# (数据长度, 是否有符号) -> 取数据的格式
+_UPLOAD_VALUE = {
+    (1, False): struct.Struct("<4xB"), (1, True): struct.Struct("<4xb"),
+    (2, False): struct.Struct("<4xH"), (2, True): struct.Struct("<4xh"),
+    (4, False): struct.Struct("<4xI"), (4, True): struct.Struct("<4xi"),
+}
+_MASKS = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF}
+
+
+class SdoError(Exception):
+    '''SDO应答不符合协议'''
+
+
+class SdoTimeoutError(SdoError):
+    '''重试后仍没有收到应答'''
+    def __init__(self, index: int, sub: int, attempts: int):
+        super().__init__(f"SDO timeout index={index:#06x} sub={sub:#04x} after {attempts} attempt(s)")
+        self.index = index
+        self.sub = sub
+        self.attempts = attempts
+
+
+class SdoAbortError(SdoError):
+    '''从站回了0x80中止帧'''
+    def __init__(self, index: int, sub: int, code: int):
+        super().__init__(f"SDO abort index={index:#06x} sub={sub:#04x} code={code:#010x}")
+        self.index = index
+        self.sub = sub
+        self.code = code
+
+
+def encode_upload(index: int, sub: int) -> bytes:
+    '''读对象 index/sub 的请求帧'''
+    return _UPLOAD_REQUEST.pack(UPLOAD_REQUEST, index, sub)
+
+
+def encode_download(index: int, sub: int, value: int, size: int) -> bytes:
+    '''写对象 index/sub 的请求帧, size: 1/2/4字节, value可以是负数'''
+    return _DOWNLOAD[size].pack(DOWNLOAD_COMMANDS[size], index, sub, value & _MASKS[size])
+
+
+def _raise_abort(data: Buffer):
+    _, index, sub = _HEADER.unpack_from(data)
+    raise SdoAbortError(index, sub, _ABORT_CODE.unpack_from(data)[0])
+
+
+def decode_upload(data: Buffer, signed: bool = False) -> int:
+    '''解析读应答, 中止帧抛SdoAbortError'''
+    cmd = data[0]
+    size = UPLOAD_SIZES.get(cmd)
+    if size is None:
+        if cmd == ABORT:
+            _raise_abort(data)
+        raise SdoError(f"unexpected SDO upload response {cmd:#04x}")
+    if size == 3:
+        return int.from_bytes(data[4:7], "little", signed=signed)
+    return _UPLOAD_VALUE[size, signed].unpack_from(data)[0]
+
+
+def is_reply_to(request: Buffer, reply: Buffer) -> bool:
+    '''应答回显index/subindex: 只有同一对象的应答(含中止帧)才算这个请求的'''
+    return reply[1:4] == request[1:4]
+
+
+def check_download(data: Buffer):
+    '''检查写应答, 中止帧抛SdoAbortError'''
+    cmd = data[0]
+    if cmd == DOWNLOAD_ACK:
+        return
+    if cmd == ABORT:
+        _raise_abort(data)
+    raise SdoError(f"unexpected SDO download response {cmd:#04x}")
+
+
+# ------------------------- 从站侧(仿真器用) ------------------------
+# 读应答和写请求的布局相同, 只是命令字不同; 写应答和读请求的布局相同
+_UPLOAD_COMMANDS = {1: 0x4F, 2: 0x4B, 4: 0x43}
+_DOWNLOAD_SIZES = {cmd: size for size, cmd in DOWNLOAD_COMMANDS.items()}
+_ABORT = struct.Struct("<BHBI")
+
+
+def decode_request(data: Buffer):
+    '''
+    解析主站请求
+    return: (cmd, index, sub, value, size), 读请求的value/size为None
+    '''
+    cmd, index, sub = _HEADER.unpack_from(data)
+    size = _DOWNLOAD_SIZES.get(cmd)
+    if size is None:
+        return cmd, index, sub, None, None
+    return cmd, index, sub, _UPLOAD_VALUE[size, False].unpack_from(data)[0], size
+
+
+def encode_upload_response(index: int, sub: int, value: int, size: int) -> bytes:
+    return _DOWNLOAD[size].pack(_UPLOAD_COMMANDS[size], index, sub, value & _MASKS[size])
+
+
+def encode_download_ack(index: int, sub: int) -> bytes:
+    return _UPLOAD_REQUEST.pack(DOWNLOAD_ACK, index, sub)
+
+
+def encode_abort(index: int, sub: int, code: int) -> bytes:
+    return _ABORT.pack(ABORT, index, sub, code)
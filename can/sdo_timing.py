@@ -0,0 +1,102 @@
+'''
+SDO超时和重试策略
+
+    RttEstimator: 按TCP(RFC 6298)的SRTT/RTTVAR估计每个节点的往返时间,
+                  超时 = SRTT + 4*RTTVAR, 超时一次翻倍(指数退避), 成功后按新样本恢复
+                  重发过的事务不取样(Karn算法), 避免把迟到的应答算到重发上
+    RetryPolicy:  读可以重试; 写只有幂等的对象可以重试, 控制字之类的命令不能盲目重发
+    SdoAttempts:  一次SDO事务的重发过程, 同步版和asyncio版共用:
+
+        tries = self.retry.begin(obj, is_write, self.rtt)
+        for timeout in tries:
+            reply = send_receive(request, timeout)      # asyncio版: await
+            if reply:
+                return tries.succeeded(reply)
+        raise tries.failed()
+'''
+
+import time
+
+from sdo_codec import SdoTimeoutError
+
+
+class RttEstimator:
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial: float = 0.1, min_timeout: float = 0.01, max_timeout: float = 1.0,
+                 granularity: float = 0.001):
+        '''
+        initial:     还没有样本时的超时, 单位秒
+        min_timeout: 超时下限, 防止安静总线上估计得过小, 驱动器偶尔慢一点就误判
+        max_timeout: 超时上限(包括退避后)
+        granularity: 计时粒度
+        '''
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.granularity = granularity
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        rto = self.srtt + max(self.granularity, self.K * self.rttvar)
+        self.rto = min(max(rto, self.min_timeout), self.max_timeout)
+
+    def timeout(self) -> float:
+        return self.rto
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_timeout)
+
+
+class RetryPolicy:
+    def __init__(self, retries: int = 2, no_retry=()):
+        '''
+        retries:  超时后最多重发次数
+        no_retry: 写超时后不能重发的对象(写入即动作的命令)
+        '''
+        self.retries = retries
+        self.no_retry = frozenset(no_retry)
+
+    def attempts(self, obj, is_write: bool) -> int:
+        if is_write and obj in self.no_retry:
+            return 1
+        return 1 + self.retries
+
+    def begin(self, obj, is_write: bool, rtt: RttEstimator) -> "SdoAttempts":
+        return SdoAttempts(obj, self.attempts(obj, is_write), rtt)
+
+
+class SdoAttempts:
+    def __init__(self, obj, attempts: int, rtt: RttEstimator):
+        self.obj = obj
+        self.attempts = attempts
+        self.rtt = rtt
+        self.attempt = 0
+        self._sent = 0.0
+
+    def __iter__(self):
+        '''逐次产出本次等待应答的超时; 上一次没等到应答时先退避'''
+        for self.attempt in range(self.attempts):
+            if self.attempt:
+                self.rtt.backoff()
+            self._sent = time.perf_counter()
+            yield self.rtt.timeout()
+        self.rtt.backoff()
+
+    def succeeded(self, reply):
+        '''收到应答: 只有第一次发送的往返时间取样(Karn算法), return: reply'''
+        if self.attempt == 0:
+            self.rtt.sample(time.perf_counter() - self._sent)
+        return reply
+
+    def failed(self) -> SdoTimeoutError:
+        return SdoTimeoutError(self.obj[0], self.obj[1], self.attempts)
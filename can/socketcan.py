@@ -1,6 +1,11 @@
 
 import can
-from typing import Optional, List, Union
+import logging
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Dict, Optional, List, Tuple, Union
 '''
 
 sudo ip link set can1 down
@@ -12,25 +17,73 @@ class SocketCAN:
     """
     支持标准CAN/CAN_FD
     """
-    def __init__(self, channel: str = "can0", bitrate: int = 1000000, is_fd: bool = False):
+    RX_QUEUE_SIZE = 256     # 每个COB-ID队列的上限,满了丢最旧的帧
+
+    def __init__(self, channel: str = "can0", bitrate: int = 1000000, is_fd: bool = False,
+                 interface: str = "socketcan"):
+        """interface: python-can接口名, 离线测试可以用"virtual"(见kinco_sim.py)"""
+        self.interface = interface
         self.channel = channel
         self.bitrate = bitrate
         self.is_fd = is_fd
         self.bus: Optional[can.Bus] = None
+        # 总线只由后台接收线程读取, 按COB-ID分发:
+        #   1. 等待应答的请求(transact)  -> 匹配成功的Future
+        #   2. 订阅的COB-ID(如TPDO)       -> 回调
+        #   3. 其余帧                     -> 按COB-ID的队列, 交给recv_msg
+        self._subscribers: Dict[int, Callable[[can.Message], None]] = {}
+        self._pending: Dict[int, List[Tuple[Callable[[can.Message], bool], Future]]] = {}
+        self._pending_lock = threading.Lock()
+        self._rx_queues: Dict[Optional[int], "queue.Queue[can.Message]"] = {None: queue.Queue(self.RX_QUEUE_SIZE)}
+        self._reader: Optional[threading.Thread] = None
+        self._running = False
+        # 内核接收过滤: 只有登记过的COB-ID会被拷贝到用户态, 没登记任何ID时不过滤
+        self._rx_ids: Counter = Counter()
+        self._filter_lock = threading.Lock()
+        self.rx_delivered = 0           # 过滤后送到本进程的帧数
+        self._bus_rx_base = 0           # connect时网卡已收到的帧数
+        # 抓包(can_capture.CaptureWriter), 为None时收发路径上只多一次判空
+        self._capture = None
 
     def connect(self) -> bool:
         try:
-            bus_config = {"interface": "socketcan","channel": self.channel,
+            bus_config = {"interface": self.interface,"channel": self.channel,
                           "bitrate": self.bitrate,"fd": self.is_fd }
             
             if self.is_fd:
                 bus_config["data_bitrate"] = 5000000
+            if self._rx_ids:
+                bus_config["can_filters"] = self._build_filters()
 
-            self.bus = can.Bus(**bus_config)
+            self.bus = self._open_bus(bus_config)
+            self.rx_delivered = 0
+            self._bus_rx_base = self._read_bus_rx() or 0
+            self._running = True
+            self._reader = threading.Thread(target=self._read_loop, name=f"{self.channel}-rx", daemon=True)
+            self._reader.start()
             return True
         except Exception as e:
             return False
 
+    def _open_bus(self, bus_config: dict) -> can.BusABC:
+        '''子类可以换成别的总线实现(如can_capture.ReplayCAN回放录制文件)'''
+        return can.Bus(**bus_config)
+
+    # ------------------------- 抓包 ------------------------
+    def start_capture(self, path: str, fmt: Optional[str] = None):
+        '''
+        记录之后所有收发的帧(时间戳为time.monotonic), 格式见can_capture.py
+        fmt: "candump" / "asc", None时按扩展名(.asc为ASC, 其他为candump日志)
+        '''
+        from can_capture import CaptureWriter
+        self.stop_capture()
+        self._capture = CaptureWriter(path, fmt=fmt, channel=self.channel)
+
+    def stop_capture(self):
+        capture, self._capture = self._capture, None
+        if capture is not None:
+            capture.close()
+
     def send_msg(self, can_id: int, data: Union[List[int], bytes], 
                  is_extended_id: bool = False, timeout: float = 0.2) -> bool:
         
@@ -39,26 +92,174 @@ class SocketCAN:
         msg = can.Message(arbitration_id=can_id, data=data, is_extended_id=is_extended_id, is_fd=self.is_fd)
         try:
             self.bus.send(msg, timeout=timeout)
-            return True
         except can.CanError:
             return False
+        capture = self._capture
+        if capture is not None:
+            capture.write(msg, is_rx=False)
+        return True
         
-    def recv_msg(self, timeout: float = 0.1):
+    # ------------------------- 内核过滤 ------------------------
+    def _build_filters(self) -> List[dict]:
+        return [{"can_id": can_id, "can_mask": 0x7FF, "extended": False} for can_id in sorted(self._rx_ids)]
+
+    def _apply_filters(self):
+        if self.bus:
+            # 没有登记ID时传None, 恢复接收全部帧
+            self.bus.set_filters(self._build_filters() or None)
+
+    def add_rx_ids(self, can_ids: List[int]):
+        """登记需要接收的COB-ID并更新内核过滤(按引用计数, 多个节点/控制器可重复登记)"""
+        with self._filter_lock:
+            self._rx_ids.update(can_ids)
+            self._apply_filters()
+
+    def remove_rx_ids(self, can_ids: List[int]):
+        with self._filter_lock:
+            self._rx_ids.subtract(can_ids)
+            self._rx_ids = +self._rx_ids
+            self._apply_filters()
+
+    def _read_bus_rx(self) -> Optional[int]:
+        try:
+            with open(f"/sys/class/net/{self.channel}/statistics/rx_packets") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def filter_stats(self) -> dict:
+        """
+        delivered: connect以来送到本进程的帧数
+        bus_rx:    同期网卡收到的帧数(读/sys, 非socketcan网卡时为None)
+        dropped:   被内核过滤掉的帧数
+        """
+        bus_rx = self._read_bus_rx()
+        if bus_rx is None:
+            return {"delivered": self.rx_delivered, "bus_rx": None, "dropped": None}
+        bus_rx -= self._bus_rx_base
+        return {"delivered": self.rx_delivered, "bus_rx": bus_rx,
+                "dropped": max(bus_rx - self.rx_delivered, 0)}
+
+    def subscribe(self, can_id: int, callback: Callable[[can.Message], None]):
+        """订阅指定COB-ID的帧,在接收线程里回调(回调里不要阻塞)"""
+        self._subscribers[can_id] = callback
+
+    def unsubscribe(self, can_id: int):
+        self._subscribers.pop(can_id, None)
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                msg = self.bus.recv(0.1)
+            except can.CanError as e:
+                logging.error(f"CAN接收异常: {e}")
+                continue
+            if msg is not None:
+                self.rx_delivered += 1
+                capture = self._capture
+                if capture is not None:
+                    capture.write(msg, is_rx=True)
+                self._dispatch(msg)
+
+    def _dispatch(self, msg: can.Message):
+        can_id = msg.arbitration_id
+        if can_id in self._pending:
+            with self._pending_lock:
+                waiters = self._pending.get(can_id, [])
+                for i, (match, future) in enumerate(waiters):
+                    if match(msg):
+                        del waiters[i]
+                        if not waiters:
+                            del self._pending[can_id]
+                        break
+                else:
+                    future = None
+            if future is not None:
+                future.set_result(msg)
+                return
+
+        callback = self._subscribers.get(can_id)
+        if callback is not None:
+            try:
+                callback(msg)
+            except Exception:
+                logging.exception(f"CAN回调异常 can_id={hex(can_id)}")
+            return
+
+        rx_queue = self._rx_queues.get(can_id, self._rx_queues[None])
+        if rx_queue.full():
+            try:
+                rx_queue.get_nowait()
+            except queue.Empty:
+                pass
+        rx_queue.put_nowait(msg)
+
+    def transact(self, can_id: int, data: Union[List[int], bytes], resp_id: int,
+                 match: Optional[Callable[[can.Message], bool]] = None,
+                 timeout: float = 0.1) -> Optional[bytearray]:
+        """
+        发送一帧并只等待自己的应答: resp_id上第一个满足match的帧
+        (比如SDO应答按0x580+node和index/subindex匹配), 其他帧不会被当成应答
+        return: 应答数据(不做转换), 超时/发送失败返回None
+        """
         if not self.bus:
-            return False
+            return None
+
+        future: Future = Future()
+        waiter = (match or (lambda msg: True), future)
+        # 先登记再发送, 防止应答比登记先到
+        with self._pending_lock:
+            self._pending.setdefault(resp_id, []).append(waiter)
+        try:
+            if not self.send_msg(can_id, data, timeout=timeout):
+                return None
+            msg = future.result(timeout)
+        except FutureTimeout:
+            logging.warning(f"等待CAN应答超时(can_id:{hex(resp_id)},超时时间:{timeout}s)")
+            return None
+        finally:
+            with self._pending_lock:
+                waiters = self._pending.get(resp_id)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._pending[resp_id]
+
+        return msg.data
+
+    def _recv(self, timeout: float, can_id: Optional[int]) -> Optional[can.Message]:
+        rx_queue = self._rx_queues.get(can_id)
+        if rx_queue is None:
+            # 第一次按COB-ID接收时建队列, 之后该COB-ID的帧不再进公共队列
+            rx_queue = self._rx_queues.setdefault(can_id, queue.Queue(self.RX_QUEUE_SIZE))
+        try:
+            return rx_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def recv_msg(self, timeout: float = 0.1, can_id: Optional[int] = None) -> Optional[bytearray]:
+        """
+        接收一帧未被transact/subscribe认领的帧, can_id为None时接收任意COB-ID
+        return: 帧数据(bytearray, 不做转换), 超时返回None
+        """
+        if not self.bus:
+            return None
         
-        msg = self.bus.recv(timeout)
+        msg = self._recv(timeout, can_id)
         # print("msg的所有属性", dir(msg))
         # print("msg内容      ", msg)
         if msg is None:
-            print(f"[WARNING] 接收CAN消息超时(超时时间:{timeout}s)")
-            return []
-        
-        # 转化为16进制
-        hex_list = [hex(b) for b in msg.data]
-        return hex_list
+            logging.warning(f"接收CAN消息超时(超时时间:{timeout}s)")
+            return None
+
+        return msg.data
     
     def disconnect(self):
+        self._running = False
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+        self.stop_capture()
         if self.bus:
             self.bus.shutdown()
 
@@ -0,0 +1,118 @@
+import bisect
+import threading
+from typing import Dict, Tuple
+
+'''
+驱动请求/应答的统计插件(CAN和UART共用, uart/txn_stats.py是指向这里的软链接)
+
+    驱动侧接口: 每完成一次事务调用所有已挂载插件的
+        on_transaction(source, index, seconds, outcome)
+            source:  节点标识, CAN为节点ID, UART为串口设备
+            index:   对象字典index
+            seconds: 请求发出到应答解析完的耗时
+            outcome: OK / TIMEOUT / ABORT / LRC / ERROR
+    没挂插件时驱动只多一次元组判空, 不计时
+
+    TxnStats: 按(source, index)统计次数/超时/中止/LRC错误和耗时直方图,
+              snapshot()给进程内用, to_prometheus()输出Prometheus文本格式
+'''
+
+OK = "ok"
+TIMEOUT = "timeout"
+ABORT = "abort"
+LRC = "lrc"
+ERROR = "error"
+OUTCOMES = (OK, TIMEOUT, ABORT, LRC, ERROR)
+
+# 直方图桶上界(秒), 最后一个桶是+Inf
+BUCKETS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class LatencyHistogram:
+    '''
+    固定桶直方图, 记录时只做一次bisect和几次整数加法
+    多个节点/线程会同时记录(LiftBusManager的线程池, 串口工作线程), +=不是原子的, 记录时加锁
+    '''
+    __slots__ = ("counts", "sum", "outcomes", "lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float, outcome: str):
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += seconds
+            self.outcomes[outcome] += 1
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        '''按桶上界估计分位数, 落在+Inf桶时返回最后一个有限上界'''
+        total = self.count
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+class TxnStats:
+    def __init__(self, driver: str = "can"):
+        '''driver: Prometheus标签, 区分CAN/UART'''
+        self.driver = driver
+        self.histograms: Dict[Tuple[str, int], LatencyHistogram] = {}
+
+    def on_transaction(self, source, index: int, seconds: float, outcome: str):
+        key = (str(source), index)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms.setdefault(key, LatencyHistogram())
+        histogram.record(seconds, outcome)
+
+    def reset(self):
+        self.histograms = {}
+
+    def snapshot(self) -> dict:
+        '''return: {(source, index): {count, timeout, abort, lrc, error, mean_ms, p50_ms, p99_ms}}'''
+        result = {}
+        for key, histogram in list(self.histograms.items()):
+            count = histogram.count
+            item = {"count": count}
+            item.update({outcome: n for outcome, n in histogram.outcomes.items() if outcome != OK})
+            item["mean_ms"] = histogram.sum / count * 1000 if count else 0.0
+            item["p50_ms"] = histogram.quantile(0.5) * 1000
+            item["p99_ms"] = histogram.quantile(0.99) * 1000
+            result[key] = item
+        return result
+
+    def to_prometheus(self, prefix: str = "nmx_lift") -> str:
+        '''每个指标族的HELP/TYPE和样本连续输出(文本格式要求同一族的样本不能被别的族隔开)'''
+        items = [(f'driver="{self.driver}",source="{source}",index="{index:#06x}"', histogram)
+                 for (source, index), histogram in sorted(self.histograms.items())]
+        lines = [f"# HELP {prefix}_transaction_seconds 请求发出到应答解析完的耗时",
+                 f"# TYPE {prefix}_transaction_seconds histogram"]
+        for labels, histogram in items:
+            cumulative = 0
+            for bound, n in zip(BUCKETS, histogram.counts):
+                cumulative += n
+                lines.append(f'{prefix}_transaction_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += histogram.counts[-1]
+            lines.append(f'{prefix}_transaction_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'{prefix}_transaction_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{prefix}_transaction_seconds_count{{{labels}}} {cumulative}')
+        lines += [f"# HELP {prefix}_transactions_total 按结果分类的事务数",
+                  f"# TYPE {prefix}_transactions_total counter"]
+        for labels, histogram in items:
+            for outcome, n in histogram.outcomes.items():
+                lines.append(f'{prefix}_transactions_total{{{labels},outcome="{outcome}"}} {n}')
+        return "\n".join(lines) + "\n"
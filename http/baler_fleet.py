@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多台打包机的asyncio客户端
+
+    AsyncBaler: 一台打包机, 和BalerPrinter一样的三个操作(baler_status/start_pack/end_pack), 不打印
+    BalerFleet: 一组打包机
+        status_all()      同时查询所有打包机, 耗时约为最慢的一台的一个往返
+        dispatch(ticket)  派给空闲且最不忙(完成任务最少)的打包机, 开始 -> 轮询到空闲 -> 结束
+                          所有打包机都在忙时排队等第一台空出来
+                          开始之后失败(打包超时/结束失败/请求出错)的打包机先隔离,
+                          后台轮询到空闲并补发end_pack后才重新派单
+
+    async with BalerFleet(["http://10.130.60.35:9000", "http://10.130.60.36:9000"]) as fleet:
+        statuses = await fleet.status_all()
+        results = await asyncio.gather(*(fleet.dispatch(ticket) for ticket in tickets))
+
+HTTP: 装了aiohttp时用aiohttp(每台打包机限制连接数, keep-alive);
+      没装时用http_session.PooledSession在线程里发请求, 接口不变
+日志: logging, 格式为"事件 key=value ...", 热路径上没有print
+"""
+
+import asyncio
+import logging
+import time
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from baler_jobs import default_is_busy, PackJobError
+from dbj_api import DEFAULT_SEND_DATA
+from http_session import PooledSession, DEFAULT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class ReadTimeout(Exception):
+    """请求已经发到打包机, 没等到应答(start_pack时按已开始处理)"""
+
+
+class _AiohttpTransport:
+    def __init__(self, hosts, max_per_host, timeout):
+        connector = aiohttp.TCPConnector(limit_per_host=max_per_host)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self._timeout(timeout))
+        self.default_timeout = timeout
+
+    @staticmethod
+    def _timeout(timeout):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def post(self, url, data, timeout=None):
+        kwargs = {} if timeout is None else {"timeout": self._timeout(timeout)}
+        try:
+            async with self.session.post(url, json=data, **kwargs) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except getattr(aiohttp, "SocketTimeoutError", aiohttp.ServerTimeoutError) as e:
+            raise ReadTimeout(str(e)) from e
+
+    async def close(self):
+        await self.session.close()
+
+
+class _ThreadTransport:
+    """没有aiohttp时: 共用一个PooledSession, 请求在默认线程池里执行"""
+
+    def __init__(self, hosts, max_per_host, timeout):
+        self.session = PooledSession(timeout=timeout, pool_connections=hosts, pool_maxsize=max_per_host)
+
+    async def post(self, url, data, timeout=None):
+        def post():
+            try:
+                response = self.session.post(url, json=data, timeout=timeout)
+            except requests.exceptions.ReadTimeout as e:
+                raise ReadTimeout(str(e)) from e
+            response.raise_for_status()
+            return response.json()
+        return await asyncio.to_thread(post)
+
+    async def close(self):
+        self.session.close()
+
+
+class AsyncBaler:
+    """
+    一台打包机, 同时在途的请求数不超过max_concurrency
+    """
+
+    def __init__(self, base_url, transport, max_concurrency=2, send_data=None):
+        """
+        Args:
+            send_data: 不带ticket_info的请求(如查询状态)发送的请求体, 默认和BalerPrinter相同
+        """
+        self.base_url = base_url
+        self.transport = transport
+        self.send_data = send_data or DEFAULT_SEND_DATA
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self.packing = False        # 有打包任务在执行或被隔离(派单时跳过)
+        self.quarantined = False    # 打包失败后等机器空闲, 恢复前不派单
+        self.stage = None           # 当前任务所处阶段: starting/packing/ending
+        self.jobs_done = 0
+        self.in_flight = 0
+        self.last_status = None
+        self.last_latency = None    # 最近一次请求的往返时间(秒)
+
+    async def call(self, api, ticket_info=None, timeout=None):
+        """
+        Returns:
+            dict: 响应JSON; 超时/HTTP错误抛异常
+        """
+        data = {"ticket_info": ticket_info} if ticket_info is not None else self.send_data
+        async with self._limit:
+            self.in_flight += 1
+            start = time.monotonic()
+            try:
+                return await self.transport.post(f"{self.base_url}/api/{api}", data, timeout)
+            finally:
+                self.in_flight -= 1
+                self.last_latency = time.monotonic() - start
+
+    async def baler_status(self, ticket_info=None):
+        self.last_status = await self.call("baler_status", ticket_info)
+        return self.last_status
+
+    async def start_pack(self, ticket_info):
+        return await self.call("start_pack", ticket_info, timeout=(DEFAULT_TIMEOUT[0], 30))
+
+    async def end_pack(self, ticket_info):
+        return await self.call("end_pack", ticket_info)
+
+
+class BalerFleet:
+    """
+    一组打包机
+    """
+
+    def __init__(self, base_urls, max_per_device=2, timeout=DEFAULT_TIMEOUT, is_busy=default_is_busy,
+                 min_interval=0.2, max_interval=2.0, expected_duration=10.0, pack_timeout=120.0,
+                 start_timeout=(DEFAULT_TIMEOUT[0], 2), send_data=None):
+        """
+        Args:
+            base_urls: 各打包机的API基础地址
+            max_per_device: 每台打包机同时在途的请求数上限(也是连接数上限)
+            timeout: 默认超时(连接, 读), 单位秒
+            is_busy: baler_status的响应 -> 是否在打包中(见baler_jobs.py)
+            min_interval/max_interval/expected_duration/pack_timeout: 轮询参数, 同baler_jobs.BalerJobRunner
+            start_timeout: start_pack的超时, 读超时按已开始处理
+            send_data: 查询状态等请求的请求体, 默认和BalerPrinter相同
+        """
+        self.base_urls = list(base_urls)
+        self.max_per_device = max_per_device
+        self.timeout = timeout
+        self.is_busy = is_busy
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pack_timeout = pack_timeout
+        self.start_timeout = start_timeout
+        self.send_data = send_data
+        self.expected = {url: expected_duration for url in self.base_urls}
+        self.transport = None
+        self.balers = {}
+        self._idle = None
+        self._recoveries = set()
+
+    async def open(self):
+        transport_class = _AiohttpTransport if aiohttp is not None else _ThreadTransport
+        self.transport = transport_class(len(self.base_urls), self.max_per_device, self.timeout)
+        self.balers = {url: AsyncBaler(url, self.transport, self.max_per_device, self.send_data)
+                       for url in self.base_urls}
+        self._idle = asyncio.Condition()
+        logger.info("fleet_open balers=%d transport=%s", len(self.balers), transport_class.__name__)
+        return self
+
+    async def close(self):
+        for task in list(self._recoveries):
+            task.cancel()
+        if self._recoveries:
+            await asyncio.gather(*self._recoveries, return_exceptions=True)
+        if self.transport is not None:
+            await self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def status_all(self):
+        """
+        Returns:
+            dict: {base_url: baler_status的响应, 失败为None}
+        """
+        urls = list(self.balers)
+        results = await asyncio.gather(*(self.balers[url].baler_status() for url in urls), return_exceptions=True)
+        statuses = {}
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                logger.warning("status_failed baler=%s error=%r", url, result)
+                statuses[url] = None
+            else:
+                statuses[url] = result
+        return statuses
+
+    async def _acquire(self):
+        """选空闲且完成任务最少的打包机, 都在忙时等"""
+        async with self._idle:
+            while True:
+                idle = [baler for baler in self.balers.values() if not baler.packing]
+                if idle:
+                    baler = min(idle, key=lambda b: (b.jobs_done, b.in_flight))
+                    baler.packing = True
+                    return baler
+                await self._idle.wait()
+
+    async def _release(self, baler):
+        async with self._idle:
+            baler.packing = False
+            self._idle.notify()
+
+    async def dispatch(self, ticket_info):
+        """
+        派一个打包任务, 打包机做完并end_pack后返回
+
+        Returns:
+            dict: end_pack的响应
+        Raises:
+            PackJobError: 开始被拒绝/打包超时/结束失败
+        """
+        baler = await self._acquire()
+        try:
+            result = await self._run_pack(baler, ticket_info)
+        except BaseException:
+            if baler.stage == "starting":
+                # start_pack被拒绝或没连上, 机器没有开始打包
+                await self._release(baler)
+            else:
+                self._quarantine(baler, ticket_info)
+            raise
+        await self._release(baler)
+        return result
+
+    def _quarantine(self, baler, ticket_info):
+        """机器可能还在打包或没收到end_pack: 不放回空闲, 后台等它空闲后补发end_pack再放回"""
+        baler.quarantined = True
+        logger.warning("baler_quarantined baler=%s stage=%s", baler.base_url, baler.stage)
+        task = asyncio.get_running_loop().create_task(self._recover(baler, ticket_info))
+        self._recoveries.add(task)
+        task.add_done_callback(self._recoveries.discard)
+
+    async def _recover(self, baler, ticket_info):
+        while True:
+            try:
+                if not self.is_busy(await baler.baler_status(ticket_info)):
+                    break
+            except Exception as e:
+                logger.warning("status_failed baler=%s error=%r", baler.base_url, e)
+            await asyncio.sleep(self.max_interval)
+        try:
+            result = await baler.end_pack(ticket_info)
+            logger.info("baler_recovered baler=%s end_pack=%s", baler.base_url, result.get("Success", False))
+        except Exception as e:
+            logger.warning("recover_end_failed baler=%s error=%r", baler.base_url, e)
+        baler.quarantined = False
+        await self._release(baler)
+
+    async def _run_pack(self, baler, ticket_info):
+        order = ticket_info.get("order_no") if isinstance(ticket_info, dict) else None
+        started = time.monotonic()
+        baler.stage = "starting"
+        try:
+            result = await baler.call("start_pack", ticket_info, timeout=self.start_timeout)
+        except ReadTimeout:
+            # 和BalerPrinter.start_pack一样, 读超时按已开始处理, 由轮询确认完成
+            result = None
+        if result is not None and not result.get("Success", False):
+            raise PackJobError(f"{baler.base_url} 开始打包被拒绝: {result.get('Message', '')}")
+        logger.info("pack_started baler=%s order=%s ack=%s", baler.base_url, order, result is not None)
+
+        baler.stage = "packing"
+        polls = await self._wait_idle(baler, ticket_info, started)
+        duration = time.monotonic() - started
+        self.expected[baler.base_url] = 0.7 * self.expected[baler.base_url] + 0.3 * duration
+
+        baler.stage = "ending"
+        result = await baler.end_pack(ticket_info)
+        if not result.get("Success", False):
+            raise PackJobError(f"{baler.base_url} 结束打包失败: {result.get('Message', '')}")
+        baler.stage = None
+        baler.jobs_done += 1
+        logger.info("pack_done baler=%s order=%s duration=%.2f polls=%d", baler.base_url, order, duration, polls)
+        return result
+
+    async def _wait_idle(self, baler, ticket_info, started):
+        """轮询间隔和baler_jobs.BalerJobRunner相同: 按预计剩余时间的一半, 超过预计后逐步放大"""
+        interval = self.min_interval
+        polls = 0
+        while True:
+            elapsed = time.monotonic() - started
+            remaining = self.expected[baler.base_url] - elapsed
+            if remaining > self.min_interval:
+                delay = min(max(remaining / 2, self.min_interval), self.max_interval)
+            else:
+                delay = interval
+                interval = min(interval * 1.5, self.max_interval)
+            if elapsed + delay > self.pack_timeout:
+                raise PackJobError(f"{baler.base_url} 打包超过{self.pack_timeout}秒未完成")
+            await asyncio.sleep(delay)
+            polls += 1
+            try:
+                status = await baler.baler_status(ticket_info)
+            except Exception as e:
+                logger.warning("status_failed baler=%s error=%r", baler.base_url, e)
+                continue
+            if not self.is_busy(status):
+                return polls
+
+
+async def _main(base_urls):
+    async with BalerFleet(base_urls) as fleet:
+        start = time.monotonic()
+        statuses = await fleet.status_all()
+        logger.info("status_all elapsed=%.3f statuses=%s", time.monotonic() - start, statuses)
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2:
+        print("使用方法: python3 baler_fleet.py http://10.130.60.35:9000 [http://... ...]")
+        sys.exit(1)
+    asyncio.run(_main(sys.argv[1:]))
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+打包机的非阻塞打包任务
+
+    start_pack()会阻塞最多30秒等机器, 超时也当成"已开始"; end必须等机器做完再发
+    这里每台打包机一个后台线程, 任务排队按顺序执行:
+        1. start_pack(读超时很短, 超时按已开始处理, 和原来一样)
+        2. 轮询baler_status直到机器空闲, 轮询间隔自适应:
+               按最近几次打包的耗时估计剩余时间, 离预计完成还早时间隔长, 快完成时缩短到min_interval,
+               超过预计时间后从min_interval逐步放大到max_interval
+        3. 机器空闲后自动end_pack, 然后才开始下一个任务
+    调用方提交后可以去准备下一张小票, 多台打包机各自的线程并行
+
+    with BalerPrinter(base_url) as printer:
+        job = printer.submit_pack(ticket_info)
+        ...                                        # 准备下一张小票
+        job.wait(timeout=120)                      # 或者在协程里: await job
+
+状态判断: 默认认为baler_status返回Success=true表示空闲, false表示打包中;
+          机器固件不同时给BalerJobRunner传is_busy(result) -> bool
+失败恢复: 任务在开始之后失败(打包超时/end_pack失败/请求出错), 机器可能还在打包或没收到end_pack,
+          后台线程先轮询到机器空闲并补发end_pack, 然后才开始下一个任务, 期间runner.recovering为True
+日志: logging, 格式为"事件 key=value ..."
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+
+# start_pack只等机器确认收到, 不等打包完成
+START_TIMEOUT = (3.05, 2)
+
+logger = logging.getLogger(__name__)
+
+
+def default_is_busy(result):
+    """baler_status的响应 -> 是否在打包中"""
+    return not result.get("Success", False)
+
+
+class PackJobError(Exception):
+    """打包任务失败, job.state是失败时所处的阶段"""
+
+
+class PackJob:
+    """
+    一个打包任务的句柄, 状态: queued -> starting -> packing -> ending -> done / failed / cancelled
+    """
+
+    def __init__(self, ticket_info):
+        self.ticket_info = ticket_info
+        self.state = "queued"
+        self.future = Future()
+        self.submitted = time.monotonic()
+        self.started = None         # start_pack发出的时刻
+        self.finished = None        # 轮询到机器空闲的时刻
+        self.start_result = None    # start_pack的响应, 超时为None
+        self.polls = 0
+
+    @property
+    def send_data(self):
+        return {"ticket_info": self.ticket_info}
+
+    @property
+    def duration(self):
+        """打包耗时(秒), 没做完为None"""
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def done(self):
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        """
+        等任务完成
+
+        Returns:
+            dict: end_pack的响应
+        Raises:
+            PackJobError: 任务失败; concurrent.futures.TimeoutError: 超时(任务继续执行)
+        """
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """只有还在排队的任务能取消"""
+        return self.future.cancel()
+
+    def add_done_callback(self, fn):
+        """fn(job)在后台线程里调用"""
+        self.future.add_done_callback(lambda _: fn(self))
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    def __repr__(self):
+        return f"PackJob(state={self.state}, polls={self.polls}, duration={self.duration})"
+
+
+class BalerJobRunner:
+    """
+    一台打包机的任务队列和后台线程
+    """
+
+    def __init__(self, printer, is_busy=default_is_busy, min_interval=0.2, max_interval=2.0,
+                 expected_duration=10.0, pack_timeout=120.0):
+        """
+        Args:
+            printer: BalerPrinter
+            is_busy: baler_status的响应 -> 是否在打包中
+            min_interval/max_interval: 轮询间隔范围, 单位秒
+            expected_duration: 还没有打包记录时预计的打包时间, 单位秒
+            pack_timeout: 一次打包最长时间, 超过则任务失败(不发end_pack)
+        """
+        self.printer = printer
+        self.is_busy = is_busy
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.expected_duration = expected_duration
+        self.pack_timeout = pack_timeout
+        self._queue = queue.Queue()
+        self._running = True
+        # 失败后等机器空闲期间为True; close(wait=False)时放弃等待
+        self.recovering = False
+        self._abandon = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"baler-{printer.base_url}", daemon=True)
+        self._thread.start()
+
+    def submit_pack(self, ticket_info=None):
+        job = PackJob(ticket_info or self.printer.send_data["ticket_info"])
+        if not self._running:
+            job.state = "failed"
+            job.future.set_exception(PackJobError("任务队列已关闭"))
+            return job
+        self._queue.put(job)
+        return job
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self, wait=True):
+        """
+        Args:
+            wait: True时等排队的任务都做完; False时取消还没开始的任务, 正在打包的任务仍会做完并end
+        """
+        self._running = False
+        if not wait:
+            self._abandon.set()
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                job.state = "cancelled"
+                job.cancel()
+        self._queue.put(None)
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    # ------------------------- 后台线程 ------------------------
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self._execute(job)
+            except Exception as e:
+                stage = job.state
+                logger.warning("pack_failed baler=%s stage=%s error=%s", self.printer.base_url, stage, e)
+                job.state = "failed"
+                job.future.set_exception(e if isinstance(e, PackJobError) else PackJobError(f"{stage}: {e}"))
+                if stage != "starting":
+                    self._recover(job)
+                continue
+            job.state = "done"
+            job.future.set_result(result)
+
+    def _recover(self, job):
+        """机器可能还在打包或没收到end_pack: 轮询到空闲后补发end_pack, 再开始下一个任务"""
+        self.recovering = True
+        logger.info("baler_recovering baler=%s", self.printer.base_url)
+        try:
+            while True:
+                if self._abandon.is_set():
+                    return
+                try:
+                    busy = self.is_busy(self.printer.call("baler_status", job.send_data))
+                except requests.exceptions.RequestException as e:
+                    logger.warning("status_failed baler=%s error=%s", self.printer.base_url, e)
+                    busy = True
+                if not busy:
+                    break
+                self._abandon.wait(self.max_interval)
+            try:
+                result = self.printer.call("end_pack", job.send_data)
+                logger.info("baler_recovered baler=%s end_pack=%s", self.printer.base_url, result.get("Success", False))
+            except requests.exceptions.RequestException as e:
+                logger.warning("recover_end_failed baler=%s error=%s", self.printer.base_url, e)
+        finally:
+            self.recovering = False
+
+    def _execute(self, job):
+        job.state = "starting"
+        job.started = time.monotonic()
+        try:
+            job.start_result = self.printer.call("start_pack", job.send_data, timeout=START_TIMEOUT)
+        except requests.exceptions.ReadTimeout:
+            # 机器收到了但没及时应答, 和原来一样按已开始处理, 由轮询确认完成
+            job.start_result = None
+        else:
+            if not job.start_result.get("Success", False):
+                raise PackJobError(f"开始打包被拒绝: {job.start_result.get('Message', '')}")
+
+        job.state = "packing"
+        self._wait_idle(job)
+        job.finished = time.monotonic()
+        # 按最近的打包耗时更新预计时间, 下一次轮询更省
+        self.expected_duration = 0.7 * self.expected_duration + 0.3 * job.duration
+
+        job.state = "ending"
+        result = self.printer.call("end_pack", job.send_data)
+        if not result.get("Success", False):
+            raise PackJobError(f"结束打包失败: {result.get('Message', '')}")
+        return result
+
+    def _wait_idle(self, job):
+        interval = self.min_interval
+        while True:
+            elapsed = time.monotonic() - job.started
+            remaining = self.expected_duration - elapsed
+            if remaining > self.min_interval:
+                # 离预计完成还早: 睡剩余时间的一半, 越接近越密
+                delay = min(max(remaining / 2, self.min_interval), self.max_interval)
+            else:
+                delay = interval
+                interval = min(interval * 1.5, self.max_interval)
+            if elapsed + delay > self.pack_timeout:
+                raise PackJobError(f"打包超过{self.pack_timeout}秒未完成")
+            time.sleep(delay)
+            job.polls += 1
+            try:
+                status = self.printer.call("baler_status", job.send_data)
+            except requests.exceptions.RequestException as e:
+                # 轮询偶尔失败不影响任务, 下次再查
+                logger.warning("status_failed baler=%s error=%s", self.printer.base_url, e)
+                continue
+            if not self.is_busy(status):
+                return
@@ -10,49 +10,113 @@
 
 """
 
+import copy
 import requests
 import sys      # 处理命令行参数
 import time
 
+from http_session import PooledSession, DEFAULT_TIMEOUT
+
+# 开始打包要等机器动作完成才返回, 读超时放宽
+START_PACK_TIMEOUT = (DEFAULT_TIMEOUT[0], 30)
+
+# 不指定send_data时的请求体(baler_fleet.py的AsyncBaler也用这一份)
+DEFAULT_SEND_DATA = {
+     "ticket_info": {
+        "order_source": "美团",
+        "source_add": "某某大药房",
+        "source_phone": "123-4567-8900",
+        "order_parcels_num": "N",
+        "get_num": "10099",
+        "dem_num": "1/3",
+        "order_no": "601827061572981635",
+        "order_time": "2026-05-12 10:19:40",
+        "expected_delivery_time": "2026-05-12 10:19:40",
+        "store_name": "姓名姓名姓名",
+        "rec_phone": "***-****-1234",
+        "rec_fake_phone": "123-4567-8900(0000)",
+        "delivery_address": "某某省-某某市-某某区某某某某产业基地一号楼某某",
+        "buyer_message": "《临江仙·滚滚长江东逝水》"
+    }
+}
+
 class BalerPrinter:
     """
     打包机打印机操作类
     封装打包机的所有API操作
     """
 
-    def __init__(self, base_url="http://10.130.60.35:9000", send_data=None):
+    def __init__(self, base_url="http://10.130.60.35:9000", send_data=None, session=None, timeout=DEFAULT_TIMEOUT):
         """
         初始化打包机操作类
 
         Args:
             base_url: API基础地址
             self.test_data: 测试数据，如果不提供则使用默认数据
+            session: 共用的PooledSession(如http_session.shared_session()), 不提供则自己建一个, close()时关闭
+            timeout: 默认超时(连接, 读), 单位秒
         """
         self.base_url = base_url
-        self.send_data = send_data or {
-             "ticket_info": {
-                "order_source": "美团",
-                "source_add": "某某大药房",
-                "source_phone": "123-4567-8900",
-                "order_parcels_num": "N",
-                "get_num": "10099",
-                "dem_num": "1/3",
-                "order_no": "601827061572981635",
-                "order_time": "2026-05-12 10:19:40",
-                "expected_delivery_time": "2026-05-12 10:19:40",
-                "store_name": "姓名姓名姓名",
-                "rec_phone": "***-****-1234",
-                "rec_fake_phone": "123-4567-8900(0000)",
-                "delivery_address": "某某省-某某市-某某区某某某某产业基地一号楼某某",
-                "buyer_message": "《临江仙·滚滚长江东逝水》"
-            }
-        }
+        # 同一台打包机的请求复用keep-alive连接, 不再每次建TCP连接
+        self._own_session = session is None
+        self.session = session or PooledSession(timeout=timeout, pool_connections=1)
+        # 打包任务队列(baler_jobs.BalerJobRunner), 第一次submit_pack时创建
+        self.jobs = None
+        self.send_data = send_data or copy.deepcopy(DEFAULT_SEND_DATA)
+
+    def close(self):
+        """等排队的打包任务做完, 再关闭自己建的会话(连接池), 共用的会话由调用方关闭"""
+        if self.jobs is not None:
+            self.jobs.close()
+            self.jobs = None
+        if self._own_session:
+            self.session.close()
+
+    def call(self, api, send_data=None, timeout=None):
+        """
+        调用一个接口, 不打印, 给后台任务用
+
+        Args:
+            api: 接口名, 如"baler_status"
+            send_data: 请求数据, 不提供则用self.send_data
+            timeout: 超时(连接, 读), 不提供则用会话的默认超时
+        Returns:
+            dict: 响应JSON, HTTP错误/超时/非JSON抛requests的异常
+        """
+        response = self.session.post(
+            f"{self.base_url}/api/{api}",
+            json=send_data or self.send_data,
+            headers={"Content-Type": "application/json"},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def submit_pack(self, ticket_info=None):
+        """
+        非阻塞打包: 排队后马上返回PackJob, 开始/等完成/结束打包由后台线程按顺序做(见baler_jobs.py)
+
+        Args:
+            ticket_info: 小票信息, 不提供则用self.send_data里的
+        Returns:
+            PackJob: job.wait()等完成, 或者await job
+        """
+        if self.jobs is None:
+            from baler_jobs import BalerJobRunner
+            self.jobs = BalerJobRunner(self)
+        return self.jobs.submit_pack(ticket_info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
     
     def baler_status(self):
         """查询打包机状态"""
         print("=== 查询打包机状态 ===")
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/baler_status",
                 json=self.send_data,
                 headers={"Content-Type": "application/json"}
@@ -80,11 +144,11 @@ class BalerPrinter:
         print("\n=== 开始打包 ===")
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/start_pack",
                 json=self.send_data,
                 headers={"Content-Type": "application/json"},
-                timeout=30
+                timeout=START_PACK_TIMEOUT
             )
 
             print(f"状态码: {response.status_code}")
@@ -112,7 +176,7 @@ class BalerPrinter:
         """结束打包"""
         print("\n=== 结束打包 ===")
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/end_pack",
                 json=self.send_data,
                 headers={"Content-Type": "application/json"}
@@ -148,19 +212,19 @@ if __name__ == "__main__":
     # 2. 获取指令参数
     cmd = sys.argv[1].lower()  # 转为小写，兼容大小写输入（如Start/START）
     
-    printer = BalerPrinter()
-    
-    # 4. 根据指令执行对应方法
-    if cmd == "status":
-        printer.baler_status()
-    elif cmd == "start":
-        printer.start_pack()
-    elif cmd == "end":
-        printer.end_pack()
-    else:
-        print(f"✗ 无效指令: {cmd}")
-        print("支持的指令：status / start / end")
-        sys.exit(1)
+    with BalerPrinter() as printer:
+
+        # 4. 根据指令执行对应方法
+        if cmd == "status":
+            printer.baler_status()
+        elif cmd == "start":
+            printer.start_pack()
+        elif cmd == "end":
+            printer.end_pack()
+        else:
+            print(f"✗ 无效指令: {cmd}")
+            print("支持的指令：status / start / end")
+            sys.exit(1)
     
     print("\n 操作完成 ")
 
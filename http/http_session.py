@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+带连接池的HTTP会话, 打包机(dbj_api.py)和芯烨云(xpj_test.py)共用
+
+    requests.post每次新建连接(https还要重新握手); Session按host复用keep-alive连接,
+    几Hz轮询状态时每次只有一个请求的开销
+
+    with PooledSession(pool_maxsize=2) as session:
+        session.post(url, json=data)                  # 默认超时(连接3秒, 读10秒)
+        session.post(url, json=data, timeout=(3, 30)) # 单次覆盖
+
+    shared_session(): 进程内共用的会话, 程序退出前close_shared_session()
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (连接超时, 读超时), 单位秒
+DEFAULT_TIMEOUT = (3.05, 10)
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session + 连接池参数 + 默认超时
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_connections=4, pool_maxsize=4, pool_block=True):
+        """
+        Args:
+            timeout: 默认超时, (连接, 读)或一个数, 调用时传timeout可以覆盖
+            pool_connections: 缓存连接池的host数
+            pool_maxsize: 每个host最多保持的连接数
+            pool_block: True时连接都在用就等待, 不超过pool_maxsize; False时临时多开连接(用完不保留)
+        """
+        super().__init__()
+        self.timeout = timeout
+        # POST不是幂等的, 不自动重试
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              pool_block=pool_block, max_retries=0)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_session() -> PooledSession:
+    """进程内共用的会话(线程安全), 第一次调用时创建"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = PooledSession()
+        return _shared
+
+
+def close_shared_session():
+    global _shared
+    with _shared_lock:
+        session, _shared = _shared, None
+    if session is not None:
+        session.close()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+芯烨云打印的本地持久化队列
+
+    xp_print()每张小票同步发一次请求, 进程挂了小票就丢了, 订单集中时容易撞上云端限流
+    这里小票先写进本地SQLite(WAL模式, 一次插入几十微秒), 后台线程再发出去:
+        令牌桶限速(rate张/秒, 允许burst张突发)
+        最多max_in_flight个请求同时在途(共用一个PooledSession)
+        失败按指数退避重试(加随机抖动), 超过max_attempts次记为failed
+        只重发肯定没被处理的请求: 连接没建立, HTTP 429/503, 云端返回非0的code
+    幂等键: 同一个key只入队一次(如订单号), 重复提交直接返回; 成功后只记一次done
+    不重复打印: 请求发出后没拿到可信的应答(读超时, 连接中途断开, 其他HTTP错误/网关页面,
+              或者进程在请求途中退出), 云端可能已经打了, 这种记为unknown不自动重发,
+              人工确认后用retry_unknown()重发
+
+    spool = PrintSpool("print_spool.db", rate=5, burst=10).start()
+    spool.enqueue({"sn": "36R0T38XWN71149", "voice": VOICE_MODE_MUTE}, content, key=order_no)
+    spool.stats()      # {"pending", "inflight", "done", "failed", "unknown", "depth", "drain_rate"}
+    spool.stop()
+"""
+
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from http_session import PooledSession
+from xpj_test import xp_print
+
+PENDING = "pending"
+INFLIGHT = "inflight"
+DONE = "done"
+FAILED = "failed"
+UNKNOWN = "unknown"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    data TEXT NOT NULL,
+    content TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    created REAL NOT NULL,
+    finished REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_at);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (state, finished);
+"""
+
+# 网关/云端明确表示没有处理的HTTP状态(限流, 暂不可用), 可以重发
+RETRY_STATUS = (429, 503)
+
+
+def _not_sent(error):
+    """请求肯定没到云端(连接没建立): 可以放心重发"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], "reason", error.args[0]), NewConnectionError)
+    return False
+
+
+class TokenBucket:
+    """
+    令牌桶: 平均rate个/秒, 最多攒burst个
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """取一个令牌, return: 0表示取到了, 否则还要等的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class PrintSpool:
+    """
+    持久化打印队列 + 后台发送线程
+    """
+
+    def __init__(self, path="print_spool.db", rate=5.0, burst=10, max_in_flight=4, max_attempts=8,
+                 backoff=1.0, max_backoff=60.0, session=None, send=None):
+        """
+        Args:
+            path: SQLite文件
+            rate/burst: 令牌桶, 张/秒和突发张数
+            max_in_flight: 同时在途的请求数
+            max_attempts: 最多发送次数, 超过记为failed
+            backoff/max_backoff: 第n次失败后等backoff*2^(n-1)秒(不超过max_backoff), 加0~50%抖动
+            session: PooledSession, 不提供则自己建一个(每个host保持max_in_flight个连接)
+            send: 发送函数send(data, content, session=) -> 芯烨云响应dict, HTTP状态不是2xx时抛requests.HTTPError,
+                  默认xp_print(check_status=True)
+        """
+        self.path = path
+        self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._own_session = session is None
+        self.session = session or self._new_session()
+        self.send = send or partial(xp_print, check_status=True)
+        self._db = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._slots = threading.Semaphore(max_in_flight)
+        self._executor = None
+        self._thread = None
+        self._running = False
+        # 上次退出时还在途的请求: 不知道云端打没打, 不自动重发
+        with self._lock:
+            db = self._conn()
+            db.execute("UPDATE jobs SET state=?, last_error=? WHERE state=?",
+                       (UNKNOWN, "进程退出时请求在途", INFLIGHT))
+
+    def _new_session(self):
+        return PooledSession(pool_connections=1, pool_maxsize=self.max_in_flight)
+
+    def _conn(self):
+        """调用方持有self._lock; stop关闭后下次用到时重新打开"""
+        if self._db is None:
+            # 一个连接, 所有线程共用, 由锁串行; WAL下写不阻塞读, 单条插入很快
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        if self.session is None:
+            self.session = self._new_session()
+        self._running = True
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="xp-print")
+        self._thread = threading.Thread(target=self._run, name="print-spool", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """
+        没发出去的小票留在库里, 下次start继续发; stop之后仍然可以enqueue/查询, 数据库用到时重新打开
+
+        Args:
+            wait: True时等在途的请求完成再返回; False时不等, 在途的请求在后台完成后再关闭数据库和会话
+                  (进程在那之前退出的话, 这些小票下次启动时记为unknown)
+        """
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        executor, self._executor = self._executor, None
+        session = None
+        if self._own_session:
+            # 下次start换新的会话, 这个等在途请求结束后关闭
+            session, self.session = self.session, None
+        if wait or executor is None:
+            self._close(executor, session)
+        else:
+            threading.Thread(target=self._close, args=(executor, session), name="print-spool-close",
+                             daemon=True).start()
+
+    def _close(self, executor, session):
+        # 在途的_deliver还要写库, 等它们都结束再关
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if session is not None:
+            session.close()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------- 入队/查询 ------------------------
+    def enqueue(self, data, content, key=None):
+        """
+        小票写入本地队列, 马上返回
+
+        Args:
+            data: xp_print的参数(sn, voice等)
+            content: 打印内容
+            key: 幂等键(如订单号), 同一个key只会打印一次; 不提供则随机生成
+        Returns:
+            str: 幂等键
+        """
+        key = key or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            db.execute("INSERT OR IGNORE INTO jobs (key, data, content, state, next_at, created) "
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, json.dumps(data, ensure_ascii=False), content, PENDING, now, now))
+        self._wake.set()
+        return key
+
+    def job(self, key):
+        """return: dict(state, attempts, last_error...), 不存在为None"""
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT key, state, attempts, created, finished, last_error FROM jobs WHERE key=?",
+                             (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("key", "state", "attempts", "created", "finished", "last_error"), row))
+
+    def retry_unknown(self, keys=None):
+        """人工确认没打印的unknown小票重新排队, keys为None时全部, return: 重新排队的张数"""
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            if keys is None:
+                cursor = db.execute("UPDATE jobs SET state=?, next_at=? WHERE state=?", (PENDING, now, UNKNOWN))
+            else:
+                cursor = db.executemany("UPDATE jobs SET state=?, next_at=? WHERE state=? AND key=?",
+                                        [(PENDING, now, UNKNOWN, key) for key in keys])
+        self._wake.set()
+        return cursor.rowcount
+
+    def stats(self, window=60.0):
+        """
+        Returns:
+            dict: 各状态张数, depth(待发+在途), drain_rate(最近window秒每秒完成张数)
+        """
+        with self._lock:
+            db = self._conn()
+            counts = dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            recent = db.execute("SELECT COUNT(*) FROM jobs WHERE state=? AND finished>=?",
+                                (DONE, time.time() - window)).fetchone()[0]
+        result = {state: counts.get(state, 0) for state in (PENDING, INFLIGHT, DONE, FAILED, UNKNOWN)}
+        result["depth"] = result[PENDING] + result[INFLIGHT]
+        result["drain_rate"] = recent / window
+        return result
+
+    # ------------------------- 后台线程 ------------------------
+    def _claim(self):
+        """取一张到期的小票并标记为在途, return: (id, data, content, attempts) 或 (None, 下一张到期的等待秒数)"""
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT id, data, content, attempts FROM jobs WHERE state=? AND next_at<=? "
+                             "ORDER BY next_at, id LIMIT 1", (PENDING, now)).fetchone()
+            if row is None:
+                next_at = db.execute("SELECT MIN(next_at) FROM jobs WHERE state=?", (PENDING,)).fetchone()[0]
+                return None, (None if next_at is None else max(next_at - now, 0.0))
+            db.execute("UPDATE jobs SET state=?, attempts=attempts+1 WHERE id=?", (INFLIGHT, row[0]))
+        return row, None
+
+    def _run(self):
+        while self._running:
+            # 先占在途名额再取小票, 名额满时不会把小票标成在途
+            if not self._slots.acquire(timeout=0.5):
+                continue
+            row, wait = self._claim()
+            if row is None:
+                self._slots.release()
+                self._wake.wait(0.5 if wait is None else min(wait, 0.5))
+                self._wake.clear()
+                continue
+            delay = self.bucket.wait_time()
+            while delay > 0:
+                time.sleep(delay)
+                delay = self.bucket.wait_time()
+            self._executor.submit(self._deliver, self.session, *row)
+
+    def _deliver(self, session, job_id, data, content, attempts):
+        try:
+            try:
+                result = self.send(json.loads(data), content, session=session)
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status in RETRY_STATUS:
+                    self._retry(job_id, attempts + 1, f"HTTP {status}")
+                else:
+                    # 502/504之类: 上游可能已经处理了, 不自动重发
+                    self._finish(job_id, UNKNOWN, f"HTTP {status}")
+                return
+            except ValueError as e:
+                # 2xx但响应不是JSON, 不知道云端处理了没有
+                # (requests的JSONDecodeError也是RequestException, 要先于下面判断)
+                self._finish(job_id, UNKNOWN, f"响应无法解析: {e}")
+                return
+            except requests.exceptions.RequestException as e:
+                if _not_sent(e):
+                    self._retry(job_id, attempts + 1, f"连接失败: {e}")
+                else:
+                    # 请求可能已经发出去了(读超时/连接中途断开), 云端也许已经打了, 不自动重发
+                    self._finish(job_id, UNKNOWN, f"应答丢失: {e}")
+                return
+            if result.get("code") == 0:
+                self._finish(job_id, DONE, None)
+            else:
+                self._retry(job_id, attempts + 1, f"code={result.get('code')} msg={result.get('msg')}")
+        except Exception as e:
+            self._finish(job_id, UNKNOWN, f"发送异常: {e}")
+        finally:
+            self._slots.release()
+
+    def _retry(self, job_id, attempts, error):
+        if attempts >= self.max_attempts:
+            self._finish(job_id, FAILED, error)
+            return
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        delay *= 1 + random.uniform(0, 0.5)
+        with self._lock:
+            db = self._conn()
+            db.execute("UPDATE jobs SET state=?, next_at=?, last_error=? WHERE id=?",
+                       (PENDING, time.time() + delay, error, job_id))
+        self._wake.set()
+
+    def _finish(self, job_id, state, error):
+        with self._lock:
+            db = self._conn()
+            db.execute("UPDATE jobs SET state=?, finished=?, last_error=? WHERE id=?",
+                       (state, time.time(), error, job_id))
@@ -1,7 +1,8 @@
-import requests
 import time
 import hashlib
 
+from http_session import shared_session, close_shared_session
+
 # 开发者配置（替换为自己的信息）
 USER = "1911342262@qq.com"  # 替换为实际用户邮箱
 USER_KEY = "xxx"  # 替换为实际用户密钥
@@ -68,10 +69,11 @@ def get_common_params() -> dict:
         "debug": "0"
     }
 
-def add_printer(printers: list) -> dict:
+def add_printer(printers: list, session=None) -> dict:
     """
     批量添加打印机
     :param printers: 打印机列表，每个元素为包含"sn"和"name"的字典
+    :param session: PooledSession, 不提供则用进程内共用的会话(复用TLS连接)
     :return: 接口返回结果
 
     调用示例
@@ -89,11 +91,13 @@ def add_printer(printers: list) -> dict:
         "items": printers
     })
     # 发送POST请求
-    response = requests.post(url, json=params, headers={"Content-Type": "application/json;charset=UTF-8"})
+    response = (session or shared_session()).post(url, json=params, headers={"Content-Type": "application/json;charset=UTF-8"})
     return response.json()
 
-def xp_print(data: list, content: str) -> dict:
-    
+def xp_print(data: list, content: str, session=None, check_status=False) -> dict:
+    """
+    :param check_status: True时HTTP状态不是2xx抛requests.HTTPError(带response), 给print_spool判断能否重发
+    """
     url = f"{XP_PRINT_URL}"
     params = get_common_params()
 
@@ -102,7 +106,9 @@ def xp_print(data: list, content: str) -> dict:
     # print("打印参数：", params)
 
     # 发送POST请求
-    response = requests.post(url, json=params, headers={"Content-Type": "application/json;charset=UTF-8"})
+    response = (session or shared_session()).post(url, json=params, headers={"Content-Type": "application/json;charset=UTF-8"})
+    if check_status:
+        response.raise_for_status()
     return response.json()
     
 if __name__ == "__main__":
@@ -113,5 +119,8 @@ if __name__ == "__main__":
         "voice": VOICE_MODE_MUTE,
     }
 
-    result = xp_print(data=xp_print_data, content=XP_PRINT_DATA)
-    print("r:", result)
+    try:
+        result = xp_print(data=xp_print_data, content=XP_PRINT_DATA)
+        print("r:", result)
+    finally:
+        close_shared_session()
@@ -0,0 +1,109 @@
+from collections import namedtuple
+from typing import Optional
+
+import sdo_codec
+
+'''
+Kinco RS232 帧: 站号(7F) + 8字节SDO报文 + LRC, 共10字节
+    8字节SDO报文和CANopen快速SDO完全相同, 编解码用sdo_codec(uart/sdo_codec.py是指向can/的软链接)
+    LRC: 10个字节相加为0(mod 256)
+
+KincoFrameParser: 增量解析
+    feed()追加串口读到的任意长度数据, pop()切出下一帧
+    在缓冲区里找站号字节, 够10字节就校验LRC; 校验失败说明这个站号字节不是帧头,
+    跳过它从下一个站号字节重新同步, 不会因为一个坏字节卡住链路
+'''
+
+FRAME_SIZE = 10
+STATION = 0x7F
+# 合法的命令字: 上传应答/下载应答/中止, 以及请求(仿真器解析主站请求时用)
+RESPONSE_COMMANDS = frozenset(list(sdo_codec.UPLOAD_SIZES) + [sdo_codec.DOWNLOAD_ACK, sdo_codec.ABORT])
+REQUEST_COMMANDS = frozenset(list(sdo_codec.DOWNLOAD_COMMANDS.values()) + [sdo_codec.UPLOAD_REQUEST])
+
+# payload: 8字节SDO报文, 可直接交给sdo_codec.decode_upload/check_download
+KincoFrame = namedtuple("KincoFrame", "cmd index sub payload")
+
+
+def lrc(data) -> int:
+    return (256 - sum(data) % 256) & 0xFF
+
+
+def encode_frame(payload: bytes, station: int = STATION) -> bytes:
+    '''8字节SDO报文 -> 10字节RS232帧'''
+    frame = bytes([station]) + payload
+    return frame + bytes([lrc(frame)])
+
+
+class KincoFrameParser:
+    def __init__(self, station: int = STATION, commands=RESPONSE_COMMANDS, capacity: int = 4096):
+        '''
+        commands: 认作帧头的命令字, 主站解析应答用默认值, 仿真器解析请求时传REQUEST_COMMANDS
+        capacity: 缓冲区上限(字节), 超过时丢弃最旧的数据
+        '''
+        self.station = station
+        self.commands = commands
+        self.capacity = capacity
+        # 读指针之前是已经解析掉的数据, 超过一半时一次性删掉, 均摊下来每字节只搬一次
+        self._buf = bytearray()
+        self._pos = 0
+        self.frames = 0
+        self.lrc_errors = 0
+        self.skipped = 0        # 重新同步时丢掉的字节
+        self.overflows = 0      # 缓冲区满丢掉的字节
+
+    def __len__(self):
+        return len(self._buf) - self._pos
+
+    def feed(self, data: bytes):
+        overflow = len(self) + len(data) - self.capacity
+        if overflow > 0:
+            self.overflows += overflow
+            self._pos += overflow
+            self._compact()
+        self._buf += data
+
+    def pop(self) -> Optional[KincoFrame]:
+        '''return: 下一个完整且LRC正确的帧, 数据不够一帧时None'''
+        buf = self._buf
+        pos = self._pos
+        try:
+            while True:
+                start = buf.find(self.station, pos)
+                if start < 0:
+                    self.skipped += len(buf) - pos
+                    pos = len(buf)
+                    return None
+                self.skipped += start - pos
+                pos = start
+                if len(buf) - start < FRAME_SIZE:
+                    return None
+                cmd = buf[start + 1]
+                if cmd in self.commands:
+                    if sum(buf[start:start + FRAME_SIZE]) & 0xFF == 0:
+                        payload = bytes(buf[start + 1:start + FRAME_SIZE - 1])
+                        pos = start + FRAME_SIZE
+                        self.frames += 1
+                        return KincoFrame(cmd, payload[1] | (payload[2] << 8), payload[3], payload)
+                    self.lrc_errors += 1
+                # 不是帧头, 从下一个字节重新找
+                self.skipped += 1
+                pos = start + 1
+        finally:
+            self._pos = pos
+            self._compact()
+
+    def _compact(self):
+        if self._pos >= len(self._buf):
+            self._buf.clear()
+            self._pos = 0
+        elif self._pos > 1024 and self._pos * 2 > len(self._buf):
+            del self._buf[:self._pos]
+            self._pos = 0
+
+    def reset(self):
+        self._buf.clear()
+        self._pos = 0
+
+    def stats(self) -> dict:
+        return {"frames": self.frames, "lrc_errors": self.lrc_errors, "skipped": self.skipped,
+                "overflows": self.overflows, "buffered": len(self)}
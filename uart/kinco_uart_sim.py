@@ -0,0 +1,325 @@
+import heapq
+import logging
+import os
+import pty
+import random
+import threading
+import time
+import tty
+from typing import Dict, List, Optional, Tuple
+
+import sdo_codec
+from kinco_frame import FRAME_SIZE, REQUEST_COMMANDS, KincoFrameParser, encode_frame
+from nmx_lift_uart_device import KincoObject, DEC_PER_RPM
+
+'''
+Kinco RS232 伺服仿真器(伪终端), 不需要实物就能跑 nmx_lift_uart_device.py
+
+    sim = KincoUartSimulator(baudrate=115200).start()
+    config.dev = sim.port                    # 如/dev/pts/5, 驱动按普通串口打开
+    ...
+    sim.stop()
+
+    单独运行, 给别的进程用:
+        python3 kinco_uart_sim.py [波特率]
+
+支持: KincoObject里的对象读写, 梯形速度规划的位置模式运动(控制字bit4上升沿, bit6相对运动),
+      急停(0x0B)/故障复位(0x86), 速度模式
+      按波特率模拟线路时间(每字节10位, 请求和应答都占线路), 驱动器按收到的顺序逐个应答
+      应答延时/抖动, 不应答, 插入噪声字节, 丢字节, 改坏字节(LRC错误)
+'''
+
+ABORT_NO_OBJECT = 0x06020000
+ABORT_READ_ONLY = 0x06010002
+
+SW_OPERATION_ENABLED = 0x0237
+SW_TARGET_REACHED = 0x0400
+SW_FAULT = 0x0008
+INC_PER_REV = 65536
+
+OBJECT_SIZES = {
+    KincoObject.CONTROL_WORD: 2, KincoObject.STATUS_WORD: 2, KincoObject.WORK_MODE: 1,
+    KincoObject.POS_ACTUAL: 4, KincoObject.POS_TARGET: 4, KincoObject.TRAPEZOID_SPEED: 4,
+    KincoObject.SPEED_ACTUAL: 4, KincoObject.SPEED_TARGET: 4,
+    KincoObject.ERROR_CODE1: 2, KincoObject.ERROR_CODE2: 2,
+}
+READ_ONLY = {KincoObject.STATUS_WORD, KincoObject.POS_ACTUAL, KincoObject.SPEED_ACTUAL,
+             KincoObject.ERROR_CODE1, KincoObject.ERROR_CODE2}
+
+
+def to_signed(value: int, bits: int) -> int:
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+
+def dec_to_inc_per_s(dec: int) -> float:
+    '''速度DEC单位 -> inc/s'''
+    return dec / DEC_PER_RPM / 60 * INC_PER_REV
+
+
+class KincoUartSimNode:
+    '''仿真伺服, 方法都在持有KincoUartSimulator.lock时调用'''
+
+    def __init__(self, accel: float = 200.0, position: int = 0):
+        '''accel: 加减速度, 单位rps^2'''
+        self.accel = accel * INC_PER_REV
+        self.position = float(position)
+        self.target = self.position
+        self.velocity = 0.0
+        self.moving = False
+        self.fault = 0
+        self.od: Dict[Tuple[int, int], int] = {obj: 0 for obj in OBJECT_SIZES}
+        self.od[KincoObject.TRAPEZOID_SPEED] = round(200 * DEC_PER_RPM)
+
+    def status_word(self) -> int:
+        word = SW_OPERATION_ENABLED
+        if self.fault:
+            word |= SW_FAULT
+        if not self.moving:
+            word |= SW_TARGET_REACHED
+        return word
+
+    def read(self, key) -> Optional[Tuple[int, int]]:
+        '''return: (值, 长度), 对象不存在返回None'''
+        if key == KincoObject.STATUS_WORD:
+            return self.status_word(), 2
+        if key == KincoObject.POS_ACTUAL:
+            return round(self.position), 4
+        if key == KincoObject.SPEED_ACTUAL:
+            return round(self.velocity / dec_to_inc_per_s(1)), 4
+        if key == KincoObject.ERROR_CODE1:
+            return self.fault & 0xFFFF, 2
+        if key == KincoObject.ERROR_CODE2:
+            return self.fault >> 16, 2
+        if key in OBJECT_SIZES:
+            return self.od[key], OBJECT_SIZES[key]
+        return None
+
+    def write(self, key, value: int) -> Optional[int]:
+        '''return: 中止码, 成功返回None'''
+        if key in READ_ONLY:
+            return ABORT_READ_ONLY
+        if key not in OBJECT_SIZES:
+            return ABORT_NO_OBJECT
+        previous = self.od[key]
+        self.od[key] = value
+        if key == KincoObject.CONTROL_WORD:
+            self.control_word(previous, value)
+        return None
+
+    def control_word(self, previous: int, value: int):
+        if value == 0x86:
+            self.fault = 0
+        elif value == 0x0B:
+            self.moving = False
+            self.velocity = 0.0
+        elif value & 0x10 and not previous & 0x10 and not self.fault:
+            # bit4上升沿: 接受新的目标位置, bit6: 相对当前位置
+            if self.od[KincoObject.WORK_MODE] == 1:
+                target = to_signed(self.od[KincoObject.POS_TARGET], 32)
+                self.target = self.position + target if value & 0x40 else float(target)
+                self.moving = True
+
+    def inject_fault(self, code: int):
+        self.fault = code
+        self.moving = False
+        self.velocity = 0.0
+
+    def step(self, dt: float):
+        mode = self.od[KincoObject.WORK_MODE]
+        if mode == 3 and not self.fault and self.od[KincoObject.CONTROL_WORD] & 0x0F == 0x0F:
+            self.velocity = dec_to_inc_per_s(to_signed(self.od[KincoObject.SPEED_TARGET], 32))
+            self.position += self.velocity * dt
+            return
+        if not self.moving:
+            return
+        v_max = abs(dec_to_inc_per_s(to_signed(self.od[KincoObject.TRAPEZOID_SPEED], 32)))
+        distance = self.target - self.position
+        direction = 1.0 if distance > 0 else -1.0
+        speed = abs(self.velocity)
+        if abs(distance) <= speed * speed / (2 * self.accel):
+            speed = max(speed - self.accel * dt, 0.0)
+        else:
+            speed = min(speed + self.accel * dt, v_max)
+        self.velocity = direction * speed
+        moved = self.velocity * dt
+        if abs(moved) >= abs(distance) or (speed == 0.0 and abs(distance) < 1.0):
+            self.position = self.target
+            self.velocity = 0.0
+            self.moving = False
+        else:
+            self.position += moved
+
+
+class KincoUartSimulator:
+    def __init__(self, baudrate: int = 115200, latency: float = 0.0005, jitter: float = 0.0,
+                 drop_rate: float = 0.0, noise_rate: float = 0.0, drop_byte_rate: float = 0.0,
+                 corrupt_rate: float = 0.0, tick: float = 0.001):
+        '''
+        baudrate:       模拟的线路速率, 0时不模拟线路时间
+        latency/jitter: 驱动器处理一个请求的时间和随机抖动, 单位秒
+        drop_rate:      请求不应答的概率
+        noise_rate:     应答前插入1~4个随机字节的概率
+        drop_byte_rate: 应答丢掉一个字节的概率
+        corrupt_rate:   应答改坏一个字节(LRC错误)的概率
+        tick:           运动仿真步长, 单位秒
+        '''
+        self.node = KincoUartSimNode()
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.noise_rate = noise_rate
+        self.drop_byte_rate = drop_byte_rate
+        self.corrupt_rate = corrupt_rate
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.port: Optional[str] = None
+        self._master: Optional[int] = None
+        self._slave: Optional[int] = None
+        self._parser = KincoFrameParser(commands=REQUEST_COMMANDS)
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        self._wake = threading.Condition(self.lock)
+        # 待发的应答: (发出时刻, 序号, 数据)
+        self._outgoing: List[Tuple[float, int, bytes]] = []
+        self._seq = 0
+        self._rx_line_free = 0.0    # 接收线路上一个请求收完的时刻
+        self._busy_until = 0.0      # 驱动器处理完上一个请求的时刻
+        self._line_free = 0.0       # 发送线路空闲的时刻
+        self.requests = 0
+        self.replies = 0
+
+    def byte_time(self, count: int) -> float:
+        return count * 10 / self.baudrate if self.baudrate else 0.0
+
+    def start(self):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._threads = [threading.Thread(target=target, name=name, daemon=True)
+                         for target, name in ((self._read_loop, "kinco-uart-sim-rx"),
+                                              (self._write_loop, "kinco-uart-sim-tx"),
+                                              (self._motion_loop, "kinco-uart-sim"))]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        with self.lock:
+            self._wake.notify_all()
+        # 关闭从端让读线程的os.read返回
+        for fd in (self._slave, self._master):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        for thread in self._threads:
+            thread.join(1.0)
+        self._slave = self._master = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def inject_fault(self, code: int = 0x0001):
+        with self.lock:
+            self.node.inject_fault(code)
+
+    # ------------------------- 收发 ------------------------
+    def _read_loop(self):
+        while self._running:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            arrived = time.monotonic()
+            self._parser.feed(data)
+            while True:
+                frame = self._parser.pop()
+                if frame is None:
+                    break
+                self._on_request(frame.payload, arrived)
+
+    def _on_request(self, payload: bytes, arrived: float):
+        self.requests += 1
+        if self.drop_rate and random.random() < self.drop_rate:
+            return
+        cmd, index, sub, value, size = sdo_codec.decode_request(payload)
+        key = (index, sub)
+        with self.lock:
+            if cmd == sdo_codec.UPLOAD_REQUEST:
+                result = self.node.read(key)
+                response = (sdo_codec.encode_abort(index, sub, ABORT_NO_OBJECT) if result is None
+                            else sdo_codec.encode_upload_response(index, sub, *result))
+            else:
+                abort = self.node.write(key, value)
+                response = (sdo_codec.encode_download_ack(index, sub) if abort is None
+                            else sdo_codec.encode_abort(index, sub, abort))
+            # pty上一批请求是一下子到的, 按线路速率补上每个请求在线上的时间, 驱动器逐个处理
+            self._rx_line_free = max(arrived, self._rx_line_free) + self.byte_time(FRAME_SIZE)
+            delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+            self._busy_until = max(self._rx_line_free, self._busy_until) + delay
+            data = self._damage(encode_frame(response))
+            due = max(self._busy_until, self._line_free) + self.byte_time(len(data))
+            self._line_free = due
+            self._seq += 1
+            heapq.heappush(self._outgoing, (due, self._seq, data))
+            self._wake.notify()
+
+    def _damage(self, frame: bytes) -> bytes:
+        data = bytearray(frame)
+        if self.corrupt_rate and random.random() < self.corrupt_rate:
+            data[random.randrange(1, len(data))] ^= 1 << random.randrange(8)
+        if self.drop_byte_rate and random.random() < self.drop_byte_rate:
+            del data[random.randrange(len(data))]
+        if self.noise_rate and random.random() < self.noise_rate:
+            data[0:0] = os.urandom(random.randint(1, 4))
+        return bytes(data)
+
+    def _write_loop(self):
+        with self.lock:
+            while self._running:
+                if not self._outgoing:
+                    self._wake.wait()
+                    continue
+                due, _, data = self._outgoing[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._wake.wait(wait)
+                    continue
+                heapq.heappop(self._outgoing)
+                try:
+                    os.write(self._master, data)
+                except OSError:
+                    return
+                self.replies += 1
+
+    def _motion_loop(self):
+        next_tick = time.monotonic()
+        while self._running:
+            with self.lock:
+                self.node.step(self.tick)
+            next_tick += self.tick
+            time.sleep(max(next_tick - time.monotonic(), 0))
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    baudrate = int(sys.argv[1]) if len(sys.argv) > 1 else 115200
+    with KincoUartSimulator(baudrate=baudrate) as sim:
+        logging.info(f"Kinco RS232仿真器运行中: {sim.port} {baudrate}bps, Ctrl+C退出")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
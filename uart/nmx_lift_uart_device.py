@@ -1,15 +1,124 @@
-from typing import List
+from collections import deque
+from typing import List, Optional, Tuple
 
 import serial
 import logging
+import select
+import time
+
+try:
+    from nmxrdk import LiftDevice
+except ImportError:
+    # 开发机上没有nmxrdk, 只用KincoRS232Controller或跑仿真器(kinco_uart_sim.py)时不需要
+    LiftDevice = object
+
+import sdo_codec
+import txn_stats
+from kinco_frame import FRAME_SIZE, KincoFrame, KincoFrameParser, encode_frame
+from sdo_codec import SdoAbortError, SdoError, SdoTimeoutError
+from serial_worker import SerialWorker, PRIORITY_NORMAL, PRIORITY_STOP
+
+
+class KincoObject:
+    '''对象字典条目: (index, subindex), 和CAN版一致'''
+    CONTROL_WORD = (0x6040, 0x00)
+    STATUS_WORD = (0x6041, 0x00)
+    WORK_MODE = (0x6060, 0x00)
+    POS_ACTUAL = (0x6063, 0x00)             # 实际位置
+    POS_TARGET = (0x607A, 0x00)             # 目标位置
+    TRAPEZOID_SPEED = (0x6081, 0x00)        # 梯形速度
+    SPEED_ACTUAL = (0x606C, 0x00)           # 实际速度
+    SPEED_TARGET = (0x60FF, 0x00)           # 目标速度
+    ERROR_CODE1 = (0x2601, 0x00)
+    ERROR_CODE2 = (0x2602, 0x00)
+
+
+DEC_PER_RPM = 512 * 65536 / 1875    # DEC=[(RPM*512*编码器分辨率)/1875]
+# 同时在途的请求数上限; 驱动器按顺序处理, 多发几帧可以省掉中间的往返等待
+# 驱动器接收缓冲区不够时会丢帧, 可用config.max_in_flight调小
+MAX_IN_FLIGHT = 8
+# read_status读的对象, 位置和速度有符号
+STATUS_OBJECTS = [(*KincoObject.POS_ACTUAL, True), (*KincoObject.SPEED_ACTUAL, True),
+                  KincoObject.STATUS_WORD, KincoObject.ERROR_CODE1, KincoObject.ERROR_CODE2]
+
+
+class _Pipeline:
+    '''
+    一批流水线请求的发送窗口和应答匹配, 不做I/O
+    阻塞收发(KincoRS232Controller._transact)和事件循环(serial_loop.py)共用
+        最多max_in_flight个请求在途, 应答按index/sub匹配在途请求中最早的一个
+        驱动器按顺序应答, 收到后面请求的应答时, 排在前面还没应答的请求就是丢了, 不再等它
+    '''
+
+    def __init__(self, payloads: List[bytes], max_in_flight: int):
+        self.payloads = payloads
+        self.max_in_flight = max_in_flight
+        # [(应答帧或None, 耗时秒)], 和payloads一一对应
+        self.results: List[Tuple[Optional[KincoFrame], float]] = [(None, 0.0)] * len(payloads)
+        self._sent_at = [0.0] * len(payloads)
+        self._outstanding: deque = deque()      # 在途请求(slot, index, sub), 按发送顺序
+        self._next_send = 0
+
+    @property
+    def done(self) -> bool:
+        return self._next_send >= len(self.payloads) and not self._outstanding
+
+    def fill(self) -> bytes:
+        '''return: 窗口里能补发的请求帧, 拼在一起一次write'''
+        burst = bytearray()
+        now = time.perf_counter()
+        while self._next_send < len(self.payloads) and len(self._outstanding) < self.max_in_flight:
+            payload = self.payloads[self._next_send]
+            self._outstanding.append((self._next_send, payload[1] | (payload[2] << 8), payload[3]))
+            burst += encode_frame(payload)
+            self._sent_at[self._next_send] = now
+            self._next_send += 1
+        return bytes(burst)
+
+    def on_frame(self, frame: KincoFrame) -> bool:
+        '''return: 是否匹配上在途请求, 没匹配上的帧(迟到的应答等)丢掉'''
+        for position, (slot, index, sub) in enumerate(self._outstanding):
+            if index == frame.index and sub == frame.sub:
+                break
+        else:
+            logging.debug(f"丢弃不匹配的应答: {frame.payload.hex()}")
+            return False
+        now = time.perf_counter()
+        for _ in range(position):
+            lost, _, _ = self._outstanding.popleft()
+            self.results[lost] = (None, now - self._sent_at[lost])
+        self._outstanding.popleft()
+        self.results[slot] = (frame, now - self._sent_at[slot])
+        return True
+
+    def expire(self):
+        '''超时: 没等到的和还没发的都是None'''
+        now = time.perf_counter()
+        for slot, _, _ in self._outstanding:
+            self.results[slot] = (None, now - self._sent_at[slot])
+        self._outstanding.clear()
+        self._next_send = len(self.payloads)
 
-import nmxrdk
 
 class KincoRS232Controller:
     def __init__(self, config):
         self.config = config
         self.ser = None
-        self.recv_buffer = b""
+        # 串口收到的字节先进解析器, 按帧取出(见kinco_frame.py)
+        self.parser = KincoFrameParser()
+        self.max_in_flight = getattr(config, "max_in_flight", MAX_IN_FLIGHT)
+        # 事务统计插件(见txn_stats.py), 为空时不计时
+        self.instruments = ()
+
+    def add_instrument(self, instrument):
+        self.instruments = self.instruments + (instrument,)
+
+    def remove_instrument(self, instrument):
+        self.instruments = tuple(i for i in self.instruments if i is not instrument)
+
+    def _record(self, index, seconds, outcome):
+        for instrument in self.instruments:
+            instrument.on_transaction(self.config.dev, index, seconds, outcome)
 
     def init(self):
         logging.info(f"Open Kinco RS232 on {self.config.dev} at {self.config.baudrate}")
@@ -22,121 +131,233 @@ class KincoRS232Controller:
             timeout=0.5,
         )
 
-    def _execute(self, hex_cmd):
-        self.ser.write(bytes.fromhex(hex_cmd))
-        return "recv"
+    # ------------------------- 收帧 ------------------------
+    def _fill(self, timeout: float) -> bool:
+        '''
+        把串口里已经到的字节一次读进解析器; 一个都没有时最多等timeout秒
+        (select等串口可读, 不受ser.timeout限制, 也不用每次改ser.timeout重新配置串口)
+        return: 是否读到数据
+        '''
+        waiting = self.ser.in_waiting
+        if not waiting:
+            if not select.select([self.ser.fileno()], [], [], timeout)[0]:
+                return False
+            waiting = self.ser.in_waiting or 1
+        data = self.ser.read(waiting)
+        if data:
+            self.parser.feed(data)
+        return bool(data)
+
+    def read_frame(self, timeout=None) -> Optional[KincoFrame]:
+        '''
+        取下一个LRC正确的帧(任意类型), timeout为None时用串口的超时
+        return: KincoFrame, 超时None
+        '''
+        deadline = time.monotonic() + (self.ser.timeout if timeout is None else timeout)
+        while True:
+            frame = self.parser.pop()
+            if frame is not None:
+                return frame
+            if not self._fill(max(deadline - time.monotonic(), 0)) and time.monotonic() >= deadline:
+                return None
+
+    def flush_input(self):
+        '''丢掉串口和解析器里残留的字节: 上一批超时后迟到的应答不能被当成新请求的应答'''
+        self.ser.reset_input_buffer()
+        self.parser.reset()
+
+    # ------------------------- 请求/应答 ------------------------
+    def _transact(self, payloads: List[bytes], timeout=None) -> List[Tuple[Optional[KincoFrame], float]]:
+        '''
+        流水线收发(见_Pipeline), 子类可以换成别的I/O方式(如serial_loop.py的事件循环)
+        timeout: 连续这么久收不到应答就放弃剩下的请求(默认串口超时)
+        return: [(应答帧或None, 耗时秒)], 和payloads一一对应
+        '''
+        timeout = self.ser.timeout if timeout is None else timeout
+        self.flush_input()
+        pipeline = _Pipeline(payloads, self.max_in_flight)
+        deadline = time.monotonic() + timeout
+        while True:
+            burst = pipeline.fill()
+            if burst:
+                self.ser.write(burst)
+            if pipeline.done:
+                return pipeline.results
+            frame = self.read_frame(max(deadline - time.monotonic(), 0))
+            if frame is None:
+                pipeline.expire()
+                return pipeline.results
+            if pipeline.on_frame(frame):
+                deadline = time.monotonic() + timeout
+
+    def _check(self, index, sub, frame, seconds, decode, lrc_seen=False):
+        '''
+        解析应答并记录统计, 失败抛SdoTimeoutError/SdoAbortError(都是SdoError)
+        lrc_seen: 这批请求期间出现过LRC错误, 超时多半是应答坏了而不是没应答
+        '''
+        try:
+            if frame is None:
+                raise SdoTimeoutError(index, sub, 1)
+            value = decode(frame.payload)
+        except SdoError as e:
+            if self.instruments:
+                if isinstance(e, SdoTimeoutError):
+                    outcome = txn_stats.LRC if lrc_seen else txn_stats.TIMEOUT
+                else:
+                    outcome = txn_stats.ABORT if isinstance(e, SdoAbortError) else txn_stats.ERROR
+                self._record(index, seconds, outcome)
+            raise
+        if self.instruments:
+            self._record(index, seconds, txn_stats.OK)
+        return value
+
+    def sdo_read_many(self, objs) -> List[int]:
+        '''
+        流水线读多个对象, objs: [(index, sub)或(index, sub, signed)]
+        return: 值列表; 有失败时整批读完后抛第一个错误
+        '''
+        lrc_errors = self.parser.lrc_errors
+        results = self._transact([sdo_codec.encode_upload(obj[0], obj[1]) for obj in objs])
+        return self._read_values(objs, results, self.parser.lrc_errors != lrc_errors)
+
+    def _read_values(self, objs, results, lrc_seen=False) -> List[int]:
+        '''解析一批读应答, 有失败时抛第一个错误'''
+        values = []
+        error = None
+        for obj, (frame, seconds) in zip(objs, results):
+            signed = obj[2] if len(obj) > 2 else False
+            try:
+                values.append(self._check(obj[0], obj[1], frame, seconds,
+                                          lambda payload: sdo_codec.decode_upload(payload, signed), lrc_seen))
+            except SdoError as e:
+                logging.error(f"读伺服数据失败: {e}")
+                error = error or e
+                values.append(None)
+        if error is not None:
+            raise error
+        return values
+
+    def sdo_write_many(self, writes) -> bool:
+        '''
+        流水线写多个对象, 驱动器按发送顺序执行(控制字的上升沿顺序不会乱)
+        writes: [(index, sub, value, size)]
+        有失败时整批应答收完后抛第一个错误
+        '''
+        lrc_errors = self.parser.lrc_errors
+        results = self._transact([sdo_codec.encode_download(*write) for write in writes])
+        lrc_seen = self.parser.lrc_errors != lrc_errors
+        error = None
+        for (index, sub, _, _), (frame, seconds) in zip(writes, results):
+            try:
+                self._check(index, sub, frame, seconds, sdo_codec.check_download, lrc_seen)
+            except SdoError as e:
+                logging.error(f"写伺服数据失败: {e}")
+                error = error or e
+        if error is not None:
+            raise error
+        return True
+
+    def sdo_read(self, index, sub, signed=False) -> int:
+        '''失败抛SdoTimeoutError/SdoAbortError(都是SdoError)'''
+        return self.sdo_read_many([(index, sub, signed)])[0]
+
+    def sdo_write(self, index, sub, value, size) -> bool:
+        '''size: 1/2/4字节, 失败抛SdoTimeoutError/SdoAbortError(都是SdoError)'''
+        return self.sdo_write_many([(index, sub, value, size)])
+
+    def _execute(self, hex_cmd) -> bool:
+        '''发送一条完整的十六进制命令(含站号和LRC)并等应答, 失败抛SdoError'''
+        cmd = bytes.fromhex(hex_cmd)
+        if len(cmd) != FRAME_SIZE or self.calc_lrc(cmd[:-1]) != cmd[-1]:
+            raise ValueError(f"命令格式或LRC错误: {hex_cmd}")
+        payload = cmd[1:-1]
+        decode = sdo_codec.decode_upload if payload[0] == sdo_codec.UPLOAD_REQUEST else sdo_codec.check_download
+        (frame, seconds), = self._transact([payload])
+        self._check(payload[1] | (payload[2] << 8), payload[3], frame, seconds, decode)
+        return True
+
+    # ------------------------- 暴露 ------------------------
+    def set_control_word(self, value):
+        return self.sdo_write(*KincoObject.CONTROL_WORD, value, 2)
 
     def set_control_word_2F(self):
-        cmd = "7F2B4060002F00000087"
-        return self._execute(cmd)
+        return self.set_control_word(0x2F)
 
     def set_control_word_3F(self):
-        cmd = "7F2B4060003F00000077"
-        return self._execute(cmd)
+        return self.set_control_word(0x3F)
 
     def set_control_word_4F(self):
-        cmd = "7F2B4060004F00000067"
-        return self._execute(cmd)
+        return self.set_control_word(0x4F)
 
     def set_control_word_5F(self):
-        cmd = "7F2B4060005F00000057"
-        return self._execute(cmd)
+        return self.set_control_word(0x5F)
 
     def set_control_word_103F(self):
-        cmd = "7F2B4060003F10000067"
-        return self._execute(cmd)
+        return self.set_control_word(0x103F)
 
     def set_control_word_06(self):
-        cmd = "7F2B40600006000000B0"
-        return self._execute(cmd)
+        return self.set_control_word(0x06)
+
+    def quick_stop(self):
+        '''急停'''
+        return self.set_control_word(0x0B)
 
     def set_operation_mode_pos(self):
-        cmd = "7F2F6060000100000091"
-        return self._execute(cmd)
+        return self.sdo_write(*KincoObject.WORK_MODE, 0x01, 1)
 
     def set_operation_mode_speed(self):
-        cmd = "7F2F606000030000008F"
-        return self._execute(cmd)
+        return self.sdo_write(*KincoObject.WORK_MODE, 0x03, 1)
 
     def set_target_position_0(self):
-        cmd = "7F237A60000000000084"
-        return self._execute(cmd)
+        return self.set_target_position(0)
 
     def set_target_position_3584000(self):
-        cmd = "7F237A600000b6360098"
-        return self._execute(cmd)
+        # 沿用原命令里的值(0x36B600)
+        return self.set_target_position(0x36B600)
 
     def set_target_position(self, pos):
-        pos_bytes = pos.to_bytes(4, byteorder="little", signed=True)
-        cmd = [0x7F, 0x23, 0x7A, 0x60, 0x00] + list(pos_bytes)
-        cmd.append(self.calc_lrc(cmd))
-        self.ser.write(bytes(cmd))
+        return self.sdo_write(*KincoObject.POS_TARGET, pos, 4)
 
     def set_trapezoid_speed_200(self):
-        cmd = "7F23816000039D3600A7"
-        return self._execute(cmd)
+        return self.set_trapezoid_speed(200)
 
     def set_trapezoid_speed(self, speed):
-        target_speed = speed * 512 * 65536 / 1875
-        speed_hex = int(target_speed) & 0xFFFFFFFF
-        speed_bytes = speed_hex.to_bytes(4, byteorder="little")
-        cmd = [0x7F, 0x23, 0x81, 0x60, 0x00] + list(speed_bytes)
-        cmd.append(self.calc_lrc(cmd))
-        self.ser.write(bytes(cmd))
+        '''speed: 单位rpm'''
+        return self.sdo_write(*KincoObject.TRAPEZOID_SPEED, int(speed * DEC_PER_RPM), 4)
 
     def set_target_speed_0(self):
-        cmd = "7F23FF600000000000FF"
-        return self._execute(cmd)
+        return self.set_target_speed(0)
 
     def set_target_speed_r100(self):
-        cmd = "7F23FF60007EB1E4FFED"
-        return self._execute(cmd)
+        # 沿用原命令里的值(-100rpm取整后的DEC)
+        return self.sdo_write(*KincoObject.SPEED_TARGET, -1789570, 4)
 
     def set_target_speed(self, speed):
-        target_speed = int(speed * 512 * 65536 / 1875)
-        speed_bytes = target_speed.to_bytes(4, byteorder="little", signed=True)
-        cmd = [0x7F, 0x23, 0xFF, 0x60, 0x00] + list(speed_bytes)
-        cmd.append(self.calc_lrc(cmd))
-        self.ser.write(bytes(cmd))
+        '''speed: 单位rpm'''
+        return self.sdo_write(*KincoObject.SPEED_TARGET, int(speed * DEC_PER_RPM), 4)
 
-    def read_frame(self):
-        while True:
-            frame = b""
-            datastart = self.ser.read(1)
-            if not datastart:
-                break
-            if datastart == b"\x7f":
-                data1 = self.ser.read(1)
-                data2 = self.ser.read(1)
-                if not data1 or not data2:
-                    break
-                if data1[0] == 0x43 and data2[0] == 0x63:
-                    frame += datastart + data1 + data2
-                    temp = self.ser.read(7)
-                    if len(temp) < 7:
-                        break
-                    frame += temp
-                    return frame
-        return b""
+    def move_to(self, pos, start=0x2F, trigger=0x3F):
+        '''目标位置 + 控制字上升沿一次发出, 一个往返完成'''
+        return self.sdo_write_many([(*KincoObject.POS_TARGET, pos, 4),
+                                    (*KincoObject.CONTROL_WORD, start, 2),
+                                    (*KincoObject.CONTROL_WORD, trigger, 2)])
 
     def get_position(self) -> int:
-        cmd = "7F40636000000000007E"
+        '''return: 单位inc, 失败-1'''
+        try:
+            return self.sdo_read(*KincoObject.POS_ACTUAL, signed=True)
+        except SdoError:
+            return -1
 
-        self.ser.write(bytes.fromhex(cmd))
+    def read_status(self) -> dict:
+        '''位置/速度/状态字/错误码流水线读, 约一个串口往返, 原始单位'''
+        return self._status(self.sdo_read_many(STATUS_OBJECTS))
 
-        frame = self.read_frame()
-        response = frame.hex()
-        if response[0:2] != "7f" or response[2:4] != "43" or response[4:6] != "63":
-            return -1
-        data = response[10:18]
-        value = int.from_bytes(bytes.fromhex(data), byteorder="little", signed=True)
-        lrc_recv = int(response[18:20], 16)
-        lrc_calc = self.calc_lrc(
-            [int(response[i : i + 2], 16) for i in range(0, 18, 2)]
-        )
-        if lrc_recv == lrc_calc:
-            return value
-        return -1
+    @staticmethod
+    def _status(values) -> dict:
+        position, speed, status_word, err1, err2 = values
+        return {"position": position, "speed": speed, "status_word": status_word,
+                "err": (err2 << 16) | err1}
 
     # http://www.ip33.com/lrc.html
     def calc_lrc(self, cmd_bytes):
@@ -145,17 +366,43 @@ class KincoRS232Controller:
         lrc = (256 - mod) & 0xFF
         return lrc
 
-class NmxLiftDevice(nmxrdk.LiftDevice):
-    def __init__(self, config):
+class NmxLiftDevice(LiftDevice):
+    def __init__(self, config, loop=None):
+        '''
+        loop: serial_loop.SerialLoop, 多路串口共用一个事件循环线程;
+              None时这个口单独一个I/O线程(见serial_worker.py)
+        两种方式下串口都只由一个线程读写, 多个线程同时调用也不会串帧
+        '''
         self.config = config
+        self.loop = loop
         self.ctrl = None
+        self.io: Optional[SerialWorker] = None
 
     def init(self, config):
         # TODO 86 清除错误
-        self.ctrl = KincoRS232Controller(self.config)
-        self.ctrl.init()
-        self.ctrl.set_operation_mode_pos()
-        self.ctrl.set_trapezoid_speed(200)
+        if self.loop is not None:
+            self.ctrl = self.loop.add_port(self.config)
+        else:
+            self.ctrl = KincoRS232Controller(self.config)
+            self.ctrl.init()
+            self.io = SerialWorker(self.ctrl)
+            self.io.start()
+        self._call(lambda ctrl: ctrl.set_operation_mode_pos() and ctrl.set_trapezoid_speed(200))
+
+    def _call(self, command, priority=PRIORITY_NORMAL):
+        if self.io is None:
+            # 事件循环: 控制器本身线程安全, 急停由SelectorRS232Controller.quick_stop插队
+            return command(self.ctrl)
+        return self.io.call(command, priority)
+
+    def Close(self):
+        if self.io is not None:
+            self.io.stop()
+            self.io = None
+        if self.loop is not None and self.ctrl is not None:
+            self.ctrl.close()
+        elif self.ctrl is not None and self.ctrl.ser is not None:
+            self.ctrl.ser.close()
 
     def up(self, speed: float = 30, duration: float = 0.5):
         """升降机构上升
@@ -163,9 +410,7 @@ class NmxLiftDevice(nmxrdk.LiftDevice):
             speed: 速度百分比，0~100
             duration: 运动时间，单位：秒
         """
-        self.ctrl.set_target_position(178400)
-        self.ctrl.set_control_word_4F()
-        self.ctrl.set_control_word_5F()
+        self._call(lambda ctrl: ctrl.move_to(178400, 0x4F, 0x5F))
 
     def down(self, speed: float = 30, duration: float = 0.5):
         """升降机构下降
@@ -173,13 +418,11 @@ class NmxLiftDevice(nmxrdk.LiftDevice):
             speed: 速度百分比，0~100
             duration: 运动时间，单位：秒
         """
-        self.ctrl.set_target_position(-178400)
-        self.ctrl.set_control_word_4F()
-        self.ctrl.set_control_word_5F()
+        self._call(lambda ctrl: ctrl.move_to(-178400, 0x4F, 0x5F))
 
     def stop(self):
-        """停止升降机构运动"""
-        pass
+        """停止升降机构运动, 排在所有未执行的命令前面"""
+        self._call(lambda ctrl: ctrl.quick_stop(), priority=PRIORITY_STOP)
 
     def get_height(self) -> List[float]:
         """获取升降机构当前高度
@@ -187,7 +430,7 @@ class NmxLiftDevice(nmxrdk.LiftDevice):
             float: 当前高度，单位m
         """
         h = [0.0, 0.0]
-        pos = self.ctrl.get_position()
+        pos = self._call(lambda ctrl: ctrl.get_position())
         if pos < 0:
             return [-1, -1]
         else:
@@ -199,6 +442,12 @@ class NmxLiftDevice(nmxrdk.LiftDevice):
         Args:
             height: 目标高度，单位m
         """
-        self.ctrl.set_target_position(int(height * 1000 * 3584000.0 / 500))
-        self.ctrl.set_control_word_2F()
-        self.ctrl.set_control_word_3F()
+        pos = int(height * 1000 * 3584000.0 / 500)
+        self._call(lambda ctrl: ctrl.move_to(pos))
+
+
+class UartConfig:
+    def __init__(self):
+        self.dev = "/dev/ttyUSB0"    # 串口设备, 仿真时用KincoUartSimulator.port
+        self.baudrate = 115200
+        self.max_in_flight = MAX_IN_FLIGHT  # 流水线在途请求数上限
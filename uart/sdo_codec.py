@@ -0,0 +1 @@
+../can/sdo_codec.py
\ No newline at end of file
@@ -0,0 +1,328 @@
+import logging
+import os
+import selectors
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+import serial
+
+import sdo_codec
+from nmx_lift_uart_device import KincoRS232Controller, KincoObject, STATUS_OBJECTS, _Pipeline
+from sdo_codec import SdoError
+
+'''
+一个线程驱动多路RS232升降电机(6~12个USB串口)
+
+    每个串口一个KincoRS232Controller + 一个线程时, 每个线程各自阻塞在自己的串口超时上
+    这里所有串口的fd登记到同一个selectors(Linux上是epoll), 一个线程按事件推进各口的请求批次:
+        可读 -> 读进该口的解析器, 按index/sub匹配在途请求(_Pipeline)
+        窗口有空位 -> 补发请求
+        最近的超时时刻作为select的超时
+    各口之间互不等待, 多口的状态读是并行的
+
+    loop = SerialLoop().start()
+    devices = {dev: NmxLiftDevice(config, loop=loop) for dev, config in configs.items()}
+    for device in devices.values():
+        device.init(None)
+    loop.read_status_all()                   # {dev: 状态dict或None}, 约一个串口往返
+    loop.stop()
+
+SelectorRS232Controller和KincoRS232Controller的接口完全一样(sdo_read/read_status/move_to...),
+可以在任意线程调用; 同一个口的请求批次按提交顺序执行, 一批里的多帧不会被别的批次插入
+不能在事件循环线程里(比如Future回调中)调用阻塞接口, 会死锁
+'''
+
+
+class SelectorRS232Controller(KincoRS232Controller):
+    def __init__(self, config, loop: "SerialLoop"):
+        super().__init__(config)
+        self.loop = loop
+        self.timeout = 0.5
+        # 以下只在事件循环线程里访问
+        self._batches: deque = deque()      # 等待执行的(payloads, timeout, Future)
+        self._pipeline: Optional[_Pipeline] = None
+        self._future: Optional[Future] = None
+        self._batch_timeout = 0.0
+        self.deadline: Optional[float] = None
+
+    def init(self):
+        logging.info(f"Open Kinco RS232 on {self.config.dev} at {self.config.baudrate} (selector)")
+        # 非阻塞读, 读多少由事件循环决定
+        self.ser = serial.Serial(port=self.config.dev, baudrate=self.config.baudrate,
+                                 bytesize=8, parity="N", stopbits=1, timeout=0)
+        self.loop.register(self)
+
+    def close(self):
+        if self.ser is not None:
+            self.loop.unregister(self)
+
+    # ------------------------- 提交 ------------------------
+    def submit(self, payloads: List[bytes], timeout: Optional[float] = None, urgent: bool = False) -> Future:
+        '''
+        非阻塞提交一批请求
+        urgent: 排到这个口所有未开始的批次前面(急停)
+        return: Future[[(应答帧或None, 耗时秒)]]
+        '''
+        future: Future = Future()
+        if not self.loop.running:
+            future.set_exception(SdoError("串口事件循环没有运行"))
+            return future
+        batch = (payloads, self.timeout if timeout is None else timeout, future)
+        self.loop.call_soon(lambda: self._enqueue(batch, urgent), future)
+        return future
+
+    def _transact(self, payloads: List[bytes], timeout=None):
+        return self.submit(payloads, timeout).result()
+
+    def quick_stop(self):
+        '''急停, 排在这个口所有未发出的批次前面'''
+        (frame, seconds), = self.submit([sdo_codec.encode_download(*KincoObject.CONTROL_WORD, 0x0B, 2)],
+                                        urgent=True).result()
+        self._check(*KincoObject.CONTROL_WORD, frame, seconds, sdo_codec.check_download)
+        return True
+
+    # ------------------------- 事件循环线程 ------------------------
+    def _enqueue(self, batch, urgent: bool):
+        if self.loop.controllers.get(self.config.dev) is not self:
+            batch[2].set_exception(SdoError(f"串口{self.config.dev}没有登记或已关闭"))
+            return
+        if urgent:
+            self._batches.appendleft(batch)
+        else:
+            self._batches.append(batch)
+        if self._pipeline is None:
+            self._next_batch()
+
+    def _next_batch(self):
+        while self._batches:
+            payloads, timeout, future = self._batches.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            # 和同步版_transact一样, 每批从干净的缓冲区开始
+            try:
+                self.flush_input()
+            except Exception as e:
+                logging.error(f"清空串口{self.config.dev}失败: {e}")
+            self._pipeline = _Pipeline(payloads, self.max_in_flight)
+            self._future = future
+            self._batch_timeout = timeout
+            self.deadline = time.monotonic() + timeout
+            self._pump()
+            return
+        self._pipeline = self._future = self.deadline = None
+
+    def _pump(self):
+        '''补发请求, 批次完成时交付结果并开始下一批'''
+        pipeline = self._pipeline
+        try:
+            burst = pipeline.fill()
+            if burst:
+                self.ser.write(burst)
+        except Exception as e:
+            logging.error(f"写串口{self.config.dev}失败: {e}")
+            pipeline.expire()
+        if pipeline.done:
+            self._future.set_result(pipeline.results)
+            self._next_batch()
+
+    def on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except Exception as e:
+            logging.error(f"读串口{self.config.dev}失败: {e}")
+            return
+        self.parser.feed(data)
+        while True:
+            frame = self.parser.pop()
+            if frame is None:
+                return
+            if self._pipeline is None:
+                logging.debug(f"丢弃空闲时收到的帧: {frame.payload.hex()}")
+            elif self._pipeline.on_frame(frame):
+                self.deadline = time.monotonic() + self._batch_timeout
+                self._pump()
+
+    def on_timeout(self):
+        self._pipeline.expire()
+        self._pump()
+
+    def fail_pending(self, error: Exception):
+        '''关闭时: 执行中和排队的批次都以error结束'''
+        futures = [future for _, _, future in self._batches]
+        if self._future is not None:
+            futures.append(self._future)
+        self._batches.clear()
+        self._pipeline = self._future = self.deadline = None
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+
+class SerialLoop:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.controllers: Dict[str, SelectorRS232Controller] = {}
+        self._callbacks: deque = deque()     # (callback, 对应的Future或None)
+        self._lock = threading.Lock()
+        self._closed = False
+        # 其他线程提交请求时写一个字节唤醒select
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="serial-loop", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._wake()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        # 循环退出时还没执行的回调不会再执行, 等结果的Future以错误结束, 不让调用方永远等下去
+        with self._lock:
+            self._closed = True
+            callbacks, self._callbacks = self._callbacks, deque()
+        for _, future in callbacks:
+            self._fail_stopped(future)
+        for controller in list(self.controllers.values()):
+            self._remove(controller)
+        self.selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def add_port(self, config) -> SelectorRS232Controller:
+        '''打开串口并登记, return: 这个口的控制器'''
+        controller = SelectorRS232Controller(config, self)
+        controller.init()
+        return controller
+
+    def register(self, controller: SelectorRS232Controller):
+        self._call_and_wait(lambda: self._add(controller))
+
+    def unregister(self, controller: SelectorRS232Controller):
+        self._call_and_wait(lambda: self._remove(controller))
+
+    def _call_and_wait(self, callback: Callable):
+        '''controllers和selector只在事件循环线程里改; 循环没运行时直接执行'''
+        if not self._running or threading.current_thread() is self._thread:
+            callback()
+            return
+        future: Future = Future()
+
+        def run():
+            try:
+                callback()
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+        self.call_soon(run, future)
+        future.result()
+
+    def call_soon(self, callback: Callable, future: Optional[Future] = None):
+        '''
+        callback在事件循环线程里执行
+        future: callback负责完成的Future; 循环已经停止或停止前没来得及执行时, 以SdoError结束
+        '''
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._callbacks.append((callback, future))
+                # 在锁里唤醒: stop()置_closed之后才关闭管道, 不会写到已关闭的fd
+                self._wake()
+        if closed:
+            self._fail_stopped(future)
+
+    @staticmethod
+    def _fail_stopped(future: Optional[Future]):
+        if future is not None and not future.done():
+            future.set_exception(SdoError("串口事件循环已停止"))
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            # 管道满了说明已经有唤醒没处理
+            pass
+
+    def read_status_all(self, devs=None) -> Dict[str, Optional[dict]]:
+        '''
+        所有口(或devs里的口)同时流水线读状态, 耗时约为最慢的那个口的一次read_status
+        return: {dev: 状态dict, 失败None}
+        '''
+        controllers = [self.controllers[dev] for dev in (devs if devs is not None else list(self.controllers))]
+        requests = [sdo_codec.encode_upload(obj[0], obj[1]) for obj in STATUS_OBJECTS]
+        pending = [(controller, controller.parser.lrc_errors, controller.submit(requests))
+                   for controller in controllers]
+        statuses = {}
+        for controller, lrc_errors, future in pending:
+            try:
+                values = controller._read_values(STATUS_OBJECTS, future.result(),
+                                                 controller.parser.lrc_errors != lrc_errors)
+                statuses[controller.config.dev] = controller._status(values)
+            except SdoError:
+                statuses[controller.config.dev] = None
+        return statuses
+
+    # ------------------------- 事件循环线程 ------------------------
+    def _add(self, controller: SelectorRS232Controller):
+        self.selector.register(controller.ser.fileno(), selectors.EVENT_READ, controller)
+        self.controllers[controller.config.dev] = controller
+
+    def _remove(self, controller: SelectorRS232Controller):
+        if self.controllers.get(controller.config.dev) is not controller:
+            return
+        del self.controllers[controller.config.dev]
+        self.selector.unregister(controller.ser.fileno())
+        controller.fail_pending(SdoError(f"串口{controller.config.dev}已关闭"))
+        controller.ser.close()
+
+    def _run_callbacks(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            with self._lock:
+                if not self._callbacks:
+                    return
+                callback, _ = self._callbacks.popleft()
+            try:
+                callback()
+            except Exception:
+                logging.exception("串口事件循环回调异常")
+
+    def _run(self):
+        while self._running:
+            deadlines = [c.deadline for c in self.controllers.values() if c.deadline is not None]
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    self._run_callbacks()
+                else:
+                    key.data.on_readable()
+            now = time.monotonic()
+            for controller in list(self.controllers.values()):
+                if controller.deadline is not None and now >= controller.deadline:
+                    controller.on_timeout()
@@ -0,0 +1,117 @@
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+'''
+串口I/O线程: 串口只由这一个线程读写, 其他线程把命令投进优先级队列, 拿Future等结果
+
+    worker = SerialWorker(ctrl)              # ctrl: 已init的KincoRS232Controller
+    worker.start()
+    future = worker.submit(lambda c: c.read_status())
+    future.result()
+    worker.call(lambda c: c.quick_stop(), priority=PRIORITY_STOP)   # 插队到最前面
+
+    命令是参数为controller的函数, 在I/O线程里执行, 一个命令内的多帧(如move_to)不会被别的命令打断
+    同优先级按提交顺序执行; 正在执行的命令不会被打断, 停止命令最多等一个事务
+    空闲时每poll_interval秒把串口里的字节读出来丢掉(迟到的应答等), 内核缓冲区不会积压
+'''
+
+PRIORITY_STOP = 0       # 停止/急停
+PRIORITY_NORMAL = 1     # 运动/读写
+PRIORITY_LOW = 2        # 周期性的状态轮询
+
+
+class SerialWorker:
+    def __init__(self, controller, poll_interval: float = 0.01):
+        self.controller = controller
+        self.poll_interval = poll_interval
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        # 同优先级按提交顺序, 也避免比较函数对象
+        self._seq = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        # submit和stop共用: stop置位之后不会再有命令进队列
+        self._lock = threading.Lock()
+        self._closed = True
+        self.executed = 0
+        self.drained = 0        # 空闲时丢掉的字节数
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            self._closed = False
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"{self.controller.config.dev}-io", daemon=True)
+        self._thread.start()
+
+    def submit(self, command: Callable, priority: int = PRIORITY_NORMAL) -> Future:
+        '''command(controller)在I/O线程里执行, return: Future, 异常(如SdoError)从result()抛出'''
+        future: Future = Future()
+        with self._lock:
+            if not self._closed:
+                self._queue.put((priority, next(self._seq), command, future))
+                return future
+        future.set_exception(RuntimeError("串口I/O线程没有运行"))
+        return future
+
+    def call(self, command: Callable, priority: int = PRIORITY_NORMAL, timeout: Optional[float] = None):
+        '''submit并等待结果'''
+        return self.submit(command, priority).result(timeout)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def stop(self):
+        '''执行中的命令做完后退出, 队列里没执行的命令以RuntimeError结束'''
+        with self._lock:
+            self._closed = True
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        with self._lock:
+            while True:
+                try:
+                    _, _, _, future = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if not future.done():
+                    future.set_exception(RuntimeError("串口I/O线程已停止"))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------- 线程 ------------------------
+    def _drain(self):
+        ser = self.controller.ser
+        try:
+            waiting = ser.in_waiting
+            if waiting:
+                self.drained += len(ser.read(waiting))
+        except Exception as e:
+            logging.error(f"读串口{self.controller.config.dev}失败: {e}")
+        # 解析器里残留的半帧/迟到应答也一起丢掉, 下一个命令从干净的缓冲区开始
+        self.controller.parser.reset()
+
+    def _run(self):
+        while self._running:
+            try:
+                _, _, command, future = self._queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                self._drain()
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(command(self.controller))
+            except BaseException as e:
+                future.set_exception(e)
+            self.executed += 1
@@ -0,0 +1 @@
+../can/txn_stats.py
\ No newline at end of file
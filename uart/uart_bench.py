@@ -0,0 +1,164 @@
+import argparse
+import logging
+import statistics
+import time
+from typing import List
+
+from kinco_frame import KincoFrameParser, encode_frame
+from kinco_uart_sim import KincoUartSimulator
+from nmx_lift_uart_device import KincoRS232Controller, KincoObject, NmxLiftDevice, UartConfig, STATUS_OBJECTS
+from serial_loop import SerialLoop
+import sdo_codec
+
+'''
+RS232驱动性能基准, 跑在kinco_uart_sim伪终端仿真器上, 不需要实物
+
+    python3 uart_bench.py
+    python3 uart_bench.py --bauds 9600,115200 --latency 0.001
+    python3 uart_bench.py --noise 0.01 --drop-byte 0.01 --corrupt 0.01
+
+输出:
+    帧解析耗时(纯CPU, 不经过串口) us/帧
+    各波特率下: 流水线读的吞吐(帧/秒, 和线路上限对比)
+                read_status()(流水线) 和 逐个sdo_read 的耗时 p50/p99/max
+                解析器统计(LRC错误/重新同步丢掉的字节)
+    多口(serial_loop事件循环, 一个线程): 所有口一起读状态的耗时, 和逐口读对比
+'''
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    k = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[k]
+
+
+def summarize(samples: List[float]) -> dict:
+    return {"count": len(samples),
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "max_ms": max(samples) * 1000,
+            "mean_ms": statistics.fmean(samples) * 1000}
+
+
+def bench_parse(frames: int, chunk: int = 64) -> float:
+    '''return: 每帧解析耗时(秒), 数据按chunk字节一块块喂, 和串口读到的情况相近'''
+    data = b"".join(encode_frame(sdo_codec.encode_upload_response(0x6063, 0, i, 4)) for i in range(frames))
+    parser = KincoFrameParser()
+    count = 0
+    start = time.perf_counter()
+    for offset in range(0, len(data), chunk):
+        parser.feed(data[offset:offset + chunk])
+        while parser.pop() is not None:
+            count += 1
+    elapsed = time.perf_counter() - start
+    assert count == frames, f"解析出{count}帧, 应为{frames}帧"
+    return elapsed / frames
+
+
+def bench_throughput(ctrl: KincoRS232Controller, frames: int) -> float:
+    '''return: 流水线读每秒收到的应答数, 丢掉/坏掉的应答不算'''
+    request = sdo_codec.encode_upload(*KincoObject.POS_ACTUAL)
+    start = time.perf_counter()
+    results = ctrl._transact([request] * frames)
+    elapsed = time.perf_counter() - start
+    return sum(frame is not None for frame, _ in results) / elapsed
+
+
+def bench_status(ctrl: KincoRS232Controller, count: int, pipelined: bool) -> dict:
+    '''失败(超时/中止)的次数计入errors, 不计入耗时统计'''
+    samples = []
+    errors = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            if pipelined:
+                ctrl.read_status()
+            else:
+                for obj in STATUS_OBJECTS:
+                    ctrl.sdo_read(*obj)
+        except sdo_codec.SdoError:
+            errors += 1
+            continue
+        samples.append(time.perf_counter() - start)
+    return dict(summarize(samples), errors=errors) if samples else {"errors": errors}
+
+
+def bench_multi_port(ports: int, baudrate: int, latency: float, rounds: int) -> dict:
+    '''return: {"parallel": 所有口同时读状态, "serial": 逐口读状态} 的耗时统计'''
+    sims = [KincoUartSimulator(baudrate=baudrate, latency=latency).start() for _ in range(ports)]
+    loop = SerialLoop().start()
+    devices = []
+    try:
+        for sim in sims:
+            config = UartConfig()
+            config.dev = sim.port
+            config.baudrate = baudrate
+            device = NmxLiftDevice(config, loop=loop)
+            device.init(None)
+            devices.append(device)
+        result = {"parallel": [], "serial": []}
+        for _ in range(rounds):
+            start = time.perf_counter()
+            statuses = loop.read_status_all()
+            result["parallel"].append(time.perf_counter() - start)
+            assert all(statuses.values()), f"读状态失败: {statuses}"
+            start = time.perf_counter()
+            for device in devices:
+                device.ctrl.read_status()
+            result["serial"].append(time.perf_counter() - start)
+        return {name: summarize(samples) for name, samples in result.items()}
+    finally:
+        for device in devices:
+            device.Close()
+        loop.stop()
+        for sim in sims:
+            sim.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kinco RS232驱动基准(仿真器)")
+    parser.add_argument("--bauds", default="19200,38400,115200", help="测试的波特率")
+    parser.add_argument("--count", type=int, default=200, help="状态读次数")
+    parser.add_argument("--frames", type=int, default=500, help="吞吐测试帧数")
+    parser.add_argument("--latency", type=float, default=0.0005, help="驱动器处理一个请求的时间(秒)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="处理时间抖动(秒)")
+    parser.add_argument("--noise", type=float, default=0.0, help="应答前插入噪声字节的概率")
+    parser.add_argument("--drop-byte", type=float, default=0.0, help="应答丢一个字节的概率")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="应答改坏一个字节的概率")
+    parser.add_argument("--ports", default="1,4,12", help="多口测试的串口数")
+    args = parser.parse_args()
+
+    # 有噪声时失败是预期的, 不刷屏
+    logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s - %(levelname)s - %(message)s')
+    print(f"帧解析:             {bench_parse(20000) * 1e6:.2f} us/帧")
+
+    for baudrate in [int(b) for b in args.bauds.split(",")]:
+        with KincoUartSimulator(baudrate=baudrate, latency=args.latency, jitter=args.jitter,
+                                noise_rate=args.noise, drop_byte_rate=args.drop_byte,
+                                corrupt_rate=args.corrupt) as sim:
+            config = UartConfig()
+            config.dev = sim.port
+            config.baudrate = baudrate
+            ctrl = KincoRS232Controller(config)
+            ctrl.init()
+            # 有丢字节时超时是常态, 缩短超时免得基准跑太久
+            ctrl.ser.timeout = 0.1
+            try:
+                # 每帧10字节, 每字节10位; 请求和应答各占一个方向
+                line_limit = baudrate / 10 / 10
+                print(f"[{baudrate}bps] 吞吐: {bench_throughput(ctrl, args.frames):.0f} 帧/秒 "
+                      f"(线路上限{line_limit:.0f})")
+                print(f"[{baudrate}bps] read_status(流水线): {bench_status(ctrl, args.count, True)}")
+                print(f"[{baudrate}bps] 逐个sdo_read x{len(STATUS_OBJECTS)}: "
+                      f"{bench_status(ctrl, args.count, False)}")
+                print(f"[{baudrate}bps] 解析器: {ctrl.parser.stats()}, 仿真器: 请求{sim.requests} 应答{sim.replies}")
+            finally:
+                ctrl.ser.close()
+
+    baudrate = int(args.bauds.split(",")[-1])
+    for ports in [int(n) for n in args.ports.split(",")]:
+        for name, stats in bench_multi_port(ports, baudrate, args.latency, min(args.count, 100)).items():
+            print(f"[{baudrate}bps] {ports}口读状态({name}): {stats}")
+
+
+if __name__ == "__main__":
+    main()